@@ -0,0 +1,242 @@
+import sys
+import json
+import time
+import hashlib
+import tracemalloc
+import warnings
+import numpy as np
+import pandas as pd
+import indicators
+import stock2026
+import stock_html
+import stock_bao
+import stock_pytdx
+from history_store import STORE_DIR, store_exists, list_history_codes, load_history
+warnings.filterwarnings('ignore')
+
+# ==========================================
+# 各版本指标流水线的一致性与性能基准
+# ==========================================
+# 同一套策略现在有好几份实现：stock2026 / stock_html / stock_bao 的 XMA 是 EMA，stock_pytdx 的 XMA 是向历史平移的居中均线，
+# 均线的 min_periods 也各不相同 (tdx 为 1，其余为窗口长度)。这里在固定的数据快照上把每个版本的指标流水线各跑一遍：
+#   一致性：以 REFERENCE 版本为准，按 (股票, 日期) 对齐后逐列统计超出容差的行数、NaN 不一致行数、最大绝对/相对误差；
+#   性能：  每个阶段 (读快照 / 各版本计算 / 对照) 记录耗时与 tracemalloc 峰值内存。
+# 快照 = 仓库中按代码排序的前 SAMPLE_SIZE 只股票、截至 SNAPSHOT_END 的日线；快照指纹与耗时一起存入基线文件，
+# 之后每次运行都与基线对比，指纹不同 (数据或样本变了) 时只提示、不比较耗时。
+# 计算期间关闭指标缓存，测的是真实计算量。
+
+# --- 配置 ---
+HISTORY_STORE_DIR = STORE_DIR
+SNAPSHOT_END = '2025-12-31'          # 快照截止日期 (之后新下载的K线不影响结果)
+SAMPLE_SIZE = 100                    # 参与基准的股票数，0 表示全部
+REFERENCE = 'bao'                    # 一致性对照的基准版本 (逐日增量状态与回放均以 bao 口径为准)
+VALUE_RTOL = 1e-9
+VALUE_ATOL = 1e-9
+TRACE_MEMORY = True                  # 每个阶段额外再跑一遍，用 tracemalloc 记录峰值内存
+REPORT_FILE = 'benchmark_report.csv'
+BASELINE_FILE = 'benchmark_baseline.json'
+
+COMPARE_COLUMNS = ['MA5', 'MA10', 'MA20', 'MA60', 'VOL_MA5', 'DIF', 'DEA', 'BBI', '波动率%', 'MA20_Angle',
+                   'RA', 'RC', 'RD', 'RE', 'RF', 'S2_BuyLine',
+                   'S1_Signal', 'S2_Signal', 'S3_Signal', 'S1_Streak', 'S2_Streak', 'S3_Streak']
+# tdx_formula 输出名 -> 选股脚本列名
+FORMULA_COLUMNS = {'MA5': 'MA5', 'MA10': 'MA10', 'MA20': 'MA20', 'MA60': 'MA60', 'VOL_MA5': 'VOL_MA5',
+                   'DIF': 'DIF', 'DEA': 'DEA', 'MA20_ANGLE': 'MA20_Angle', 'BUY_SIGNAL': 'S3_Signal',
+                   'RA': 'RA', 'RC': 'RC', 'RD': 'RD', 'RE': 'RE', 'RF': 'RF'}
+
+# ==========================================
+# 1. 数据快照
+# ==========================================
+def load_snapshot(codes=None, end_date=SNAPSHOT_END):
+    """返回 ({代码: 日期索引的日线}, 快照指纹)；未指定股票时取前 SAMPLE_SIZE 只"""
+    if not codes:
+        codes = list_history_codes(HISTORY_STORE_DIR)
+        sample_size = SAMPLE_SIZE
+    else:
+        sample_size = 0
+    if sample_size:
+        codes = sorted(codes)[:sample_size]
+    end = pd.to_datetime(end_date)
+    frames = {}
+    digest = hashlib.blake2b(digest_size=16)
+    for code in codes:
+        df = load_history(code, HISTORY_STORE_DIR)
+        if df is None:
+            continue
+        df = df[df['日期'] <= end].set_index('日期')
+        if df.empty:
+            continue
+        frames[code] = df
+        digest.update(code.encode())
+        digest.update(df.index.values.tobytes())
+        digest.update(np.ascontiguousarray(df[['开盘', '收盘', '最高', '最低', '成交量']].to_numpy()).tobytes())
+    return frames, digest.hexdigest()
+
+# ==========================================
+# 2. 各版本流水线 (输入快照，输出 股票代码/日期 + 指标列 的长表)
+# ==========================================
+def _long(code, df):
+    columns = [c for c in COMPARE_COLUMNS if c in df.columns]
+    out = df[columns].reset_index()
+    out.insert(0, '股票代码', code)
+    return out
+
+def _per_stock(compute):
+    def run(frames):
+        parts = [_long(code, compute(df.copy(), code)) for code, df in frames.items()]
+        return pd.concat(parts, ignore_index=True)
+    return run
+
+def _formula(frames):
+    """公式编译器：主升浪 + 历史大底编译进同一张图，在面板上一次算完全部股票"""
+    from panel_engine import load_bars, long_table
+    from tdx_formula import compile_strategies
+    bars = load_bars(list(frames))
+    graph = compile_strategies({'RIGHT_SIDE_PRO': ({'SLOPE': 25}, None), 'DEEP_BOTTOM': ({}, None)})
+    results = graph.evaluate(bars)
+    arrays = {FORMULA_COLUMNS[k]: v for outputs in results.values() for k, v in outputs.items() if k in FORMULA_COLUMNS}
+    table = long_table(bars, arrays, ['股票代码', '日期'] + list(arrays), end_date=SNAPSHOT_END, min_bars=0)
+    table['S3_Signal'] = table['S3_Signal'].astype(np.int8)
+    return table
+
+VARIANTS = {
+    'stock2026': _per_stock(lambda df, code: stock2026.compute_signals(df)),
+    'html': _per_stock(stock_html.compute_signals),
+    'bao': _per_stock(stock_bao.compute_signals),
+    'tdx': _per_stock(stock_pytdx.compute_signals),
+    'formula': _formula,
+}
+
+# ==========================================
+# 3. 计时 / 内存 / 对照
+# ==========================================
+def measure(func, *args):
+    """
+    返回 (结果, 耗时秒, tracemalloc 峰值 MB)。
+    tracemalloc 会明显拖慢 pandas，所以先不开追踪计时，再开追踪重跑一次取峰值内存。
+    """
+    start = time.perf_counter()
+    result = func(*args)
+    elapsed = time.perf_counter() - start
+    if TRACE_MEMORY:
+        tracemalloc.start()
+        try:
+            func(*args)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+    else:
+        peak = 0
+    return result, elapsed, peak / 2**20
+
+def compare_columns(reference, candidate, variant):
+    """按 (股票代码, 日期) 对齐后逐列统计差异，返回记录列表"""
+    merged = reference.merge(candidate, on=['股票代码', '日期'], suffixes=('', '@'))
+    records = []
+    for col in COMPARE_COLUMNS:
+        if col not in reference.columns or col not in candidate.columns:
+            continue
+        a = merged[col].to_numpy(dtype=np.float64)
+        b = merged[col + '@'].to_numpy(dtype=np.float64)
+        nan_a, nan_b = np.isnan(a), np.isnan(b)
+        both = ~nan_a & ~nan_b
+        diff = np.abs(a - b)
+        bad = both & (diff > VALUE_ATOL + VALUE_RTOL * np.maximum(np.abs(a), np.abs(b)))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rel = np.where(both & (diff > 0), diff / np.maximum(np.abs(a), np.abs(b)), 0.0)
+        records.append({
+            '版本': variant, '指标': col, '对齐行数': len(merged),
+            '超差行数': int(bad.sum()), 'NaN不一致行数': int((nan_a != nan_b).sum()),
+            '最大绝对误差': float(diff[both].max()) if both.any() else 0.0,
+            '最大相对误差': float(rel.max()) if len(rel) else 0.0,
+        })
+    return records
+
+# ==========================================
+# 4. 基线
+# ==========================================
+def load_baseline(path=BASELINE_FILE):
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def save_baseline(fingerprint, timings, path=BASELINE_FILE):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({'fingerprint': fingerprint, 'snapshot_end': SNAPSHOT_END, 'sample_size': SAMPLE_SIZE,
+                   'recorded': time.strftime('%Y-%m-%d %H:%M:%S'), 'stages': timings}, f, ensure_ascii=False, indent=2)
+
+def run_benchmark(variants=None, codes=None, save=False):
+    variants = variants or list(VARIANTS)
+    if REFERENCE not in variants:
+        variants = [REFERENCE] + variants
+    indicators.INDICATOR_CACHE_ENABLED = False
+
+    timings = {}
+    (frames, fingerprint), seconds, peak = measure(load_snapshot, codes)
+    timings['读快照'] = {'seconds': seconds, 'peak_mb': peak}
+    print(f"📸 快照 {len(frames)} 只股票，截至 {SNAPSHOT_END}，指纹 {fingerprint}，读取 {seconds:.2f}s")
+
+    tables = {}
+    for name in variants:
+        tables[name], seconds, peak = measure(VARIANTS[name], frames)
+        timings[name] = {'seconds': seconds, 'peak_mb': peak}
+
+    records = []
+    compare_seconds, compare_peak = 0.0, 0.0
+    for name in variants:
+        if name != REFERENCE:
+            result, seconds, peak = measure(compare_columns, tables[REFERENCE], tables[name], name)
+            records.extend(result)
+            compare_seconds, compare_peak = compare_seconds + seconds, max(compare_peak, peak)
+    timings['对照'] = {'seconds': compare_seconds, 'peak_mb': compare_peak}
+    report = pd.DataFrame(records)
+    if not report.empty:
+        report.to_csv(REPORT_FILE, index=False, encoding='utf-8-sig')
+
+    baseline = load_baseline()
+    comparable = baseline is not None and baseline.get('fingerprint') == fingerprint
+    print(f"\n⏱️ 各阶段耗时 / 峰值内存" + ("" if comparable else " (无可比基线)"))
+    for stage, t in timings.items():
+        line = f"  {stage:<10} {t['seconds']:8.2f}s {t['peak_mb']:9.1f} MB"
+        old = baseline['stages'].get(stage) if comparable else None
+        if old:
+            line += f"   基线 {old['seconds']:.2f}s / {old['peak_mb']:.1f} MB ({t['seconds'] / old['seconds'] - 1:+.0%})"
+        print(line)
+    if baseline is not None and not comparable:
+        print(f"  ⚠️ 基线 {BASELINE_FILE} 的快照指纹不同 (数据或样本已变)，耗时不可直接比较")
+
+    print(f"\n🔍 与 {REFERENCE} 的逐列差异 (只列出有差异的指标)")
+    for name in variants:
+        if name == REFERENCE:
+            continue
+        rows = report[(report['版本'] == name) & ((report['超差行数'] > 0) | (report['NaN不一致行数'] > 0))]
+        total = int((report['版本'] == name).sum())
+        if rows.empty:
+            print(f"  [{name}] {total} 个共同指标全部一致")
+            continue
+        print(f"  [{name}] {total} 个共同指标中 {len(rows)} 个有差异:")
+        for _, r in rows.iterrows():
+            print(f"    {r['指标']:<11} 超差 {r['超差行数']:>7} 行  NaN不一致 {r['NaN不一致行数']:>6} 行  "
+                  f"最大绝对误差 {r['最大绝对误差']:.3g}  最大相对误差 {r['最大相对误差']:.3g}")
+    print(f"📄 逐列明细已保存至: {REPORT_FILE}")
+
+    if save:
+        save_baseline(fingerprint, timings)
+        print(f"💾 已记录基线: {BASELINE_FILE}")
+    return report, timings
+
+if __name__ == '__main__':
+    # python3 benchmark.py                     全部版本，与基线比较
+    # python3 benchmark.py save                 运行并把本次耗时记录为基线
+    # python3 benchmark.py bao tdx 000001 ...   指定版本与股票 (指定股票时不受 SAMPLE_SIZE 限制)
+    if not store_exists(HISTORY_STORE_DIR):
+        print(f"错误: 找不到历史数据仓库 {HISTORY_STORE_DIR}。请先运行 download_history.py 下载！")
+        sys.exit(1)
+    args = sys.argv[1:]
+    save = 'save' in args
+    args = [a for a in args if a != 'save']
+    variants = [a for a in args if a in VARIANTS]
+    codes = [str(a).zfill(6) for a in args if a not in VARIANTS]
+    run_benchmark(variants or None, codes or None, save)
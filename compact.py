@@ -0,0 +1,172 @@
+import sys
+import numpy as np
+import pandas as pd
+
+# ==========================================
+# 紧凑长表：float32 价格/指标 + 分类股票代码 + 位打包信号
+# ==========================================
+# 回测预处理得到的长表 (股票 × 交易日 一行) 默认是 float64 价格、object 字符串股票代码、每个信号一列 bool。
+# 5000 只股票 × 20 年约 2500 万行，float64 + object 代码要好几个 GB，撮合循环逐行扫描时缓存也装不下。
+# compact_table 把它压成：
+#   浮点列       -> float32 (每个值相对误差不超过 FLOAT32_RTOL，即舍入到最近的 float32)
+#   股票代码     -> pandas 分类列 (每行只存 int16/int32 编号，字符串只存一份)
+#   bool 信号列  -> 合并成一列 uint8 的 FLAG_COLUMN，第 i 位对应 flag_columns[i]
+# 日期列保持 datetime64 不变。信号在 float64 下算好后才打包，所以买卖信号本身完全不受影响；
+# 受 float32 影响的只有成交价/斜率等数值，偏差在 FLOAT32_RTOL 以内，
+# 只有当某个值离阈值 (如斜率阈值、止盈止损比例) 不到这个相对距离时，撮合结果才可能与 float64 不同。
+# 注意撮合是路径相关的：开盘价恰好落在止盈线上 (涨幅正好 20.00%) 这类边界一旦翻转，后续资金与持仓都会随之改变，
+# 所以压缩表适合大范围参数筛选与内存受限的场景，需要逐笔对账时仍用默认的 float64 长表。
+# 撮合循环统一用 iter_rows 遍历：未压缩的表等同 itertuples，压缩的表按块把信号位解开成同名 bool 字段。
+
+# --- 配置 ---
+FLOAT_DTYPE = np.float32
+FLAG_COLUMN = 'flags'
+FLOAT32_RTOL = 2.0 ** -24      # float64 舍入到最近 float32 的最大相对误差 (半个 ulp)
+ITER_CHUNK_ROWS = 65536        # iter_rows 每次解开的行数，块越小缓存占用越少
+
+def compact_table(df, code_column='股票代码', flag_columns=None):
+    """
+    把回测长表压缩为紧凑表示 (不修改原表)。
+    flag_columns: 要打包的 bool 列 (最多 8 个)，默认取表中全部 bool 列
+    位编号记录在 attrs['flag_bits'] 中，flag_bits(df) 可取回。
+    """
+    if flag_columns is None:
+        flag_columns = [c for c in df.columns if df[c].dtype == bool]
+    flag_columns = list(flag_columns)
+    if len(flag_columns) > 8:
+        raise ValueError(f"最多打包 8 个信号列，实际 {len(flag_columns)} 个")
+
+    result = {}
+    flags = np.zeros(len(df), dtype=np.uint8)
+    bits = {}
+    for col in df.columns:
+        if col in flag_columns:
+            bit = 1 << flag_columns.index(col)
+            flags |= df[col].to_numpy(dtype=bool).astype(np.uint8) * np.uint8(bit)
+            bits[col] = bit
+        elif col == code_column:
+            result[col] = df[col].astype('category')
+        elif pd.api.types.is_float_dtype(df[col].dtype):
+            result[col] = df[col].to_numpy().astype(FLOAT_DTYPE)
+        else:
+            result[col] = df[col].to_numpy()
+    if flag_columns:
+        result[FLAG_COLUMN] = flags
+
+    compact = pd.DataFrame(result, index=df.index)
+    compact.attrs['flag_bits'] = bits
+    return compact
+
+def flag_bits(df):
+    """压缩表的 {信号列: 位掩码}；未压缩的表返回空字典"""
+    return dict(df.attrs.get('flag_bits', {})) if FLAG_COLUMN in df.columns else {}
+
+def expand_table(df):
+    """compact_table 的逆操作：浮点列升回 float64、代码列还原为字符串、信号位解开为 bool 列"""
+    bits = flag_bits(df)
+    result = {}
+    for col in df.columns:
+        if col == FLAG_COLUMN and bits:
+            flags = df[col].to_numpy()
+            for name, bit in bits.items():
+                result[name] = (flags & bit) != 0
+        elif isinstance(df[col].dtype, pd.CategoricalDtype):
+            result[col] = df[col].astype(object).to_numpy()
+        elif df[col].dtype == FLOAT_DTYPE:
+            result[col] = df[col].to_numpy().astype(np.float64)
+        else:
+            result[col] = df[col].to_numpy()
+    return pd.DataFrame(result, index=df.index)
+
+def column_values(df, name):
+    """取一列的 numpy 数组；压缩表中已打包的信号列按位解开为 bool 数组"""
+    bits = flag_bits(df)
+    if name in bits:
+        return (df[FLAG_COLUMN].to_numpy() & bits[name]) != 0
+    return df[name].to_numpy()
+
+def iter_rows(df, chunk_rows=ITER_CHUNK_ROWS):
+    """
+    逐行遍历长表，行对象与 df.itertuples(index=False) 相同 (按列名取属性，值为 Python 标量)。
+    压缩表的信号位按块解开成原来的 bool 字段，代码列直接给出字符串，调用方无需区分两种表示。
+    """
+    bits = flag_bits(df)
+    if not bits:
+        yield from df.itertuples(index=False)
+        return
+    columns = [c for c in df.columns if c != FLAG_COLUMN] + list(bits)
+    for start in range(0, len(df), chunk_rows):
+        chunk = df.iloc[start:start + chunk_rows]
+        flags = chunk[FLAG_COLUMN].to_numpy()
+        data = {c: chunk[c] for c in columns if c not in bits}
+        data.update({name: (flags & bit) != 0 for name, bit in bits.items()})
+        yield from pd.DataFrame(data, columns=columns).itertuples(index=False)
+
+def memory_bytes(df):
+    """长表实际占用的内存 (含 object 字符串本身)"""
+    return int(df.memory_usage(deep=True).sum())
+
+def check_tolerance(reference, compact, rtol=FLOAT32_RTOL):
+    """
+    压缩表与 float64 原表的对照，返回 {列名: 最大相对误差}。
+    约定的容差：浮点列逐值相对误差 <= rtol 且 NaN 位置一致；代码、日期、信号列必须完全相等。
+    不满足时抛出 AssertionError 并指明列名。
+    """
+    restored = expand_table(compact)
+    assert list(restored.columns) == list(reference.columns), (list(restored.columns), list(reference.columns))
+    errors = {}
+    for col in reference.columns:
+        expected = reference[col].to_numpy()
+        actual = restored[col].to_numpy()
+        if pd.api.types.is_float_dtype(reference[col].dtype):
+            nan = np.isnan(expected)
+            assert np.array_equal(nan, np.isnan(actual)), f"{col}: NaN 位置不一致"
+            with np.errstate(divide='ignore', invalid='ignore'):
+                rel = np.abs(actual - expected) / np.abs(expected)
+            rel[nan | (expected == actual)] = 0.0
+            # 低于 float32 最小正规数的值按绝对误差计，避免 0 附近的相对误差失真
+            tiny = np.abs(expected) < np.finfo(FLOAT_DTYPE).tiny
+            rel[tiny] = np.abs(actual - expected)[tiny]
+            # float32 溢出的值 (|x| > 3.4e38) 不可能出现在行情与指标中，这里一并视为超差
+            worst = float(rel.max()) if len(rel) else 0.0
+            assert worst <= rtol, f"{col}: 最大相对误差 {worst:.3g} 超过容差 {rtol:.3g}"
+            errors[col] = worst
+        else:
+            assert np.array_equal(expected, actual), f"{col}: 数值不一致"
+            errors[col] = 0.0
+    return errors
+
+def report_compaction(reference, compact):
+    """打印压缩前后的内存占用"""
+    before, after = memory_bytes(reference), memory_bytes(compact)
+    print(f"🗜️ 长表 {len(reference)} 行：{before / 2**20:.1f} MB -> {after / 2**20:.1f} MB "
+          f"(每行 {before / max(len(reference), 1):.0f} -> {after / max(len(reference), 1):.0f} 字节)")
+
+if __name__ == '__main__':
+    # python3 compact.py [开始日期 结束日期]   用仓库数据生成主升浪 / 左侧长表，检查容差并报告内存
+    import time
+    from history_store import STORE_DIR, store_exists, list_history_codes
+    from panel_engine import load_bars, main_wave_signals, channel_signals, long_table
+    if not store_exists(STORE_DIR):
+        print(f"错误: 找不到历史数据仓库 {STORE_DIR}。请先运行 download_history.py 下载！")
+        sys.exit(1)
+    start_date, end_date = (sys.argv[1:3] + [None, None])[:2]
+    codes = list_history_codes(STORE_DIR)
+    tables = {
+        '主升浪': (load_bars(codes), lambda bars: main_wave_signals(bars, min_periods=1, slope_threshold=25),
+                   ['日期', '股票代码', '开盘', '收盘', '最高', '最低', '成交量', 'MA20_ANGLE',
+                    'BUY_SIGNAL', 'SELL_SIGNAL', 'is_limit_up', 'is_limit_down']),
+        '左侧': (load_bars(codes, dropna=True), lambda bars: channel_signals(bars, 5, 5, 8),
+                 ['日期', '股票代码', '开盘', '收盘', '最高', '最低', 'BIAS_VAL',
+                  'BUY_SIGNAL', 'SELL_SIGNAL', 'is_limit_up', 'is_limit_down']),
+    }
+    for name, (bars, build, columns) in tables.items():
+        reference = long_table(bars, build(bars), columns, start_date, end_date)
+        t0 = time.time()
+        compact = compact_table(reference)
+        t1 = time.time()
+        errors = check_tolerance(reference, compact)
+        print(f"[{name}] 压缩耗时 {t1 - t0:.2f}s，容差检查通过，最大相对误差 {max(errors.values()):.3g} (容差 {FLOAT32_RTOL:.3g})")
+        report_compaction(reference, compact)
+        per_row = memory_bytes(compact) / max(len(compact), 1)
+        print(f"    按此估算 5000 只 × 20 年 (约 2500 万行) 约 {per_row * 25e6 / 2**30:.2f} GB")
@@ -1,97 +1,258 @@
 import os
+import time
+import argparse
 import pandas as pd
 import baostock as bs
 import datetime
+from multiprocessing import Pool
+from universe import load_universe, baostock_code
+from history_store import STORE_DIR, write_store, store_exists, load_all_history, load_history, read_manifest, qfq_changed
 
 # --- 配置 ---
 INPUT_FILE = 'stock_list.xlsx'
-SAVE_DIR = './history_data'  # 数据保存在当前目录的 history_data 文件夹下
+SAVE_DIR = STORE_DIR         # 数据直接写入列式仓库 (CSV 需要时用 history_store.py export 导出)
 YEARS_TO_FETCH = 5           # 下载过去5年的数据
+REQUEST_INTERVAL = 0.05      # 每个进程两次请求之间的最小间隔 (秒)，防止被 Baostock 限流
+RETRY_ROUNDS = 2             # 失败股票的重试轮数
+DATA_READY_HOUR = 18         # Baostock 当天日线大约收盘后 17:30 入库，此前当天不算作"可下载的最后交易日"
 
-if not os.path.exists(SAVE_DIR):
-    os.makedirs(SAVE_DIR)
+# 用法:
+#   python3 download_history.py                          全量下载 (按股票列表重建仓库；重试后仍失败的股票保留旧数据)
+#   python3 download_history.py --incremental            增量续传 (按 manifest 只下载每只股票最后日期之后的新K线)
+#   python3 download_history.py --workers 4              多进程分片下载，每个进程独立登录一次 Baostock
 
-def convert_to_baostock_code(code):
-    """将 6 位纯数字代码转换为 Baostock 需要的 sh. / sz. 格式"""
-    code_str = str(code).zfill(6)
-    if code_str.startswith('6'):
-        return f"sh.{code_str}"
-    elif code_str.startswith('0') or code_str.startswith('3'):
-        return f"sz.{code_str}"
-    elif code_str.startswith('4') or code_str.startswith('8'):
-        return f"bj.{code_str}"
-    return f"sh.{code_str}" # 默认回退
+def fetch_history(raw_code, start_str, end_str):
+    """
+    下载单只股票 [start_str, end_str] 区间的前复权日线。
+    返回 (DataFrame 或 None, 错误信息)；区间内没有K线时返回空 DataFrame。
+    """
+    bs_code = baostock_code(raw_code)
+
+    # adjustflag="2" 代表前复权 (极其重要)
+    rs = bs.query_history_k_data_plus(
+        bs_code,
+        "date,open,close,high,low,volume",
+        start_date=start_str,
+        end_date=end_str,
+        frequency="d",
+        adjustflag="2"
+    )
+
+    if rs.error_code != '0':
+        return None, rs.error_msg
+
+    data_list = []
+    while (rs.error_code == '0') & rs.next():
+        data_list.append(rs.get_row_data())
+
+    df = pd.DataFrame(data_list, columns=rs.fields)
+
+    # 重命名列以完美适配您的回测系统
+    df.rename(columns={
+        'date': '日期',
+        'open': '开盘',
+        'close': '收盘',
+        'high': '最高',
+        'low': '最低',
+        'volume': '成交量'
+    }, inplace=True)
+
+    # 类型转换 (字符串 -> datetime64 / float64) 统一在写入仓库时完成
+    return df, ""
+
+def last_trading_day(end_date, now=None):
+    """
+    返回截至 end_date 已有日线可下载的最后一个交易日 (YYYY-MM-DD)。
+    周末、节假日取之前最近的交易日；当天是交易日但还没到 DATA_READY_HOUR 时取前一个交易日。
+    查询失败时退回 end_date 本身 (行为与按日历日判断相同)。
+    """
+    now = now or datetime.datetime.now()
+    end_str = end_date.strftime('%Y-%m-%d')
+    lg = bs.login()
+    try:
+        rs = bs.query_trade_dates(start_date=(end_date - datetime.timedelta(days=30)).strftime('%Y-%m-%d'), end_date=end_str)
+        rows = []
+        while (rs.error_code == '0') & rs.next():
+            rows.append(rs.get_row_data())
+    finally:
+        bs.logout()
+    if lg.error_code != '0' or rs.error_code != '0':
+        print(f"⚠️ 查询交易日历失败，按日历日 {end_str} 判断是否需要下载。")
+        return end_str
+    days = [date for date, is_trading in rows if is_trading == '1']
+    if days and days[-1] == now.strftime('%Y-%m-%d') and now.hour < DATA_READY_HOUR:
+        days = days[:-1]
+    return days[-1] if days else end_str
+
+def plan_downloads(raw_codes, start_str, ready_str, incremental):
+    """
+    生成每只股票的下载区间 {代码: 开始日期}。
+    增量模式下已在仓库中的股票从 manifest 记录的最后日期开始下载 (多取这一根重叠K线用于复权校验)；
+    最后日期已到 ready_str (最后一个已有日线的交易日) 的股票不会有新K线，直接跳过。
+    """
+    manifest = read_manifest(SAVE_DIR) if incremental else {}
+    plan = {}
+    for raw_code in raw_codes:
+        entry = manifest.get(raw_code)
+        if entry and entry.get('end'):
+            if entry['end'] >= ready_str:
+                continue
+            plan[raw_code] = entry['end']
+        else:
+            plan[raw_code] = start_str
+    return plan
+
+def download_code(raw_code, fetch_start, end_str, full_start, incremental):
+    """
+    下载单只股票并完成复权校验，返回 (代码, DataFrame 或 None, 是否整段替换, 错误信息)。
+    只依赖当前进程的 Baostock 会话，单线程模式和多进程 worker 共用这一个函数。
+    """
+    df, error_msg = fetch_history(raw_code, fetch_start, end_str)
+    if df is None:
+        return raw_code, None, False, error_msg
+
+    old_df = load_history(raw_code, SAVE_DIR) if incremental else None
+    if old_df is None or old_df.empty:
+        return raw_code, df, True, ""
+
+    # 前复权价被改写：只对这一只股票重新下载它在仓库中覆盖的完整区间
+    if qfq_changed(old_df, df):
+        time.sleep(REQUEST_INTERVAL)
+        df, error_msg = fetch_history(raw_code, full_start, end_str)
+        if df is None:
+            return raw_code, None, False, error_msg
+        return raw_code, df, True, "readjusted"
+
+    # 去掉用于校验的重叠K线，只追加真正的新K线
+    df = df[pd.to_datetime(df['日期']) > old_df['日期'].iloc[-1]]
+    return raw_code, df, False, ""
+
+def _worker_init():
+    """多进程 worker 初始化：每个进程持有自己的 Baostock 会话 (客户端全局会话不能跨线程共享)"""
+    lg = bs.login()
+    if lg.error_code != '0':
+        print(f"\n[worker {os.getpid()}] Baostock 登录失败: {lg.error_msg}")
+
+def _worker_download(task):
+    """worker 中执行单个下载任务，并按 REQUEST_INTERVAL 自行控制请求节奏"""
+    try:
+        result = download_code(*task)
+    except Exception as e:
+        result = (task[0], None, False, str(e))
+    time.sleep(REQUEST_INTERVAL)
+    return result
+
+def run_tasks(tasks, workers):
+    """按顺序产出每个任务的下载结果；workers > 1 时把任务分片给多个进程并行下载"""
+    if workers <= 1:
+        lg = bs.login()
+        if lg.error_code != '0':
+            print(f"Baostock 登录失败: {lg.error_msg}")
+            exit()
+        try:
+            for task in tasks:
+                yield _worker_download(task)
+        finally:
+            bs.logout()
+        return
+
+    chunksize = max(1, len(tasks) // (workers * 8))
+    with Pool(processes=workers, initializer=_worker_init) as pool:
+        for result in pool.imap_unordered(_worker_download, tasks, chunksize=chunksize):
+            yield result
 
 if __name__ == '__main__':
-    print("=== 开始使用 Baostock 下载历史前复权数据 (单线程稳定版) ===")
+    parser = argparse.ArgumentParser(description='Baostock 前复权日线下载器')
+    parser.add_argument('--incremental', action='store_true', help='增量续传，只下载仓库最后日期之后的新K线')
+    parser.add_argument('--workers', type=int, default=1, help='下载进程数 (每个进程独立登录 Baostock)')
+    args = parser.parse_args()
+
+    incremental = args.incremental
+    if incremental and not store_exists(SAVE_DIR):
+        print(f"仓库 {SAVE_DIR} 尚不存在，自动切换为全量下载。")
+        incremental = False
+
+    mode_name = "增量续传" if incremental else "全量下载"
+    thread_name = "单线程稳定版" if args.workers <= 1 else f"{args.workers} 进程分片版"
+    print(f"=== 开始使用 Baostock 下载历史前复权数据 ({thread_name} · {mode_name}) ===")
     end_date = datetime.date.today()
     start_date = end_date - datetime.timedelta(days=365 * YEARS_TO_FETCH)
-    
+
     # Baostock 的日期格式要求带横杠 YYYY-MM-DD
     start_str = start_date.strftime('%Y-%m-%d')
     end_str = end_date.strftime('%Y-%m-%d')
-    
+
     # 1. 读取股票列表
-    meta_df = pd.read_excel(INPUT_FILE, usecols=[0])
-    raw_codes = meta_df.iloc[:, 0].dropna().astype(str).str.replace(r'\.0$', '', regex=True).str.zfill(6).tolist()
-    
-    print(f"共发现 {len(raw_codes)} 只股票，准备下载 {start_str} 至 {end_str} 的数据...")
-    
-    # 2. 登录 Baostock 系统
-    lg = bs.login()
-    if lg.error_code != '0':
-        print(f"Baostock 登录失败: {lg.error_msg}")
-        exit()
-        
+    raw_codes = load_universe(INPUT_FILE)['code'].tolist()
+
+    # 增量模式按最后一个交易日判断是否已是最新 (周末、节假日、收盘前运行时不会把全部股票重查一遍)
+    ready_str = last_trading_day(end_date) if incremental else end_str
+    plan = plan_downloads(raw_codes, start_str, ready_str, incremental)
+    print(f"共发现 {len(raw_codes)} 只股票，其中 {len(plan)} 只需要下载 (最后交易日 {ready_str})...")
+
+    # 先把仓库里的已有数据读出来：增量模式在其后追加新K线；全量模式下载成功的整段替换，
+    # 重试后仍失败的股票保留旧数据 (仓库是整体重写的，不带上旧数据就等于把它们删掉了)
+    frames = load_all_history(SAVE_DIR) if store_exists(SAVE_DIR) else {}
+    if not incremental:
+        # 全量下载按股票列表重建仓库：已不在列表中的股票 (退市、调出) 不再带进新仓库
+        universe = set(raw_codes)
+        dropped = sorted(code for code in frames if code not in universe)
+        frames = {code: df for code, df in frames.items() if code in universe}
+    manifest = read_manifest(SAVE_DIR) if incremental else {}
+
+    tasks = []
+    for raw_code, fetch_start in plan.items():
+        full_start = min(manifest.get(raw_code, {}).get('start') or start_str, start_str)
+        tasks.append((raw_code, fetch_start, end_str, full_start, incremental))
+
     success_count = 0
-    
-    # 3. 稳妥的单线程循环下载（绝不报 Connection aborted）
-    for i, raw_code in enumerate(raw_codes, 1):
-        bs_code = convert_to_baostock_code(raw_code)
-        
-        # adjustflag="2" 代表前复权 (极其重要)
-        rs = bs.query_history_k_data_plus(
-            bs_code,
-            "date,open,close,high,low,volume",
-            start_date=start_str, 
-            end_date=end_str,
-            frequency="d", 
-            adjustflag="2"
-        )
-        
-        if rs.error_code == '0':
-            data_list = []
-            while (rs.error_code == '0') & rs.next():
-                data_list.append(rs.get_row_data())
-            
-            if data_list:
-                df = pd.DataFrame(data_list, columns=rs.fields)
-                
-                # 重命名列以完美适配您的回测系统
-                df.rename(columns={
-                    'date': '日期', 
-                    'open': '开盘', 
-                    'close': '收盘', 
-                    'high': '最高', 
-                    'low': '最低', 
-                    'volume': '成交量'
-                }, inplace=True)
-                
-                # 将字符串转换为数字格式，防止回测系统计算报错
-                for col in ['开盘', '收盘', '最高', '最低', '成交量']:
-                    df[col] = pd.to_numeric(df[col], errors='coerce')
-                    
-                save_path = os.path.join(SAVE_DIR, f"{raw_code}.csv")
-                df.to_csv(save_path, index=False, encoding='utf-8-sig')
+    new_rows = 0
+    updated_codes = set()
+    readjusted_codes = []
+
+    # 2. 下载 (失败的股票在后续轮次中重试)
+    for round_no in range(RETRY_ROUNDS + 1):
+        if not tasks:
+            break
+        if round_no > 0:
+            print(f"\n🔁 第 {round_no} 轮重试，共 {len(tasks)} 只失败股票...")
+            time.sleep(2)
+
+        failed = {}
+        total = len(tasks)
+        task_map = {task[0]: task for task in tasks}
+        for i, (raw_code, df, replace, note) in enumerate(run_tasks(tasks, args.workers), 1):
+            if df is None:
+                failed[raw_code] = note
+            else:
                 success_count += 1
-        else:
-            print(f"\n[{raw_code}] 下载异常: {rs.error_msg}")
-            
-        # 实时打印进度条
-        if i % 5 == 0 or i == len(raw_codes):
-            print(f"📡 下载进度: {i}/{len(raw_codes)} (已成功: {success_count})", end='\r')
-            
-    # 4. 登出系统
-    bs.logout()
-    print(f"\n\n✅ 下载彻底完成！成功保存 {success_count} 个 CSV 文件到 {SAVE_DIR} 目录。")
-    print("👉 现在您可以运行 python3 stock_backtest_pro.py 进行策略回测了！")
\ No newline at end of file
+                if note == "readjusted":
+                    readjusted_codes.append(raw_code)
+                if not df.empty:
+                    old_df = frames.get(raw_code)
+                    frames[raw_code] = df if replace or old_df is None else pd.concat([old_df, df], ignore_index=True)
+                    updated_codes.add(raw_code)
+                    new_rows += len(df)
+
+            # 实时打印进度条 (多进程结果在主进程汇总)
+            if i % 5 == 0 or i == total:
+                print(f"📡 下载进度: {i}/{total} (已成功: {success_count}, 失败: {len(failed)})", end='\r')
+
+        tasks = [task_map[code] for code in failed]
+
+    for raw_code in [task[0] for task in tasks]:
+        print(f"\n[{raw_code}] 下载异常: {failed[raw_code]}")
+    stale_codes = [task[0] for task in tasks if task[0] in frames]
+
+    # 3. 一次性写入列式仓库 (同时刷新 manifest.json 中每只股票的覆盖范围)
+    write_store(frames, SAVE_DIR, updated_codes=updated_codes)
+    print(f"\n\n✅ {mode_name}完成！成功处理 {success_count} 只股票，新增 {new_rows} 根K线，已写入列式仓库 {SAVE_DIR}。")
+    if readjusted_codes:
+        print(f"🔁 检测到 {len(readjusted_codes)} 只股票发生除权除息，已整段重新下载: {', '.join(readjusted_codes)}")
+    if tasks:
+        print(f"⚠️ 仍有 {len(tasks)} 只股票在 {RETRY_ROUNDS} 轮重试后下载失败。")
+    if stale_codes:
+        print(f"📦 其中 {len(stale_codes)} 只沿用仓库中的旧数据 (未更新): {', '.join(stale_codes)}")
+    if not incremental and dropped:
+        print(f"🗑️ 已从仓库移除 {len(dropped)} 只不在股票列表中的股票: {', '.join(dropped)}")
+    print("👉 现在您可以运行 python3 stock_backtest_pro.py 进行策略回测了！")
@@ -0,0 +1,138 @@
+import os
+import time
+import random
+import asyncio
+import threading
+import contextvars
+import pandas as pd
+
+# ==========================================
+# 异步抓取流水线：令牌桶限速 + 抖动指数退避重试 + 单请求超时 + 失败报告
+# ==========================================
+# 数据源接口 (akshare 等) 本身是同步阻塞的，这里用 asyncio.to_thread 把每次调用放进线程，
+# 由事件循环统一控制发起节奏：令牌桶决定"每秒最多发几次"，信号量决定"同时最多挂起几次"，
+# 整体耗时约等于 任务数 / 速率，不再取决于某几次请求卡住多久。
+
+# --- 配置 (默认值，调用方可覆盖) ---
+RATE_PER_SECOND = 3.0      # 令牌桶速率：平均每秒发起的请求数
+BURST = 3                  # 令牌桶容量：允许的瞬时突发请求数
+CONCURRENCY = 6            # 同时在途的请求数上限
+REQUEST_TIMEOUT = 20.0     # 单次请求超时 (秒)
+MAX_RETRIES = 4            # 失败后的最大重试次数 (不含第一次)
+BACKOFF_BASE = 1.0         # 退避基数 (秒)：第 k 次重试前等待 U(0, BACKOFF_BASE * 2^k)
+BACKOFF_MAX = 30.0         # 单次退避等待上限 (秒)
+
+# 当前流水线的 (事件循环, 令牌桶)；asyncio.to_thread 会把上下文带进工作线程，供 acquire_token 使用
+_PIPELINE = contextvars.ContextVar('fetch_pipeline', default=None)
+
+class TokenBucket:
+    """
+    令牌桶：acquire() 供事件循环内的协程使用，acquire_blocking() 供普通线程使用 (线程安全)；
+    没有令牌时等待到下一枚令牌生成。同一个桶只用其中一种方式取令牌。
+    """
+
+    def __init__(self, rate=RATE_PER_SECOND, burst=BURST):
+        self.rate = float(rate)
+        self.capacity = float(burst)
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+        self._thread_lock = threading.Lock()
+
+    def _take(self):
+        """补充令牌并尝试取走一枚，返回还需等待的秒数 (0 表示已取到)"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    async def acquire(self):
+        async with self._lock:
+            while (wait := self._take()) > 0:
+                await asyncio.sleep(wait)
+
+    def acquire_blocking(self):
+        with self._thread_lock:
+            while (wait := self._take()) > 0:
+                time.sleep(wait)
+
+# 不在流水线中调用 acquire_token 时使用的进程级令牌桶
+_DEFAULT_BUCKET = TokenBucket(RATE_PER_SECOND, BURST)
+
+async def fetch_with_retry(func, args, bucket, semaphore, timeout=REQUEST_TIMEOUT,
+                           max_retries=MAX_RETRIES, backoff_base=BACKOFF_BASE, backoff_max=BACKOFF_MAX):
+    """
+    执行一次 func(*args)，失败或超时后按"全抖动"指数退避重试。
+    返回 (结果, 错误信息, 尝试次数)；成功时错误信息为空字符串。
+    注意：超时只是放弃等待，已在线程中运行的同步调用无法被强行中断，会在后台自然结束。
+    """
+    last_error = ""
+    for attempt in range(max_retries + 1):
+        if attempt > 0:
+            await asyncio.sleep(random.uniform(0, min(backoff_max, backoff_base * (2 ** (attempt - 1)))))
+        await bucket.acquire()
+        try:
+            async with semaphore:
+                result = await asyncio.wait_for(asyncio.to_thread(func, *args), timeout)
+            return result, "", attempt + 1
+        except asyncio.TimeoutError:
+            last_error = f"超时 ({timeout}s)"
+        except Exception as e:
+            last_error = f"{type(e).__name__}: {e}"
+    return None, last_error, max_retries + 1
+
+def acquire_token():
+    """
+    为同一任务内的额外请求 (如尾部校验失败后回退整段下载) 再申请一枚令牌。
+    在流水线工作线程中取当前流水线的令牌桶；不在流水线中 (选股脚本自己的线程池等) 时取进程级的
+    默认令牌桶 (RATE_PER_SECOND / BURST)，这类回退请求同样受限速约束。
+    """
+    current = _PIPELINE.get()
+    if current is None:
+        _DEFAULT_BUCKET.acquire_blocking()
+        return
+    loop, bucket = current
+    asyncio.run_coroutine_threadsafe(bucket.acquire(), loop).result()
+
+async def _run_all(func, jobs, rate, burst, concurrency, timeout, max_retries, on_done):
+    bucket = TokenBucket(rate, burst)
+    _PIPELINE.set((asyncio.get_running_loop(), bucket))
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run_one(key, args):
+        result = await fetch_with_retry(func, args, bucket, semaphore, timeout, max_retries)
+        return key, result
+
+    results, failures = {}, []
+    pending = [run_one(key, args) for key, args in jobs.items()]
+    for done_count, coro in enumerate(asyncio.as_completed(pending), 1):
+        key, (result, error, attempts) = await coro
+        if error:
+            failures.append({'key': key, 'attempts': attempts, 'error': error})
+        else:
+            results[key] = result
+        if on_done:
+            on_done(done_count, len(pending), len(failures))
+    return results, failures
+
+def fetch_all(func, jobs, rate=RATE_PER_SECOND, burst=BURST, concurrency=CONCURRENCY,
+              timeout=REQUEST_TIMEOUT, max_retries=MAX_RETRIES, on_done=None):
+    """
+    同步入口：对 jobs = {键: 参数元组} 中每一项执行 func(*参数)。
+    返回 (results {键: 结果}, failures [{key, attempts, error}])。
+    on_done(已完成数, 总数, 失败数) 用于打印进度。
+    """
+    return asyncio.run(_run_all(func, jobs, rate, burst, concurrency, timeout, max_retries, on_done))
+
+def write_failure_report(failures, path):
+    """把重试耗尽仍失败的任务写成 CSV (没有失败时删除旧报告)"""
+    if not failures:
+        if os.path.exists(path):
+            os.remove(path)
+        return None
+    df = pd.DataFrame(failures, columns=['key', 'attempts', 'error'])
+    df.to_csv(path, index=False, encoding='utf-8-sig')
+    return path
@@ -0,0 +1,120 @@
+import numpy as np
+from compact import ITER_CHUNK_ROWS
+
+# ==========================================
+# 批量组合撮合：一次扫描长表，同时推进 K 个参数组合
+# ==========================================
+# 网格寻优时每个组合都把整张长表走一遍，可每一行 (股票×交易日) 的行情、信号对所有组合都一样，
+# 不同的只有各组合的资金与持仓。所以这里把 K 个组合的状态摆成矩阵一起推进：
+#   现金 / 交易笔数 / 盈利笔数      -> 形状 (K,)
+#   持股数 / 买入价 / 买入行 等     -> 形状 (股票数, K)，同一只股票的 K 个组合状态在内存中连续
+# 扫描到某只股票的某一行时，买卖条件对 K 个组合算成布尔掩码，一次完成全部组合的成交。
+# 没有任何组合持有、又不可能触发买入的行直接跳过 (持仓天数由行号差得出，不需要逐行累加)，
+# 期末估值用各股票最后一根K线的收盘价，并按买入先后累加，与逐组合循环的浮点结果逐位一致。
+
+# --- 配置 ---
+BATCH_COMBOS = 256          # 每批一起推进的组合数 (一次扫描服务的组合数)
+
+class BatchPortfolios:
+    """K 个相互独立的组合在同一张长表上的资金与持仓 (持仓矩阵按 股票 × 组合 排列)"""
+
+    def __init__(self, k, n_stocks, initial_capital, position_pct=0.20):
+        self.initial_capital = initial_capital
+        self.position_cap = initial_capital * position_pct
+        self.cash = np.full(k, initial_capital)
+        self.trades = np.zeros(k, dtype=np.int64)
+        self.wins = np.zeros(k, dtype=np.int64)
+        self.shares = np.zeros((n_stocks, k), dtype=np.int64)
+        self.buy_price = np.zeros((n_stocks, k))
+        self.buy_low = np.zeros((n_stocks, k))
+        self.entry_rank = np.zeros((n_stocks, k), dtype=np.int64)   # 买入K线是该股票的第几根 (算持仓天数)
+        self.entry_row = np.zeros((n_stocks, k), dtype=np.int64)    # 买入行在长表中的位置 (期末估值的累加顺序)
+        self.held_count = [0] * n_stocks                               # 每只股票被多少个组合持有
+
+    def sell(self, s, mask, price):
+        """掩码内的组合卖出股票 s，price 为标量或 (K,) 成交价"""
+        idx = np.flatnonzero(mask)
+        if not len(idx):
+            return
+        sell_price = price[idx] if isinstance(price, np.ndarray) else price
+        self.cash[idx] += self.shares[s, idx] * sell_price
+        self.trades[idx] += 1
+        self.wins[idx] += (sell_price / self.buy_price[s, idx] - 1) * 100 > 0
+        self.shares[s, idx] = 0
+        self.held_count[s] -= len(idx)
+
+    def buy(self, s, mask, price, min_lot, rank, row, low=None):
+        """掩码内的组合按 price 买入股票 s：单只最多占初始资金的 position_pct，且不超过可用现金，按最小买入单位取整"""
+        idx = np.flatnonzero(mask)
+        if not len(idx):
+            return
+        max_shares = (np.minimum(self.position_cap, self.cash[idx]) // price).astype(np.int64)
+        shares = (max_shares // min_lot) * min_lot
+        ok = shares >= min_lot
+        idx, shares = idx[ok], shares[ok]
+        if not len(idx):
+            return
+        self.cash[idx] -= shares * price
+        self.shares[s, idx] = shares
+        self.buy_price[s, idx] = price
+        self.entry_rank[s, idx] = rank
+        self.entry_row[s, idx] = row
+        if low is not None:
+            self.buy_low[s, idx] = low
+        self.held_count[s] += len(idx)
+
+    def results(self, last_close):
+        """每个组合的 (绝对盈亏, 总收益率%, 总交易笔数, 胜率%)，剩余持仓按 last_close 估值"""
+        results = []
+        for k in range(len(self.cash)):
+            held = np.flatnonzero(self.shares[:, k])
+            final_value = float(self.cash[k])
+            for s in held[np.argsort(self.entry_row[held, k])].tolist():
+                final_value += int(self.shares[s, k]) * float(last_close[s])
+            total_trades = int(self.trades[k])
+            win_rate = (int(self.wins[k]) / total_trades * 100) if total_trades > 0 else 0.0
+            results.append((final_value - self.initial_capital, (final_value / self.initial_capital - 1) * 100,
+                            total_trades, win_rate))
+        return results
+
+def stock_layout(table, code_column='code'):
+    """共享长表中每行是该股票的第几根K线，以及每只股票最后一行的位置 (结果缓存在 table 中)"""
+    if 'layout' not in table:
+        stock = np.asarray(table[code_column])
+        order = np.argsort(stock, kind='stable')
+        counts = np.bincount(stock, minlength=len(table['codes']))
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        rank = np.empty(len(stock), dtype=np.int64)
+        rank[order] = np.arange(len(stock)) - np.repeat(starts, counts)
+        last_row = np.full(len(table['codes']), -1, dtype=np.int64)
+        np.maximum.at(last_row, stock, np.arange(len(stock)))
+        table['layout'] = (rank, last_row)
+    return table['layout']
+
+def scan(table, columns, candidate, book, code_column='code', chunk_rows=ITER_CHUNK_ROWS):
+    """
+    按长表顺序给出需要处理的行：(行位置, 股票编号, 第几根K线, *columns 的 Python 标量)。
+    只给出 candidate 为真 (可能触发买入) 或当前有组合持有该股票的行；持有情况在遍历过程中实时读取。
+    """
+    rank, _ = stock_layout(table, code_column)
+    held_count = book.held_count
+    for start in range(0, len(rank), chunk_rows):
+        stop = start + chunk_rows
+        stocks = table[code_column][start:stop].tolist()
+        wanted = candidate[start:stop].tolist()
+        ranks = rank[start:stop].tolist()
+        data = [table[col][start:stop].tolist() for col in columns]
+        for i, s in enumerate(stocks):
+            if wanted[i] or held_count[s]:
+                yield (start + i, s, ranks[i], *(values[i] for values in data))
+
+def last_close(table, code_column='code'):
+    """每只股票最后一根K线的收盘价 (期末未平仓持仓的估值价)"""
+    _, last_row = stock_layout(table, code_column)
+    return np.asarray(table['close'])[last_row]
+
+def split_batches(items, processes, size=BATCH_COMBOS):
+    """把组合切成批：每批不超过 size 个，且批数不少于进程数 (让每个进程都有活干)"""
+    items = list(items)
+    size = max(1, min(size, -(-len(items) // max(processes, 1))))
+    return [items[i:i + size] for i in range(0, len(items), size)]
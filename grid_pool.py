@@ -0,0 +1,115 @@
+import os
+import time
+import shutil
+import tempfile
+from contextlib import contextmanager
+from multiprocessing import Pool
+import numpy as np
+import pandas as pd
+from compact import column_values, ITER_CHUNK_ROWS
+
+# ==========================================
+# 网格搜索进程池：参数组合分片并行，长表只读共享
+# ==========================================
+# 网格寻优时每个参数组合都要把整张长表 (几十万个 股票×交易日) 走一遍，组合之间互不依赖，天然可以并行。
+# 直接把 DataFrame 传给进程池会在每个子进程里各复制一份，5000 只股票时内存先撑不住，
+# 所以这里把撮合要用的列各写成一个 .npy 文件，子进程用 np.load(mmap_mode='r') 只读映射，
+# 物理内存里只有操作系统页缓存中的一份。股票代码列存成整数编号，代码字符串与其它按股票的常量放在 extra 里随元数据下发。
+# 参数组合用 imap_unordered 分发，主进程汇总完成数、已用时间与预计剩余时间；结果按组合原顺序返回，与串行枚举逐行一致。
+
+# --- 配置 ---
+SHARD_COMBOS = 1             # 每次派给子进程的组合数 (单个组合要跑数秒，1 即可均衡负载)
+PROGRESS_INTERVAL = 1.0      # 进度刷新的最小间隔 (秒)
+
+_TABLE = None                # 子进程内打开的共享长表
+
+def share_table(df, columns, directory, code_column='code', extra=None):
+    """
+    把长表的指定列写成 directory 下的 .npy 文件，返回可传给子进程的元数据。
+    代码列存为 int32 编号 (对应 meta['codes'])；压缩表中打包的信号列会按位解开成 bool。
+    extra: 其它随元数据下发的只读常量 (如按股票编号排列的最小买入单位)
+    """
+    codes = df[code_column]
+    if isinstance(codes.dtype, pd.CategoricalDtype):
+        stock = codes.cat.codes.to_numpy()
+        names = [str(c) for c in codes.cat.categories]
+    else:
+        stock, uniques = pd.factorize(codes)
+        names = [str(c) for c in uniques]
+    np.save(os.path.join(directory, f'{code_column}.npy'), stock.astype(np.int32))
+    for col in columns:
+        if col != code_column:
+            np.save(os.path.join(directory, f'{col}.npy'), np.ascontiguousarray(column_values(df, col)))
+    return {'dir': directory, 'columns': list(columns), 'code_column': code_column,
+            'codes': names, 'extra': dict(extra or {})}
+
+@contextmanager
+def shared_table(df, columns, code_column='code', extra=None):
+    """share_table 的上下文管理版本：写到临时目录，用完即删"""
+    directory = tempfile.mkdtemp(prefix='grid_shared_')
+    try:
+        yield share_table(df, columns, directory, code_column, extra)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+def open_table(meta):
+    """按元数据只读映射共享长表，返回 {列名: 只读数组, 'codes': 代码列表, 'extra': ...}"""
+    table = {col: np.load(os.path.join(meta['dir'], f'{col}.npy'), mmap_mode='r') for col in meta['columns']}
+    table['codes'] = meta['codes']
+    table['code_column'] = meta['code_column']
+    table['extra'] = meta['extra']
+    return table
+
+def iter_columns(table, columns, chunk_rows=ITER_CHUNK_ROWS, decode_codes=True):
+    """
+    逐行遍历共享长表，每行给出 columns 顺序的 Python 标量元组 (浮点为 float、信号为 bool)。
+    代码列默认给出股票代码字符串，decode_codes=False 时给出整数编号 (table['codes'] 的下标)；
+    按块转成列表后 zip，避免逐个读取 numpy 标量。
+    """
+    codes = table['codes']
+    for start in range(0, len(table[columns[0]]), chunk_rows):
+        stop = start + chunk_rows
+        data = []
+        for col in columns:
+            values = table[col][start:stop].tolist()
+            if col == table['code_column'] and decode_codes:
+                values = [codes[i] for i in values]
+            data.append(values)
+        yield from zip(*data)
+
+def _init_worker(meta):
+    global _TABLE
+    _TABLE = open_table(meta)
+
+def _run_task(args):
+    index, func, task = args
+    return index, func(_TABLE, task)
+
+def _report(done, total, started):
+    elapsed = time.time() - started
+    remaining = elapsed / done * (total - done) if done else 0.0
+    print(f"已完成 [{done}/{total}] {done / total * 100:.1f}%，已用 {elapsed:.1f} 秒，预计剩余 {remaining:.1f} 秒", end='\r')
+
+def run_sharded(func, tasks, meta, processes):
+    """
+    在进程池中对每个 task 执行 func(table, task)，返回与 tasks 同顺序的结果列表。
+    func 必须是模块级函数 (子进程按名字导入)；processes <= 1 时在本进程内顺序执行，结果相同。
+    """
+    jobs = [(i, func, task) for i, task in enumerate(tasks)]
+    if processes <= 1 or len(jobs) <= 1:
+        _init_worker(meta)
+        return _collect(map(_run_task, jobs), len(jobs))
+    with Pool(processes=min(processes, len(jobs)), initializer=_init_worker, initargs=(meta,)) as pool:
+        return _collect(pool.imap_unordered(_run_task, jobs, chunksize=SHARD_COMBOS), len(jobs))
+
+def _collect(finished, total):
+    """按完成顺序收集 (序号, 结果)，定时打印汇总进度，返回按序号排好的结果"""
+    results = [None] * total
+    started = time.time()
+    last_report = 0.0
+    for done, (index, result) in enumerate(finished, start=1):
+        results[index] = result
+        if done == total or time.time() - last_report >= PROGRESS_INTERVAL:
+            _report(done, total, started)
+            last_report = time.time()
+    return results
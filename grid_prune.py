@@ -0,0 +1,81 @@
+import numpy as np
+
+# ==========================================
+# 网格两阶段寻优：不计资金的逐笔粗筛 + 幸存组合精确撮合
+# ==========================================
+# 精确撮合要带着现金、仓位上限按日期顺序走一遍，每个组合都要付出整趟扫描的代价，
+# 可网格里大部分组合一眼就能看出很差。第一阶段先不管资金：每个候选买点都当作一笔独立交易，
+# 离场由 match_engine.plan_trades 向量化算出，按组合汇总 平均每笔收益 / 胜率 / 交易笔数；
+# 只有排名靠前 (top) 或不被其它组合全面压制 (pareto) 的组合才进入第二阶段的精确撮合。
+# 粗筛忽略了资金占用与同一股票持仓期间的重复买点，与精确撮合的排名并不一致：
+# top 与 pareto 两种方式都可能把精确收益最高的组合剪掉 (两个网格、不同区间上都出现过)。
+# 两阶段只是用精度换时间，report_pruning 会把被剪掉的最优组合与幸存的最优组合并列打印，需要确定最优时请用全量撮合。
+
+# --- 配置 ---
+STAT_COLUMNS = ['粗筛平均每笔收益(%)', '粗筛胜率(%)', '粗筛交易笔数']   # 两阶段模式下附在结果表后的粗筛指标
+PARETO_CHUNK = 256           # 判定支配关系时每次比较的组合数 (控制临时矩阵大小)
+
+def trade_stats(returns, groups, n_groups):
+    """
+    按组合汇总逐笔收益：returns 为每笔收益率 (%)，groups 为每笔所属组合编号。
+    返回 (n_groups, 3) 数组：[平均每笔收益%, 胜率%, 交易笔数]，无交易的组合收益与胜率为 NaN。
+    """
+    count = np.bincount(groups, minlength=n_groups).astype(np.float64)
+    total = np.bincount(groups, weights=returns, minlength=n_groups)
+    wins = np.bincount(groups, weights=(returns > 0).astype(np.float64), minlength=n_groups)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.column_stack([total / count, wins / count * 100, count])
+
+def pareto_front(scores):
+    """scores 每行一个组合、每列一个越大越好的指标，返回不被任何其它组合支配的行号 (升序)"""
+    scores = np.asarray(scores, dtype=np.float64)
+    dominated = np.zeros(len(scores), dtype=bool)
+    for start in range(0, len(scores), PARETO_CHUNK):
+        block = scores[start:start + PARETO_CHUNK]
+        # other 支配 block 中某行：每个指标都不差，且至少一个指标更好
+        no_worse = (scores[None, :, :] >= block[:, None, :]).all(axis=2)
+        better = (scores[None, :, :] > block[:, None, :]).any(axis=2)
+        dominated[start:start + len(block)] = (no_worse & better).any(axis=1)
+    return np.flatnonzero(~dominated)
+
+def select_combos(stats, mode, top_n, min_trades):
+    """
+    第一阶段的筛选，返回幸存组合的行号 (按原组合顺序)。
+    mode: 'top' 按平均每笔收益取前 top_n 个；'pareto' 取 (平均收益, 胜率) 的帕累托前沿。
+    交易笔数只用于剔除：少于 min_trades 的组合统计不可靠，先行剔除 (全部不足时不剔除)。
+    笔数本身不参与排名 —— 交易多并不更好，作为目标反而会让低收益、高换手的组合挤掉真正的最优组合。
+    """
+    if mode not in ('top', 'pareto'):
+        raise ValueError(f"未知的粗筛方式 {mode!r}，可选 'top' / 'pareto'")
+    eligible = np.flatnonzero(stats[:, 2] >= max(min_trades, 1))
+    if not len(eligible):
+        eligible = np.arange(len(stats))
+    scores = np.nan_to_num(stats[eligible], nan=-np.inf)
+    if mode == 'top':
+        keep = eligible[np.argsort(-scores[:, 0], kind='stable')[:top_n]]
+    else:
+        keep = eligible[pareto_front(scores[:, :2])]
+    return np.sort(keep)
+
+def _describe(names, combo, stat):
+    params = ', '.join(f"{name}={value}" for name, value in zip(names, combo))
+    return f"{params} (粗筛平均每笔收益 {stat[0]:.2f}%，胜率 {stat[1]:.2f}%，{int(stat[2])} 笔)"
+
+def report_pruning(combinations, stats, keep, names, elapsed):
+    """
+    打印粗筛的剪枝比例，并把被剪掉的最优组合与幸存的最优组合 (均按粗筛平均每笔收益) 并列打印。
+    粗筛排名与精确收益并不一致，被剪掉的组合里可能有精确收益更高的，这里让损失可见。
+    """
+    total, kept = len(combinations), len(keep)
+    pruned = total - kept
+    print(f"✂️ 粗筛完成，耗时 {elapsed:.2f} 秒：{total} 种组合中剪掉 {pruned} 种 ({pruned / max(total, 1) * 100:.1f}%)，"
+          f"{kept} 种进入精确撮合。")
+    mean_return = np.nan_to_num(stats[:, 0], nan=-np.inf)
+    kept_mask = np.zeros(total, dtype=bool)
+    kept_mask[keep] = True
+    for label, rows in (('幸存的最优组合', np.flatnonzero(kept_mask)), ('剪掉的最优组合', np.flatnonzero(~kept_mask))):
+        if len(rows):
+            best = rows[np.argmax(mean_return[rows])]
+            print(f"   {label}: {_describe(names, combinations[best], stats[best])}")
+    if pruned:
+        print("   ⚠️ 粗筛可能剪掉精确收益最高的组合，确定最优参数请用 PRUNE_MODE = None 全量撮合。")
@@ -0,0 +1,124 @@
+import os
+import sys
+import json
+import shutil
+import numpy as np
+from history_store import STORE_DIR, FIELD_FILES, open_store
+
+# ==========================================
+# 日期 × 股票 × 字段 对齐面板 (内存映射)
+# ==========================================
+# 列式仓库按股票首尾相接存放，适合逐只读取；面板把所有股票对齐到同一条交易日历上，
+# 得到稠密数组 data[天, 股票, 字段]，缺失位置为 NaN 并由 mask 标记，
+# 指标和回测可以直接做横截面 numpy 运算，多个进程以 mmap 共享同一份文件，无需拷贝或 pickle DataFrame。
+
+# --- 配置 ---
+PANEL_DIR = './history_panel'
+PANEL_FIELDS = list(FIELD_FILES.values())   # ['open', 'close', 'high', 'low', 'volume']
+PANEL_VERSION = 1
+
+# ==========================================
+# 1. 面板布局
+# ==========================================
+# calendar.npy : datetime64[ns]，全部股票出现过的交易日 (升序)
+# codes.npy    : 股票代码 (U6)，顺序与仓库一致
+# data.npy     : float64，形状 (天数, 股票数, 字段数)，字段顺序见 meta.json 的 fields
+# mask.npy     : bool，形状 (天数, 股票数)，True 表示该股票当天有K线
+# meta.json    : 版本号、形状、来源仓库的构建时间 (用于判断面板是否过期)
+
+def _store_built_at(store_dir):
+    with open(os.path.join(store_dir, 'meta.json'), 'r', encoding='utf-8') as f:
+        return json.load(f).get('built_at')
+
+def build_panel(store_dir=STORE_DIR, panel_dir=PANEL_DIR):
+    """由列式仓库构建对齐面板，先写临时目录再整体替换"""
+    store = open_store(store_dir)
+    codes = store['codes']
+    offsets = store['offsets']
+    dates = np.asarray(store['date'])
+
+    calendar = np.unique(dates)
+    lengths = np.diff(offsets)
+    day_idx = np.searchsorted(calendar, dates)
+    stock_idx = np.repeat(np.arange(len(codes)), lengths)
+
+    tmp_dir = panel_dir.rstrip('/') + '.tmp'
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+
+    np.save(os.path.join(tmp_dir, 'calendar.npy'), calendar)
+    np.save(os.path.join(tmp_dir, 'codes.npy'), codes)
+
+    shape = (len(calendar), len(codes), len(PANEL_FIELDS))
+    data = np.lib.format.open_memmap(os.path.join(tmp_dir, 'data.npy'), mode='w+', dtype=np.float64, shape=shape)
+    data[:] = np.nan
+    for k, name in enumerate(PANEL_FIELDS):
+        data[day_idx, stock_idx, k] = store[name]
+    data.flush()
+    del data
+
+    mask = np.zeros(shape[:2], dtype=bool)
+    mask[day_idx, stock_idx] = True
+    np.save(os.path.join(tmp_dir, 'mask.npy'), mask)
+
+    meta = {
+        'version': PANEL_VERSION,
+        'shape': list(shape),
+        'fields': PANEL_FIELDS,
+        'store_built_at': _store_built_at(store_dir),
+    }
+    with open(os.path.join(tmp_dir, 'meta.json'), 'w', encoding='utf-8') as f:
+        json.dump(meta, f, ensure_ascii=False, indent=2)
+
+    if os.path.exists(panel_dir):
+        shutil.rmtree(panel_dir)
+    os.rename(tmp_dir, panel_dir)
+    return meta
+
+def panel_is_current(store_dir=STORE_DIR, panel_dir=PANEL_DIR):
+    """面板存在且与仓库的构建时间一致"""
+    path = os.path.join(panel_dir, 'meta.json')
+    if not os.path.exists(path):
+        return False
+    with open(path, 'r', encoding='utf-8') as f:
+        meta = json.load(f)
+    return meta.get('version') == PANEL_VERSION and meta.get('store_built_at') == _store_built_at(store_dir)
+
+# ==========================================
+# 2. 读取面板
+# ==========================================
+def load_panel(panel_dir=PANEL_DIR, store_dir=STORE_DIR, rebuild=True):
+    """
+    以内存映射方式打开面板，返回字典:
+    calendar / codes / fields / data (天, 股票, 字段) / mask (天, 股票) / index {代码: 列号}
+    rebuild=True 时若面板缺失或落后于仓库则先重建。
+    """
+    if rebuild and not panel_is_current(store_dir, panel_dir):
+        build_panel(store_dir, panel_dir)
+
+    with open(os.path.join(panel_dir, 'meta.json'), 'r', encoding='utf-8') as f:
+        meta = json.load(f)
+    codes = np.load(os.path.join(panel_dir, 'codes.npy'))
+    return {
+        'meta': meta,
+        'calendar': np.load(os.path.join(panel_dir, 'calendar.npy')),
+        'codes': codes,
+        'fields': meta['fields'],
+        'index': {code: i for i, code in enumerate(codes.tolist())},
+        'data': np.load(os.path.join(panel_dir, 'data.npy'), mmap_mode='r'),
+        'mask': np.load(os.path.join(panel_dir, 'mask.npy'), mmap_mode='r'),
+    }
+
+def panel_field(panel, name):
+    """取出某个字段的 (天, 股票) 二维视图 (不拷贝)"""
+    return panel['data'][:, :, panel['fields'].index(name)]
+
+if __name__ == '__main__':
+    action = sys.argv[1] if len(sys.argv) > 1 else 'build'
+    if action == 'build':
+        meta = build_panel()
+        days, stocks, fields = meta['shape']
+        print(f"✅ 已由 {STORE_DIR} 构建对齐面板 {PANEL_DIR}: {days} 个交易日 × {stocks} 只股票 × {fields} 个字段。")
+    else:
+        print("用法: python3 history_panel.py [build]")
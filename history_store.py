@@ -0,0 +1,249 @@
+import os
+import sys
+import json
+import shutil
+import datetime
+import numpy as np
+import pandas as pd
+
+# --- 配置 ---
+CSV_DIR = './history_data'      # CSV 目录：现在只作为导入/导出格式使用
+STORE_DIR = './history_store'   # 列式二进制仓库：每个字段一个 .npy 文件，可直接内存映射
+
+# 中文列名 -> 仓库中的字段文件名 (全部为 float64)
+FIELD_FILES = {
+    '开盘': 'open',
+    '收盘': 'close',
+    '最高': 'high',
+    '最低': 'low',
+    '成交量': 'volume',
+}
+PRICE_COLUMNS = list(FIELD_FILES)
+STORE_VERSION = 1
+
+# 每个进程只打开一次仓库 (np.load 内存映射几乎零开销，多进程共享同一份页缓存)
+_STORE_CACHE = {}
+
+# ==========================================
+# 1. 仓库布局
+# ==========================================
+# codes.npy    : 股票代码 (U6)，已排序
+# offsets.npy  : int64，长度 = 股票数 + 1；第 i 只股票的数据位于 [offsets[i], offsets[i+1])
+# date.npy     : datetime64[ns]，所有股票按代码顺序首尾相接，每只股票内部按日期升序
+# open.npy ... : 与 date.npy 一一对应的 float64 字段
+# meta.json    : 版本号、行数、构建时间等元数据
+# manifest.json: 每只股票的覆盖范围 {代码: {start, end, rows, updated_at}}，增量下载据此决定从哪天续传
+
+def store_exists(store_dir=STORE_DIR):
+    """判断列式仓库是否已经构建"""
+    return os.path.exists(os.path.join(store_dir, 'meta.json'))
+
+def open_store(store_dir=STORE_DIR):
+    """以内存映射方式打开仓库，返回各字段数组组成的字典 (同一进程内缓存)"""
+    key = os.path.abspath(store_dir)
+    if key in _STORE_CACHE:
+        return _STORE_CACHE[key]
+
+    if not store_exists(store_dir):
+        raise FileNotFoundError(f"找不到历史数据仓库 {store_dir}，请先运行 python3 history_store.py import")
+
+    with open(os.path.join(store_dir, 'meta.json'), 'r', encoding='utf-8') as f:
+        meta = json.load(f)
+
+    codes = np.load(os.path.join(store_dir, 'codes.npy'))
+    store = {
+        'meta': meta,
+        'codes': codes,
+        'index': {code: i for i, code in enumerate(codes.tolist())},
+        'offsets': np.load(os.path.join(store_dir, 'offsets.npy')),
+        'date': np.load(os.path.join(store_dir, 'date.npy'), mmap_mode='r'),
+    }
+    for name in FIELD_FILES.values():
+        store[name] = np.load(os.path.join(store_dir, f'{name}.npy'), mmap_mode='r')
+
+    _STORE_CACHE[key] = store
+    return store
+
+def list_history_codes(store_dir=STORE_DIR):
+    """返回仓库中全部股票代码"""
+    return open_store(store_dir)['codes'].tolist()
+
+def load_history(stock_code, store_dir=STORE_DIR):
+    """
+    读取单只股票的日线数据，列名与原 CSV 完全一致：
+    日期, 开盘, 收盘, 最高, 最低, 成交量 (日期已是 datetime64，价格已是 float64)
+    """
+    store = open_store(store_dir)
+    i = store['index'].get(str(stock_code).zfill(6))
+    if i is None:
+        return None
+
+    start, end = store['offsets'][i], store['offsets'][i + 1]
+    # 从内存映射中拷贝出来，回测引擎会原地修改 DataFrame
+    data = {'日期': np.array(store['date'][start:end])}
+    for col, name in FIELD_FILES.items():
+        data[col] = np.array(store[name][start:end])
+    return pd.DataFrame(data)
+
+def load_all_history(store_dir=STORE_DIR):
+    """一次性读取全部股票，返回 {股票代码: DataFrame}"""
+    return {code: load_history(code, store_dir) for code in list_history_codes(store_dir)}
+
+def last_dates(store_dir=STORE_DIR):
+    """返回 {股票代码: 最后一根K线日期}，无需构造任何 DataFrame"""
+    store = open_store(store_dir)
+    offsets = store['offsets']
+    result = {}
+    for i, code in enumerate(store['codes'].tolist()):
+        if offsets[i + 1] > offsets[i]:
+            result[code] = pd.Timestamp(store['date'][offsets[i + 1] - 1])
+    return result
+
+def qfq_changed(old_df, new_df, rel_tol=1e-6, abs_tol=0.0):
+    """
+    前复权校验：比较新下载数据中与仓库重叠的那一根K线。
+    期间若发生分红送转，数据源会改写整段历史前复权价，重叠K线的价格随之变化。
+    abs_tol: 跨数据源比较时允许的绝对误差 (如两位小数舍入)。
+    """
+    last_date = pd.to_datetime(old_df['日期']).iloc[-1]
+    overlap = new_df[pd.to_datetime(new_df['日期']) == last_date]
+    if overlap.empty:
+        return True  # 重叠K线缺失，无法确认，按已变化处理
+
+    old_row = old_df.iloc[-1]
+    for col in ['开盘', '收盘', '最高', '最低']:
+        old_val = float(old_row[col])
+        new_val = float(pd.to_numeric(overlap[col].iloc[0], errors='coerce'))
+        if not abs(new_val - old_val) <= max(rel_tol * abs(old_val), abs_tol):  # NaN 也视为已变化
+            return True
+    return False
+
+# ==========================================
+# 2. 写入仓库
+# ==========================================
+def _normalize_frame(df):
+    """统一列类型并按日期升序去重"""
+    df = df[['日期'] + PRICE_COLUMNS].copy()
+    df['日期'] = pd.to_datetime(df['日期'])
+    for c in PRICE_COLUMNS:
+        df[c] = pd.to_numeric(df[c], errors='coerce').astype('float64')
+    df.sort_values('日期', inplace=True)
+    df.drop_duplicates(subset='日期', keep='last', inplace=True)
+    return df
+
+def read_manifest(store_dir=STORE_DIR):
+    """读取每只股票的覆盖范围清单，仓库不存在时返回空字典"""
+    path = os.path.join(store_dir, 'manifest.json')
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def write_store(frames, store_dir=STORE_DIR, updated_codes=None):
+    """
+    将 {股票代码: DataFrame} 整体写成列式仓库。
+    先写临时目录再整体替换，避免写到一半时其他进程读到半成品。
+    updated_codes: 本次有新数据写入的股票，清单中会刷新它们的 updated_at；
+                   为 None 时视为全部更新。
+    """
+    old_manifest = read_manifest(store_dir)
+    now_str = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    frames = {str(code).zfill(6): df for code, df in frames.items() if df is not None and not df.empty}
+    codes = sorted(frames)
+    normalized = [_normalize_frame(frames[c]) for c in codes]
+
+    lengths = np.array([len(df) for df in normalized], dtype=np.int64)
+    offsets = np.zeros(len(codes) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+
+    tmp_dir = store_dir.rstrip('/') + '.tmp'
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+
+    np.save(os.path.join(tmp_dir, 'codes.npy'), np.array(codes, dtype='U6'))
+    np.save(os.path.join(tmp_dir, 'offsets.npy'), offsets)
+
+    if normalized:
+        dates = np.concatenate([df['日期'].to_numpy(dtype='datetime64[ns]') for df in normalized])
+    else:
+        dates = np.array([], dtype='datetime64[ns]')
+    np.save(os.path.join(tmp_dir, 'date.npy'), dates)
+
+    for col, name in FIELD_FILES.items():
+        if normalized:
+            values = np.concatenate([df[col].to_numpy(dtype=np.float64) for df in normalized])
+        else:
+            values = np.array([], dtype=np.float64)
+        np.save(os.path.join(tmp_dir, f'{name}.npy'), values)
+
+    meta = {
+        'version': STORE_VERSION,
+        'stocks': len(codes),
+        'rows': int(offsets[-1]),
+        'fields': FIELD_FILES,
+        'built_at': now_str,
+    }
+    with open(os.path.join(tmp_dir, 'meta.json'), 'w', encoding='utf-8') as f:
+        json.dump(meta, f, ensure_ascii=False, indent=2)
+
+    manifest = {}
+    for code, df in zip(codes, normalized):
+        if updated_codes is None or code in updated_codes or code not in old_manifest:
+            updated_at = now_str
+        else:
+            updated_at = old_manifest[code].get('updated_at', now_str)
+        manifest[code] = {
+            'start': df['日期'].iloc[0].strftime('%Y-%m-%d') if len(df) else None,
+            'end': df['日期'].iloc[-1].strftime('%Y-%m-%d') if len(df) else None,
+            'rows': len(df),
+            'updated_at': updated_at,
+        }
+    with open(os.path.join(tmp_dir, 'manifest.json'), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=1)
+
+    if os.path.exists(store_dir):
+        shutil.rmtree(store_dir)
+    os.rename(tmp_dir, store_dir)
+
+    _STORE_CACHE.pop(os.path.abspath(store_dir), None)
+    return meta
+
+# ==========================================
+# 3. CSV 导入 / 导出
+# ==========================================
+def import_csv_dir(csv_dir=CSV_DIR, store_dir=STORE_DIR):
+    """把 history_data/ 下的 CSV 全部导入列式仓库 (唯一需要解析 CSV 的地方)"""
+    frames = {}
+    for file in sorted(os.listdir(csv_dir)):
+        if not file.endswith('.csv'):
+            continue
+        try:
+            frames[file.replace('.csv', '')] = pd.read_csv(os.path.join(csv_dir, file))
+        except Exception as e:
+            print(f"[{file}] 读取失败，已跳过: {e}")
+    return write_store(frames, store_dir)
+
+def export_csv_dir(csv_dir=CSV_DIR, store_dir=STORE_DIR, codes=None):
+    """把仓库导出为与 download_history.py 原格式一致的 UTF-8-BOM CSV"""
+    if not os.path.exists(csv_dir):
+        os.makedirs(csv_dir)
+    codes = codes or list_history_codes(store_dir)
+    for code in codes:
+        df = load_history(code, store_dir)
+        if df is None:
+            continue
+        df['日期'] = df['日期'].dt.strftime('%Y-%m-%d')
+        df.to_csv(os.path.join(csv_dir, f"{code}.csv"), index=False, encoding='utf-8-sig')
+    return len(codes)
+
+if __name__ == '__main__':
+    action = sys.argv[1] if len(sys.argv) > 1 else 'import'
+    if action == 'import':
+        meta = import_csv_dir()
+        print(f"✅ 已将 {CSV_DIR} 导入 {STORE_DIR}: {meta['stocks']} 只股票, {meta['rows']} 根K线。")
+    elif action == 'export':
+        count = export_csv_dir()
+        print(f"✅ 已将 {STORE_DIR} 导出为 {count} 个 CSV 文件到 {CSV_DIR}。")
+    else:
+        print("用法: python3 history_store.py [import|export]")
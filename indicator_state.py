@@ -0,0 +1,455 @@
+import os
+import sys
+import math
+import time
+import pickle
+import shutil
+import threading
+from collections import deque
+import numpy as np
+import pandas as pd
+
+# ==========================================
+# 逐日增量指标状态 (收盘后每只股票只推进一根K线)
+# ==========================================
+# 选股脚本每天为了输出最后一行，都要把 800~1000 根K线的 EMA / MA / HHV / SMA 从头重算一遍。
+# 这里把每只股票的指标中间状态持久化下来：EMA 累加值、滚动窗口的环形缓冲、SMA 递推值、连续信号计数。
+# update(bar) 用新的一根K线把状态推进一天，每个指标 O(1)。
+#
+# 各算子按 pandas 的增删顺序与补偿求和实现，滚动均值 / EWM / 滚动极值与批量结果逐位一致；
+# 滚动标准差只保证数值一致 (见 RollingStd)。
+#
+# 两套口径：
+#   'bao': stock_bao.py / stock_html.py —— 窗口未满为 NaN，策略2 为 EMA32 下轨、收盘价判定
+#   'tdx': stock_pytdx.py —— 全部 min_periods=1，策略1 取 3 日均值 /618，
+#          策略2 用 32 日均线下轨、最低价判定。原脚本的 XMA 向历史平移 (用到未来数据)，
+#          但在最后一根K线上等于普通 32 日均线，逐日推进时取的就是每天收盘时看到的这个值。
+
+# --- 配置 ---
+STATE_DIR = './indicator_state'
+STATE_VERSION = 2          # 状态结构或算法变化时递增，旧状态自动重建
+PROFILES = ['bao', 'tdx']
+BAR_FIELDS = ['开盘', '最高', '最低', '收盘', '成交量']
+
+def _div(a, b):
+    """与 numpy 相同的浮点除法 (除以 0 得 inf / NaN 而不是抛异常)"""
+    if b == 0:
+        if a == 0 or a != a or b != b:
+            return math.nan
+        return math.copysign(math.inf, a) * math.copysign(1.0, b)
+    return a / b
+
+# ==========================================
+# 1. 基础算子
+# ==========================================
+class RollingMean:
+    """rolling(window, min_periods).mean()：Kahan 补偿的滑动求和，增、删各用一个补偿量"""
+
+    def __init__(self, window, min_periods=None):
+        self.window = window
+        self.min_periods = window if min_periods is None else min_periods
+        self.buf = deque()
+        self.nobs = 0
+        self.neg_ct = 0
+        self.sum = 0.0
+        self.comp_add = 0.0
+        self.comp_remove = 0.0
+        self.same_ct = 0
+        self.prev = None
+
+    def update(self, x):
+        if self.prev is None:
+            self.prev = x
+        self.buf.append(x)
+        if len(self.buf) > self.window:
+            old = self.buf.popleft()
+            if old == old:
+                self.nobs -= 1
+                y = -old - self.comp_remove
+                t = self.sum + y
+                self.comp_remove = t - self.sum - y
+                self.sum = t
+                if math.copysign(1.0, old) < 0:
+                    self.neg_ct -= 1
+        if x == x:
+            self.nobs += 1
+            y = x - self.comp_add
+            t = self.sum + y
+            self.comp_add = t - self.sum - y
+            self.sum = t
+            if math.copysign(1.0, x) < 0:
+                self.neg_ct += 1
+            # 连续相同值时直接取该值，消除浮点残差
+            self.same_ct = self.same_ct + 1 if x == self.prev else 1
+            self.prev = x
+
+        if self.nobs >= self.min_periods and self.nobs > 0:
+            result = self.sum / self.nobs
+            if self.same_ct >= self.nobs:
+                return self.prev
+            if self.neg_ct == 0 and result < 0:
+                return 0.0
+            if self.neg_ct == self.nobs and result > 0:
+                return 0.0
+            return result
+        return math.nan
+
+class RollingStd:
+    """
+    rolling(window, min_periods).std()：Welford 增删 + Kahan 补偿，窗口内全部为同一值时重置为 0。
+    pandas 内部的重置时机不公开，极少数连续相同值的段落后会有 1e-8 量级的差别，比较时需带容差。
+    """
+
+    def __init__(self, window, min_periods=None):
+        self.window = window
+        self.min_periods = max(window if min_periods is None else min_periods, 1)
+        self.buf = deque()
+        self.nobs = 0
+        self.mean = 0.0
+        self.ssqdm = 0.0
+        self.comp_add = 0.0
+        self.comp_remove = 0.0
+        self.same_ct = 0
+        self.prev = None
+
+    def update(self, x):
+        if self.prev is None:
+            self.prev = x
+        self.buf.append(x)
+        if len(self.buf) > self.window:
+            old = self.buf.popleft()
+            if old == old:
+                self.nobs -= 1
+                if self.nobs:
+                    prev_mean = self.mean - self.comp_remove
+                    y = old - self.comp_remove
+                    t = y - self.mean
+                    self.comp_remove = t + self.mean - y
+                    self.mean = self.mean - t / self.nobs
+                    self.ssqdm = self.ssqdm - (old - prev_mean) * (old - self.mean)
+                else:
+                    self.mean = 0.0
+                    self.ssqdm = 0.0
+        if x == x:
+            self.nobs += 1
+            self.same_ct = self.same_ct + 1 if x == self.prev else 1
+            self.prev = x
+            prev_mean = self.mean - self.comp_add
+            y = x - self.comp_add
+            t = y - self.mean
+            self.comp_add = t + self.mean - y
+            self.mean = self.mean + t / self.nobs
+            self.ssqdm = self.ssqdm + (x - prev_mean) * (x - self.mean)
+            if self.same_ct >= self.nobs:
+                self.mean = x
+                self.ssqdm = 0.0
+
+        if self.nobs >= self.min_periods and self.nobs > 1:
+            var = 0.0 if self.same_ct >= self.nobs else self.ssqdm / (self.nobs - 1)
+            return math.sqrt(var) if var > 0 else 0.0
+        return math.nan
+
+class RollingExtreme:
+    """rolling(window, min_periods).max()/min()：单调双端队列，队首即窗口极值，均摊 O(1)"""
+
+    def __init__(self, window, kind='max', min_periods=None):
+        self.window = window
+        self.is_max = kind == 'max'
+        self.min_periods = max(window if min_periods is None else min_periods, 1)
+        self.index = -1
+        self.queue = deque()    # (序号, 值)，值单调
+        self.valid = deque()    # 窗口内非 NaN 值的序号，长度即有效个数
+
+    def update(self, x):
+        self.index += 1
+        expired = self.index - self.window
+        while self.queue and self.queue[0][0] <= expired:
+            self.queue.popleft()
+        while self.valid and self.valid[0] <= expired:
+            self.valid.popleft()
+        if x == x:
+            if self.is_max:
+                while self.queue and self.queue[-1][1] <= x:
+                    self.queue.pop()
+            else:
+                while self.queue and self.queue[-1][1] >= x:
+                    self.queue.pop()
+            self.queue.append((self.index, x))
+            self.valid.append(self.index)
+        if len(self.valid) >= self.min_periods:
+            return self.queue[0][1]
+        return math.nan
+
+class Ema:
+    """ewm(span, adjust=False).mean()：与 pandas 相同的加权递推 (NaN 期间旧权重继续衰减)"""
+
+    def __init__(self, span):
+        com = (span - 1) / 2.0
+        self.alpha = 1. / (1. + com)
+        self.decay = 1. - self.alpha
+        self.value = math.nan
+        self.old_wt = 1.
+        self.started = False
+
+    def update(self, x):
+        if not self.started:
+            self.started = True
+            self.value = x
+        elif self.value == self.value:
+            self.old_wt *= self.decay
+            if x == x:
+                if self.value != x:
+                    self.value = (self.old_wt * self.value + self.alpha * x) / (self.old_wt + self.alpha)
+                self.old_wt = 1.
+        elif x == x:
+            self.value = x
+        return self.value
+
+class Sma:
+    """
+    通达信 SMA(X, N, M)：与 indicators.sma 相同的递推。
+    前值为 NaN 时原实现用全部历史的 nanmean 重启，这里用累计和 / 个数代替 (数据中间出现 NaN 时才会用到)。
+    """
+
+    def __init__(self, n, m):
+        self.n = n
+        self.m = m
+        self.count = 0
+        self.value = math.nan
+        self.hist_sum = 0.0
+        self.hist_n = 0
+
+    def update(self, x):
+        self.count += 1
+        if x == x:
+            self.hist_sum += x
+            self.hist_n += 1
+        if self.count < self.n:
+            return math.nan
+        if self.count == self.n or self.value != self.value:
+            self.value = self.hist_sum / self.hist_n if self.hist_n else math.nan
+        else:
+            self.value = (x * self.m + self.value * (self.n - self.m)) / self.n
+        return self.value
+
+# ==========================================
+# 2. 选股脚本的全部指标状态
+# ==========================================
+class ScreenerState:
+    """一只股票的选股指标状态：update(bar) 推进一天并返回当天的输出行"""
+
+    def __init__(self, profile='bao'):
+        if profile not in PROFILES:
+            raise ValueError(f"未知的指标口径: {profile}")
+        self.version = STATE_VERSION
+        self.profile = profile
+        mp = 1 if profile == 'tdx' else None
+
+        self.ma = {n: RollingMean(n, mp) for n in [3, 5, 6, 10, 12, 20, 24, 60]}
+        self.vol_ma5 = RollingMean(5, mp)
+        self.ema12 = Ema(12)
+        self.ema26 = Ema(26)
+        self.dea = Ema(9)
+        self.volatility = RollingStd(20, mp)
+
+        self.hhv = {p: RollingExtreme(p, 'max', mp) for p in [500, 250, 90]}
+        self.llv = {p: RollingExtreme(p, 'min', mp) for p in [500, 250, 90]}
+        self.r_hhv = {p: RollingMean(21, mp) for p in [500, 250, 90]}
+        self.r_llv = {p: RollingMean(21, mp) for p in [500, 250, 90]}
+        self.ra = RollingMean(21, mp)
+        self.sma_abs = Sma(3, 1)
+        self.sma_max = Sma(3, 1)
+        self.rd = RollingMean(3, mp)
+        self.re = RollingExtreme(30, 'min', mp)
+        self.rf = RollingExtreme(30, 'max', mp)
+        self.r10 = RollingMean(58, mp)
+        if profile == 'tdx':
+            self.s1_mean = RollingMean(3, 1)
+            self.s2_line = RollingMean(32, 1)
+        else:
+            self.s1_flag = RollingExtreme(3, 'max', 1)
+            self.s2_line = Ema(32)
+
+        self.prev_close = math.nan
+        self.prev_low = math.nan
+        self.prev_ma20 = math.nan
+        self.prev_ma60 = math.nan
+        self.streaks = [0, 0, 0]
+        self.bars = 0
+        self.last_date = None
+        self.last_bar = None
+        self.last_row = None
+
+    def update(self, bar):
+        o, h, l, c, v = (float(bar[k]) for k in BAR_FIELDS)
+        ma = {n: s.update(c) for n, s in self.ma.items()}
+        vol_ma5 = self.vol_ma5.update(v)
+        dif = self.ema12.update(c) - self.ema26.update(c)
+        dea = self.dea.update(dif)
+        var1 = (c + h + o + l) / 4
+        bbi = (ma[3] + ma[6] + ma[12] + ma[24]) / 4
+        volatility = self.volatility.update(float(np.log(_div(c, self.prev_close)))) * math.sqrt(252) * 100
+
+        # --- 策略1：历史大底 ---
+        r_hhv = {p: self.r_hhv[p].update(self.hhv[p].update(h)) for p in [500, 250, 90]}
+        r_llv = {p: self.r_llv[p].update(self.llv[p].update(l)) for p in [500, 250, 90]}
+        r7 = (r_llv[500]*0.96 + r_llv[250]*0.96 + r_llv[90]*0.96 +
+              r_hhv[500]*0.558 + r_hhv[250]*0.558 + r_hhv[90]*0.558) / 6
+        r8 = (r_llv[500]*1.25 + r_llv[250]*1.23 + r_llv[90]*1.2 +
+              r_hhv[500]*0.55 + r_hhv[250]*0.55 + r_hhv[90]*0.65) / 6
+        r9 = (r_llv[500]*1.3 + r_llv[250]*1.3 + r_llv[90]*1.3 +
+              r_hhv[500]*0.68 + r_hhv[250]*0.68 + r_hhv[90]*0.68) / 6
+        ra = self.ra.update((r7*3 + r8*2 + r9) / 6 * 1.738)
+
+        diff = l - self.prev_low
+        sma_abs = self.sma_abs.update(abs(diff))
+        sma_max = self.sma_max.update(0.0 if diff < 0 else diff)
+        rc = (sma_abs / sma_max) * 100 if sma_max != 0 else 0.0
+        rd = self.rd.update(rc*10 if c*1.35 <= ra else rc/10)
+        re = self.re.update(l)
+        rf = self.rf.update(rd)
+        r10 = 0 if math.isnan(self.r10.update(c)) else 1
+        raw_signal = (rd + rf*2)/2 if l <= re else 0.0
+        if self.profile == 'tdx':
+            s1 = self.s1_mean.update(raw_signal) / 618 * r10 > 0
+        else:
+            trigger = 1 if raw_signal * r10 > 0 else 0
+            s1 = self.s1_flag.update(trigger) > 0
+
+        # --- 策略2：波段回调 ---
+        buy_line = self.s2_line.update(var1) * (1 - 4/100)
+        if self.profile == 'tdx':
+            s2 = buy_line == buy_line and l <= buy_line
+        else:
+            s2 = c < buy_line
+
+        # --- 策略3：主升浪 ---
+        ma20_angle = float(np.degrees(np.arctan((_div(ma[20], self.prev_ma20) - 1) * 100)))
+        cond_angle = ma20_angle > 25
+        cond_trend = c > ma[10] and ma[5] > ma[20] and ma[20] > ma[60] and ma[60] > self.prev_ma60
+        cond_power = _div(c, self.prev_close) > 1.03 and c > o
+        cond_vol = v > vol_ma5
+        cond_macd = dif > 0 and dif > dea
+        s3 = cond_angle and cond_trend and cond_power and cond_vol and cond_macd
+
+        # --- 连续信号计数 (xN，输出时由 indicators.render_signal 渲染) ---
+        flags = [int(bool(s1)), int(bool(s2)), int(bool(s3))]
+        for k, flag in enumerate(flags):
+            self.streaks[k] = self.streaks[k] + 1 if flag else 0
+
+        self.prev_close, self.prev_low = c, l
+        self.prev_ma20, self.prev_ma60 = ma[20], ma[60]
+        self.bars += 1
+        self.last_date = pd.Timestamp(bar['日期'])
+        self.last_bar = (o, h, l, c, v)
+        self.last_row = {
+            '日期': self.last_date,
+            '收盘': c,
+            'S1_Signal': flags[0],
+            'S1_Streak': self.streaks[0],
+            'S2_Signal': flags[1],
+            'S2_Streak': self.streaks[1],
+            'S3_Signal': flags[2],
+            'S3_Streak': self.streaks[2],
+            'MA20_Angle': ma20_angle,
+            'BBI': bbi,
+            'MA60': ma[60],
+            '波动率%': volatility,
+        }
+        return self.last_row
+
+def iter_bars(df):
+    """把日期索引的日线 DataFrame 逐行转成 update() 所需的 bar 字典"""
+    columns = [df[k].to_numpy(dtype=np.float64).tolist() for k in BAR_FIELDS]
+    for date, values in zip(df.index, zip(*columns)):
+        bar = dict(zip(BAR_FIELDS, values))
+        bar['日期'] = date
+        yield bar
+
+def warm_up(df, profile='bao'):
+    """用整段历史从头建立状态"""
+    state = ScreenerState(profile)
+    for bar in iter_bars(df):
+        state.update(bar)
+    return state
+
+# ==========================================
+# 3. 持久化
+# ==========================================
+def state_path(code, profile, state_dir=None):
+    return os.path.join(state_dir or STATE_DIR, profile, f"{code}.pkl")
+
+def load_state(code, profile, state_dir=None):
+    """读取持久化状态；不存在、损坏或版本不符时返回 None"""
+    path = state_path(code, profile, state_dir)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'rb') as f:
+            state = pickle.load(f)
+    except Exception:
+        return None
+    if getattr(state, 'version', None) != STATE_VERSION or state.profile != profile:
+        return None
+    return state
+
+def save_state(code, state, state_dir=None):
+    path = state_path(code, state.profile, state_dir)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # 选股脚本多线程并发写，临时文件名带上进程号与线程号
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+
+def _same_bar(a, b):
+    return all(x == y or (x != x and y != y) for x, y in zip(a, b))
+
+def advance(code, df, profile='bao', state_dir=None):
+    """
+    用最新日线 df (日期索引、升序) 推进该股票的持久化状态，返回最后一根K线的输出行。
+    状态中记录的最后一根K线在 df 里找不到或数值变了 (前复权因子变化、数据修正) 时，从头重建。
+    """
+    if df is None or df.empty:
+        return None
+    state = load_state(code, profile, state_dir)
+    start = 0
+    if state is not None and state.last_date is not None:
+        pos = df.index.searchsorted(state.last_date)
+        last = tuple(float(x) for x in df[BAR_FIELDS].iloc[pos]) if pos < len(df) else None
+        if last is not None and df.index[pos] == state.last_date and _same_bar(last, state.last_bar):
+            start = pos + 1
+        else:
+            state = None
+    if state is None:
+        state = ScreenerState(profile)
+
+    if start < len(df):
+        for bar in iter_bars(df.iloc[start:]):
+            state.update(bar)
+        save_state(code, state, state_dir)
+    return state.last_row
+
+def clear_states(state_dir=None):
+    state_dir = state_dir or STATE_DIR
+    if os.path.exists(state_dir):
+        shutil.rmtree(state_dir)
+
+if __name__ == '__main__':
+    # python3 indicator_state.py clear           清空全部持久化状态
+    # python3 indicator_state.py [股票代码]       演示：整段建状态 与 推进一根K线 的耗时
+    if len(sys.argv) > 1 and sys.argv[1] == 'clear':
+        clear_states()
+        print(f"✅ 已清空指标状态 {STATE_DIR}")
+        sys.exit(0)
+
+    from history_store import list_history_codes, load_history
+    code = sys.argv[1] if len(sys.argv) > 1 else list_history_codes()[0]
+    df = load_history(code).set_index('日期')
+    t0 = time.time()
+    state = warm_up(df.iloc[:-1], 'bao')
+    t1 = time.time()
+    row = state.update(next(iter_bars(df.iloc[-1:])))
+    t2 = time.time()
+    print(f"{code}: 整段 {len(df) - 1} 根K线建状态 {t1 - t0:.3f}s，推进一根K线 {(t2 - t1) * 1000:.3f}ms")
+    print(row)
@@ -0,0 +1,356 @@
+import os
+import sys
+import math
+import shutil
+import hashlib
+import threading
+import numpy as np
+import pandas as pd
+
+# ==========================================
+# 公共指标函数 (各选股脚本与回测脚本共用)
+# ==========================================
+
+# --- 配置 ---
+INDICATOR_CACHE_DIR = './indicator_cache'   # 指标结果缓存 (按内容寻址，每只股票每种规格只留最新一份，可随时整个删除)
+INDICATOR_CACHE_ENABLED = True
+INDICATOR_VERSION = 1                       # 指标算法变化时递增，旧缓存自动失效
+
+def sma_panel(values, n, m):
+    """
+    通达信 SMA(X, N, M) 的面板版本：values 为 (天, 股票) 二维数组，每一列独立计算，返回同形状数组。
+    递推 Y = (X*M + Y'*(N-M)) / N 沿时间方向逐日进行，但每一步都是对所有股票的向量运算。
+
+    与原逐元素循环逐位一致：
+      - 前 N-1 天为 NaN，第 N 天取前 N 个值的 nanmean 作为启动值；
+      - 前值为 NaN 时用截至当天的全部历史 nanmean 重新启动 (只对这些列单独计算，保证求和顺序相同)。
+    """
+    x = np.asarray(values, dtype=np.float64)
+    squeeze = x.ndim == 1
+    if squeeze:
+        x = x.reshape(-1, 1)
+    days, stocks = x.shape
+    out = np.full((days, stocks), np.nan)
+    if days < n:
+        return out[:, 0] if squeeze else out
+
+    # 按股票连续存放的副本：nanmean 对一维连续切片求和，与原实现的求和顺序完全相同
+    xt = np.ascontiguousarray(x.T)
+    val = np.array([np.nanmean(xt[j, :n]) for j in range(stocks)])
+    out[n - 1] = val
+    for i in range(n, days):
+        restart = np.isnan(val)
+        val = (x[i] * m + val * (n - m)) / n
+        if restart.any():
+            for j in np.flatnonzero(restart):
+                val[j] = np.nanmean(xt[j, :i + 1])
+        out[i] = val
+    return out[:, 0] if squeeze else out
+
+def sma(series, n, m):
+    """
+    策略1核心：通达信SMA递归算法 (单只股票)
+    单列时逐日向量运算反而有额外开销，这里用 Python 浮点标量递推，运算顺序与 sma_panel 相同、结果逐位一致。
+    """
+    series_array = np.asarray(series.values, dtype=np.float64)
+    xs = series_array.tolist()
+    sma_values = [np.nan] * len(xs)
+    if len(xs) >= n:
+        val = float(np.nanmean(series_array[:n]))
+        sma_values[n - 1] = val
+        for i in range(n, len(xs)):
+            if math.isnan(val):
+                val = float(np.nanmean(series_array[:i + 1]))
+            else:
+                val = (xs[i] * m + val * (n - m)) / n
+            sma_values[i] = val
+    return pd.Series(sma_values, index=series.index)
+
+def rolling_extrema(values, windows, kind='max', min_periods=None):
+    """
+    通达信 HHV / LLV 的多窗口版本：values 为一维序列或 (天, 股票) 二维数组，
+    一次调用返回 {窗口: 同形状数组}，与 pandas rolling(w, min_periods).max()/min() 逐位一致。
+
+    每个窗口用 van Herk/Gil-Werman 分块算法：按窗口长度切块，块内前缀极值 + 块内后缀极值，
+    任意窗口的极值 = 后缀[i] 与 前缀[i+w-1] 中的较大(小)者，每个元素只比较常数次，与窗口长度无关。
+    NaN 按 pandas 语义跳过，窗口内有效值个数不足 min_periods (默认等于窗口) 时为 NaN；
+    NaN 填充与有效值计数在多个窗口间共用，只算一次。
+    """
+    x = np.asarray(values, dtype=np.float64)
+    squeeze = x.ndim == 1
+    if squeeze:
+        x = x.reshape(-1, 1)
+    days, stocks = x.shape
+    accumulate, pick, fill = (np.maximum.accumulate, np.maximum, -np.inf) if kind == 'max' else (np.minimum.accumulate, np.minimum, np.inf)
+
+    is_value = ~np.isnan(x)
+    filled = np.where(is_value, x, fill)
+    counts = np.vstack([np.zeros((1, stocks), dtype=np.int64), np.cumsum(is_value, axis=0)])
+
+    result = {}
+    for w in windows:
+        # 前面补 w-1 个填充值，使前 w-1 天的不完整窗口也落在统一公式里；再补齐到 w 的整数倍
+        blocks = -(-(days + w - 1) // w)
+        padded = np.full((blocks * w, stocks), fill)
+        padded[w - 1:w - 1 + days] = filled
+        shaped = padded.reshape(blocks, w, stocks)
+        prefix = accumulate(shaped, axis=1).reshape(-1, stocks)
+        suffix = accumulate(shaped[:, ::-1], axis=1)[:, ::-1].reshape(-1, stocks)
+        out = pick(suffix[:days], prefix[w - 1:w - 1 + days])
+
+        start = np.maximum(np.arange(days) - w + 1, 0)
+        in_window = counts[1:] - counts[start]
+        need = w if min_periods is None else min_periods
+        out[(in_window < max(need, 1))] = np.nan
+        result[w] = out[:, 0] if squeeze else out
+    return result
+
+# ==========================================
+# 信号编码：int8 标记 + int16 连续天数，只在输出时渲染成 "Y x3" / "🔥 x2"
+# ==========================================
+def signal_flag(condition):
+    """布尔条件 (NaN 比较结果为 False) -> int8 标记"""
+    return np.asarray(condition, dtype=bool).astype(np.int8)
+
+def signal_streak(flag):
+    """
+    连续触发天数：标记为 1 的位置 = 截至当天的连续天数，否则为 0。
+    "遇 0 归零的累加"：累计和减去最近一次未触发时的累计和，二维输入沿时间轴 (axis=0) 逐列计算。
+    """
+    f = np.asarray(flag, dtype=bool)
+    total = np.cumsum(f, axis=0, dtype=np.int32)
+    reset = np.maximum.accumulate(np.where(f, 0, total), axis=0)
+    return (total - reset).astype(np.int16)
+
+def render_signal(streak, marker):
+    """连续天数 -> 展示字符串：0 为空，1 为标记本身，N>1 为 "标记 xN" """
+    n = int(streak)
+    return '' if n <= 0 else marker if n == 1 else f"{marker} x{n}"
+
+# ==========================================
+# 均线 / EMA / MACD / VAR1 指标库 + 按内容寻址的磁盘缓存
+# ==========================================
+# 指标规格是一个有序字典 {输出列名: 规格元组}，后面的规格可以引用前面算出的列：
+#   ('MA', 列, 窗口, min_periods)   -> 列.rolling(窗口, min_periods).mean()   (min_periods=None 即等于窗口)
+#   ('EMA', 列, span)               -> 列.ewm(span=span, adjust=False).mean()  (通达信 EMA)
+#   ('SUB', 列A, 列B)               -> 列A - 列B
+#   ('VAR1',)                       -> (收盘 + 最高 + 开盘 + 最低) / 4
+# 计算方式与各脚本原来的写法完全相同，结果逐位一致。
+
+def main_wave_specs(min_periods=None):
+    """主升浪策略所需：MA5/10/20/60、5 日均量、EMA12/26、DIF/DEA"""
+    return {
+        'MA5': ('MA', '收盘', 5, min_periods),
+        'MA10': ('MA', '收盘', 10, min_periods),
+        'MA20': ('MA', '收盘', 20, min_periods),
+        'MA60': ('MA', '收盘', 60, min_periods),
+        'VOL_MA5': ('MA', '成交量', 5, min_periods),
+        'EMA12': ('EMA', '收盘', 12),
+        'EMA26': ('EMA', '收盘', 26),
+        'DIF': ('SUB', 'EMA12', 'EMA26'),
+        'DEA': ('EMA', 'DIF', 9),
+    }
+
+def channel_specs(min_periods=1):
+    """左侧伏击策略所需：VAR1 与 32 日 EMA 中轨 MID、MA20、DIF/DEA"""
+    return {
+        'VAR1': ('VAR1',),
+        'MID': ('EMA', 'VAR1', 32),
+        'MA20': ('MA', '收盘', 20, min_periods),
+        'EMA12': ('EMA', '收盘', 12),
+        'EMA26': ('EMA', '收盘', 26),
+        'DIF': ('SUB', 'EMA12', 'EMA26'),
+        'DEA': ('EMA', 'DIF', 9),
+    }
+
+def _input_columns(specs):
+    """规格中引用到的原始行情列 (不含规格自身产出的列)"""
+    columns = []
+    for name, spec in specs.items():
+        refs = ['收盘', '最高', '开盘', '最低'] if spec[0] == 'VAR1' else [spec[1]] + ([spec[2]] if spec[0] == 'SUB' else [])
+        for ref in refs:
+            if ref not in specs and ref not in columns:
+                columns.append(ref)
+    return columns
+
+def compute_indicators(df, specs):
+    """按规格依次计算，返回 {列名: float64 数组}"""
+    series = {c: pd.Series(df[c].to_numpy(dtype=np.float64)) for c in _input_columns(specs)}
+    for name, spec in specs.items():
+        kind = spec[0]
+        if kind == 'MA':
+            _, col, window, min_periods = spec
+            series[name] = series[col].rolling(window, min_periods=min_periods).mean()
+        elif kind == 'EMA':
+            _, col, span = spec
+            series[name] = series[col].ewm(span=span, adjust=False).mean()
+        elif kind == 'SUB':
+            series[name] = series[spec[1]] - series[spec[2]]
+        elif kind == 'VAR1':
+            series[name] = (series['收盘'] + series['最高'] + series['开盘'] + series['最低']) / 4
+        else:
+            raise ValueError(f"未知的指标类型: {kind}")
+    return {name: series[name].to_numpy() for name in specs}
+
+def indicator_cache_key(code, specs, df):
+    """
+    缓存键分两段：(股票代码 + 指标规格 的哈希, 输入数据内容的哈希)，任何一项变化都会得到新键。
+    第一段决定"同一份缓存槽"：选股脚本的窗口每天滑动，数据哈希天天不同，按槽只保留最新一份才不会无限堆积。
+    """
+    slot = hashlib.blake2b(f"v{INDICATOR_VERSION}|{code}|{sorted(specs.items())!r}".encode('utf-8'), digest_size=10)
+    h = hashlib.blake2b(f"{len(df)}".encode('utf-8'), digest_size=20)
+    for c in _input_columns(specs):
+        h.update(np.ascontiguousarray(df[c].to_numpy(dtype=np.float64)).tobytes())
+    return slot.hexdigest(), h.hexdigest()
+
+def _evict_older(directory, slot, keep_name):
+    """删除同一缓存槽 (同股票同规格) 下除 keep_name 外的旧结果；其它线程的临时文件不动"""
+    for name in os.listdir(directory):
+        if name.startswith(f"{slot}-") and name != keep_name and not name.endswith('.tmp.npy'):
+            try:
+                os.remove(os.path.join(directory, name))
+            except OSError:
+                pass  # 其它线程已删除
+
+def cached_indicators(df, specs, code=None, cache_dir=None):
+    """
+    与 compute_indicators 相同，但先按内容哈希查磁盘缓存：数据与规格都没变的股票只需读一个 .npy。
+    每个 (股票, 规格) 只保留最近一次写入的结果，旧数据对应的文件在写入新结果时删除。
+    缓存写入采用 临时文件 + os.replace，多进程 / 多线程同时写同一只股票也不会读到半成品。
+    """
+    if not INDICATOR_CACHE_ENABLED:
+        return compute_indicators(df, specs)
+
+    cache_dir = cache_dir or INDICATOR_CACHE_DIR
+    slot, data_key = indicator_cache_key(code, specs, df)
+    directory = os.path.join(cache_dir, slot[:2])
+    path = os.path.join(directory, f"{slot}-{data_key}.npy")
+    names = list(specs)
+
+    if os.path.exists(path):
+        try:
+            values = np.load(path)
+            if values.shape == (len(names), len(df)):
+                return dict(zip(names, values))
+        except (OSError, ValueError):
+            pass  # 缓存损坏时重新计算并覆盖
+
+    result = compute_indicators(df, specs)
+    os.makedirs(directory, exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp.npy"
+    np.save(tmp_path, np.vstack([result[name] for name in names]) if names else np.empty((0, len(df))))
+    os.replace(tmp_path, path)
+    _evict_older(directory, slot, os.path.basename(path))
+    return result
+
+def clear_indicator_cache(cache_dir=None):
+    cache_dir = cache_dir or INDICATOR_CACHE_DIR
+    if os.path.exists(cache_dir):
+        shutil.rmtree(cache_dir)
+
+# ==========================================
+# 一致性自检：python3 indicators.py
+# ==========================================
+def _sma_reference(series, n, m):
+    """原各脚本中的逐元素循环实现，仅用于自检"""
+    sma_values = []
+    series_array = series.values
+    val = np.nan
+    for i, x in enumerate(series_array):
+        if i < n - 1:
+            sma_values.append(np.nan)
+        elif i == n - 1:
+            val = np.nanmean(series_array[:n])
+            sma_values.append(val)
+        else:
+            if np.isnan(val):
+                val = np.nanmean(series_array[:i+1])
+            else:
+                val = (x * m + val * (n - m)) / n
+            sma_values.append(val)
+    return pd.Series(sma_values, index=series.index)
+
+def _same_bits(a, b):
+    a = np.asarray(a, dtype=np.float64)
+    b = np.asarray(b, dtype=np.float64)
+    return a.shape == b.shape and np.array_equal(a.view(np.int64), b.view(np.int64))
+
+def self_check(trials=300, seed=0):
+    """随机序列 (含开头/中间 NaN、全 NaN、长度不足 N) 上比较新旧实现的二进制结果"""
+    import warnings
+    rng = np.random.default_rng(seed)
+    columns = []
+    for _ in range(trials):
+        length = int(rng.integers(0, 400))
+        data = rng.normal(0, 1, length) * rng.choice([1e-3, 1.0, 1e3])
+        if length:
+            data[rng.random(length) < rng.choice([0.0, 0.02, 0.3])] = np.nan
+            if rng.random() < 0.3:
+                data[:int(rng.integers(0, length + 1))] = np.nan
+        columns.append(data)
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)  # 全 NaN 切片的 nanmean 警告
+        for n, m in [(3, 1), (5, 2), (12, 1), (20, 3)]:
+            for data in columns:
+                series = pd.Series(data)
+                expected = _sma_reference(series, n, m).to_numpy()
+                assert _same_bits(sma(series, n, m).to_numpy(), expected), (n, m, len(data))
+                assert _same_bits(sma_panel(data, n, m), expected), (n, m, len(data))
+
+            # 面板：同长度的列拼在一起，逐列与参考实现比较
+            length = 300
+            panel = np.column_stack([np.resize(c, length) if len(c) else np.full(length, np.nan) for c in columns])
+            result = sma_panel(panel, n, m)
+            for j in range(panel.shape[1]):
+                assert _same_bits(result[:, j], _sma_reference(pd.Series(panel[:, j]), n, m).to_numpy()), (n, m, j)
+
+    # rolling_extrema 与 pandas rolling max/min 比较 (含 min_periods 与窗口长于序列)
+    panel = np.column_stack([np.resize(c, 300) if len(c) else np.full(300, np.nan) for c in columns])
+    for kind in ['max', 'min']:
+        for min_periods in [None, 1, 7]:
+            windows = [w for w in [1, 3, 30, 90, 250, 500] if min_periods is None or w >= min_periods]
+            result = rolling_extrema(panel, windows, kind, min_periods)
+            for w in windows:
+                roll = pd.DataFrame(panel).rolling(w, min_periods=min_periods)
+                expected = (roll.max() if kind == 'max' else roll.min()).to_numpy()
+                assert _same_bits(result[w], expected), (kind, min_periods, w)
+            for data in columns[:50]:
+                single = rolling_extrema(data, [90], kind, min_periods)[90]
+                roll = pd.Series(data).rolling(90, min_periods=min_periods)
+                assert _same_bits(single, (roll.max() if kind == 'max' else roll.min()).to_numpy()), (kind, min_periods, len(data))
+    return True
+
+if __name__ == '__main__':
+    import time
+    if len(sys.argv) > 1 and sys.argv[1] == 'clear':
+        clear_indicator_cache()
+        print(f"✅ 已清空指标缓存 {INDICATOR_CACHE_DIR}")
+        sys.exit(0)
+
+    self_check()
+    print("✅ sma / sma_panel 与原逐元素循环逐位一致。")
+
+    rng = np.random.default_rng(1)
+    panel = np.abs(rng.normal(0, 1, (800, 570)))
+    panel[0] = np.nan
+    t0 = time.time()
+    for j in range(panel.shape[1]):
+        _sma_reference(pd.Series(panel[:, j]), 3, 1)
+    t1 = time.time()
+    for j in range(panel.shape[1]):
+        sma(pd.Series(panel[:, j]), 3, 1)
+    t2 = time.time()
+    sma_panel(panel, 3, 1)
+    t3 = time.time()
+    print(f"800 天 × 570 只: 原循环 {t1 - t0:.2f}s, 单列 sma {t2 - t1:.2f}s, 面板 sma_panel {t3 - t2:.3f}s")
+
+    t0 = time.time()
+    for j in range(panel.shape[1]):
+        column = pd.Series(panel[:, j])
+        for w in [500, 250, 90]:
+            column.rolling(w).max()
+    t1 = time.time()
+    rolling_extrema(panel, [500, 250, 90], 'max')
+    t2 = time.time()
+    print(f"800 天 × 570 只 HHV500/250/90: 逐列 rolling {t1 - t0:.2f}s, 面板 rolling_extrema {t2 - t1:.3f}s")
@@ -6,13 +6,41 @@ from multiprocessing import Pool, cpu_count
 import time
 import itertools
 import warnings
+from history_store import STORE_DIR, store_exists, list_history_codes, load_history
+from universe import limit_pct, lot_array
+from indicators import cached_indicators, channel_specs
+from panel_engine import load_bars, channel_signals, long_table
+from compact import compact_table, report_compaction
+from grid_pool import shared_table, iter_columns, run_sharded
+from grid_batch import BatchPortfolios, scan, last_close, split_batches
+from grid_prune import STAT_COLUMNS, trade_stats, select_combos, report_pruning
+from match_engine import build_book, plan_trades
+from left_side_backtest_single import left_side_exit
 warnings.filterwarnings('ignore')
 
 # --- 配置区域 ---
-HISTORY_DATA_DIR = "./history_data"
+HISTORY_STORE_DIR = STORE_DIR
 OUTPUT_DIR = "./"
 INITIAL_CAPITAL = 1_000_000.0
 NUM_CORES = max(1, cpu_count() - 1)
+CHANNEL_SPECS = channel_specs(min_periods=1)
+USE_PANEL_ENGINE = True   # True: 面板引擎一次性计算全部股票；False: 退回逐只 DataFrame 多进程预处理
+USE_BATCH_SIMULATOR = True  # True: 每批组合共用一次长表扫描、按掩码同时推进 (见 grid_batch.py)；False: 每个组合单独扫描一遍
+PRUNE_MODE = None          # 两阶段寻优：None 全量精确撮合；'top' 粗筛后取平均每笔收益前 PRUNE_TOP_N 名；'pareto' 取 (平均收益, 胜率) 的帕累托前沿；两种方式都可能剪掉最优组合 (见 grid_prune.py)
+PRUNE_TOP_N = 50
+PRUNE_MIN_TRADES = 30      # 粗筛交易笔数少于此数的组合视为样本不足，直接剪掉
+USE_COMPACT_DTYPES = False  # True: 撮合前把长表压成 float32 价格 / 分类股票代码 / 位打包信号 (见 compact.py)，数值误差在 float32 舍入以内
+# 预处理输出列 -> 枚举时使用的英文列名
+SIGNAL_COLUMNS = {'日期': 'date', '股票代码': 'code', '开盘': 'open', '收盘': 'close', '最高': 'high', '最低': 'low',
+                  'MID': 'mid', 'BIAS_VAL': 'bias_val', 'B_COND2': 'b_cond2', 'S_COND2': 's_cond2', 'vol_shrink': 'vol_shrink',
+                  'up_trend': 'up_trend', 'is_limit_up': 'is_limit_up', 'is_limit_down': 'is_limit_down'}
+# 粗筛用的撮合引擎字段 -> 长表列名
+SCREEN_COLUMNS = {'close': 'close', 'high': 'high', 'low': 'low', 'mid': 'mid', 'bias_val': 'bias_val',
+                  'b_cond2': 'b_cond2', 's_cond2': 's_cond2', 'vol_shrink': 'vol_shrink', 'up_trend': 'up_trend',
+                  'limit_up': 'is_limit_up', 'limit_down': 'is_limit_down'}
+# 枚举撮合逐行读取的列 (顺序即 simulate_combo 中的解包顺序)
+GRID_COLUMNS = ['code', 'close', 'high', 'low', 'mid', 'bias_val', 'b_cond2', 's_cond2', 'vol_shrink', 'up_trend',
+                'is_limit_up', 'is_limit_down']
 
 def parse_input_list(prompt, type_func):
     """解析用户输入的逗号分隔的参数列表"""
@@ -42,27 +70,22 @@ def get_user_inputs():
 
 def process_single_stock_file(args):
     """单只股票数据预处理（计算无需动态变化的指标）"""
-    file, start_date, end_date = args
-    filepath = os.path.join(HISTORY_DATA_DIR, file)
+    stock_code, start_date, end_date = args
     try:
-        df = pd.read_csv(filepath)
-        df['日期'] = pd.to_datetime(df['日期'])
-        df.sort_values('日期', inplace=True)
+        # 仓库中的数据已是按日期升序的 datetime64 / float64，无需再解析
+        df = load_history(stock_code, HISTORY_STORE_DIR)
 
-        if len(df) < 60: return None
+        if df is None or len(df) < 60: return None
 
-        for c in ['开盘', '收盘', '最高', '最低', '成交量']:
-            df[c] = pd.to_numeric(df[c], errors='coerce')
-        
         # 处理异常值
         df.dropna(subset=['开盘', '收盘', '最高', '最低', '成交量'], inplace=True)
 
-        # 1. 核心轨道基础 VAR1 & MID
-        df['VAR1'] = (df['收盘'] + df['最高'] + df['开盘'] + df['最低']) / 4
-        df['MID'] = df['VAR1'].ewm(span=32, adjust=False).mean()
+        # 1. 核心轨道基础 VAR1 & MID (以及下面用到的 MA20、DIF/DEA)
+        # VAR1 / MID / MA20 / MACD 走公共指标库 (按内容哈希缓存，数据未变的股票直接读缓存)
+        for name, values in cached_indicators(df, CHANNEL_SPECS, stock_code).items():
+            df[name] = values
         
         # 2. 乖离率基础 MA20 & BIAS
-        df['MA20'] = df['收盘'].rolling(20, min_periods=1).mean()
         df['BIAS_VAL'] = (df['收盘'] - df['MA20']) / df['MA20'] * 100
         
         # 3. 买入形态 (收阳且下影线长于上影线)
@@ -75,13 +98,10 @@ def process_single_stock_file(args):
         df['vol_shrink'] = df['成交量'] < df['成交量'].shift(1)
         
         # 5. MACD趋势滤网
-        df['DIF'] = df['收盘'].ewm(span=12, adjust=False).mean() - df['收盘'].ewm(span=26, adjust=False).mean()
-        df['DEA'] = df['DIF'].ewm(span=9, adjust=False).mean()
         df['up_trend'] = (df['DIF'] > 0) & (df['DEA'] > 0) & (df['DIF'] > df['DEA'])
 
         # 涨跌停判定
-        stock_code = file.replace('.csv', '')
-        limit_threshold = 19.8 if stock_code.startswith('688') or stock_code.startswith('30') else 9.8
+        limit_threshold = limit_pct(stock_code)
         df['pct_change'] = (df['收盘'] / df['收盘'].shift(1) - 1) * 100
         df['is_limit_up'] = df['pct_change'] >= limit_threshold
         df['is_limit_down'] = df['pct_change'] <= -limit_threshold
@@ -94,138 +114,224 @@ def process_single_stock_file(args):
         df['股票代码'] = stock_code
         
         # 提取极速迭代所需列
-        df = df[['日期', '股票代码', '开盘', '收盘', '最高', '最低', 
-                 'MID', 'BIAS_VAL', 'B_COND2', 'S_COND2', 'vol_shrink', 'up_trend', 
-                 'is_limit_up', 'is_limit_down']]
-        df.columns = ['date', 'code', 'open', 'close', 'high', 'low', 
-                      'mid', 'bias_val', 'b_cond2', 's_cond2', 'vol_shrink', 'up_trend', 
-                      'is_limit_up', 'is_limit_down']
+        df = df[list(SIGNAL_COLUMNS)]
+        df.columns = list(SIGNAL_COLUMNS.values())
         return df.copy()
 
     except Exception:
         return None
 
+def simulate_combo(table, combo):
+    """单个参数组合的全量撮合 (在进程池子进程中运行)，返回 (绝对盈亏, 总收益率%, 总交易笔数, 胜率%)"""
+    p1, p2, bias_thresh = combo
+    lots = table['extra']['lots']
+    
+    cash = INITIAL_CAPITAL
+    holdings = {}
+    total_trades = 0
+    winning_trades = 0
+    last_close_prices = {} 
+    
+    # 极速遍历算法
+    for (stock, close_price, high_price, low_price, mid, bias_val, b_cond2, s_cond2, vol_shrink, up_trend,
+         is_limit_up, is_limit_down) in iter_columns(table, GRID_COLUMNS, decode_codes=False):
+        
+        last_close_prices[stock] = close_price
+        
+        # --- 卖出逻辑 ---
+        if stock in holdings:
+            info = holdings[stock]
+            info['days_held'] += 1
+            
+            # 动态计算上轨卖出线
+            upper_line = mid * (1 + p1 / 100.0)
+            
+            # 卖出条件判断
+            s_cond1 = high_price >= upper_line
+            regular_sell = s_cond1 and s_cond2 and vol_shrink
+            sell_signal = regular_sell and (not up_trend) # MACD滤网防止卖飞
+            
+            # 破位止损判断 (绑定买入动作，15日内跌破买入当日最低价)
+            stop_loss = (info['days_held'] <= 15) and (close_price < info['buy_day_low'])
+            
+            if sell_signal or stop_loss:
+                if is_limit_down:
+                    continue # 跌停封死无法卖出
+                    
+                sell_price = close_price # 回测简化：统一按收盘价撮合
+                proceeds = info['shares'] * sell_price
+                cash += proceeds
+                
+                pnl_percent = (sell_price / info['buy_price'] - 1) * 100
+                total_trades += 1
+                if pnl_percent > 0: winning_trades += 1
+                    
+                del holdings[stock]
+        
+        # --- 买入逻辑 ---
+        if stock not in holdings:
+            # 动态计算下轨买入线
+            lower_line = mid * (1 - p2 / 100.0)
+            
+            # 买入条件判断
+            bias_ok = bias_val < -bias_thresh
+            b_cond1 = (low_price <= lower_line) and bias_ok
+            buy_signal = b_cond1 and b_cond2
+            
+            if buy_signal:
+                if is_limit_up:
+                    continue # 涨停封死无法买入
+                min_lot = lots[stock]
+                
+                # 仓位控制：单只股票最多占用总资金的 20%
+                max_shares = int(min(INITIAL_CAPITAL * 0.20, cash) // close_price)
+                shares_to_buy = (max_shares // min_lot) * min_lot
+                
+                if shares_to_buy >= min_lot:
+                    cash -= shares_to_buy * close_price
+                    holdings[stock] = {
+                        'shares': shares_to_buy,
+                        'buy_price': close_price,
+                        'days_held': 0,
+                        'buy_day_low': low_price # 极其关键：记录抄底防守线
+                    }
+                    
+    # 计算期末净值
+    final_value = cash
+    for stock, info in holdings.items():
+        final_value += info['shares'] * last_close_prices.get(stock, info['buy_price'])
+        
+    total_pnl = final_value - INITIAL_CAPITAL
+    return_pct = (final_value / INITIAL_CAPITAL - 1) * 100
+    win_rate = (winning_trades / total_trades * 100) if total_trades > 0 else 0.0
+    return total_pnl, return_pct, total_trades, win_rate
+
+def simulate_batch(table, combos):
+    """一批参数组合共用一次长表扫描 (见 grid_batch.py)，返回与 combos 同顺序、与 simulate_combo 逐位相同的结果"""
+    p1, p2, bias_thresh = (np.array(values) for values in zip(*combos))
+    upper_factor = 1 + p1 / 100.0
+    lower_factor = 1 - p2 / 100.0
+    lots = table['extra']['lots']
+    book = BatchPortfolios(len(combos), len(table['codes']), INITIAL_CAPITAL)
+    no_sell = np.zeros(len(combos), dtype=bool)
+    
+    # 本批任一下轨、任一乖离要求都满足不了的行，对所有组合都不会买入
+    mid, low, bias_val = (np.asarray(table[col]) for col in ('mid', 'low', 'bias_val'))
+    touch = np.zeros(len(mid), dtype=bool)
+    for factor in np.unique(lower_factor):
+        touch |= low <= mid * factor
+    candidate = table['b_cond2'] & ~table['is_limit_up'] & touch & (bias_val < -bias_thresh.min())
+    columns = ['close', 'high', 'low', 'mid', 'bias_val', 'b_cond2', 's_cond2', 'vol_shrink', 'up_trend',
+               'is_limit_up', 'is_limit_down']
+    for (row, s, rank, close_price, high_price, low_price, mid, bias_val, b_cond2, s_cond2, vol_shrink, up_trend,
+         is_limit_up, is_limit_down) in scan(table, columns, candidate, book):
+        # --- 卖出逻辑：触及各自上轨的缩量阴线 (MACD 多头时不卖)，或 15 日内跌破买入当日最低价，跌停卖不出 ---
+        if book.held_count[s]:
+            sell_signal = no_sell
+            if s_cond2 and vol_shrink and not up_trend:
+                sell_signal = high_price >= mid * upper_factor
+            stop_loss = (rank - book.entry_rank[s] <= 15) & (close_price < book.buy_low[s])
+            want = (book.shares[s] > 0) & (sell_signal | stop_loss)
+            if not is_limit_down:
+                book.sell(s, want, close_price)
+        
+        # --- 买入逻辑：触及各自下轨且负乖离达标的收阳K线，涨停买不进 ---
+        if b_cond2 and not is_limit_up:
+            want = (book.shares[s] == 0) & (low_price <= mid * lower_factor) & (bias_val < -bias_thresh)
+            book.buy(s, want, close_price, lots[s], rank, row, low=low_price)
+    return book.results(last_close(table))
+
+def screen_combos(master_history, combinations):
+    """
+    两阶段寻优的第一阶段：不计资金，每个候选买点都按收盘价买入一笔，返回每个组合的
+    [平均每笔收益%, 胜率%, 交易笔数] (见 grid_prune.py)。离场只与上轨 P1 有关，
+    同一个 P1 只生成一次候选交易表，各 (P2, 负乖离) 组合从中按买入当日的下轨与乖离筛选。
+    """
+    book = build_book(master_history, SCREEN_COLUMNS, code_column='code', date_column='date')
+    close, low, mid, bias_val = book['close'], book['low'], book['mid'], book['bias_val']
+    stock_last_close = np.array([close[rows[-1]] for rows in book['stock_rows']])
+    regular_sell = book['s_cond2'] & book['vol_shrink'] & ~book['up_trend']
+    touch = np.zeros(len(close), dtype=bool)
+    for p2 in {combo[1] for combo in combinations}:
+        touch |= low <= mid * (1 - p2 / 100.0)
+    book['buy'] = book['b_cond2'] & touch & (bias_val < -min(combo[2] for combo in combinations))
+    by_exit = {}
+    for i, (p1, p2, bias_thresh) in enumerate(combinations):
+        by_exit.setdefault(p1, []).append(i)
+    
+    returns, groups = [], []
+    for p1, members in by_exit.items():
+        book['sell'] = regular_sell & (book['high'] >= mid * (1 + p1 / 100.0))
+        plan = plan_trades(book, left_side_exit())
+        entry = plan['entry']
+        # 持有到最后的交易按该股票最后一根K线的收盘价估值
+        exit_price = np.where(plan['exit'] >= 0, plan['price'], stock_last_close[book['stock'][entry]])
+        trade_return = (exit_price / close[entry] - 1) * 100
+        for i in members:
+            _, p2, bias_thresh = combinations[i]
+            hit = (low[entry] <= mid[entry] * (1 - p2 / 100.0)) & (bias_val[entry] < -bias_thresh)
+            returns.append(trade_return[hit])
+            groups.append(np.full(int(hit.sum()), i))
+    return trade_stats(np.concatenate(returns), np.concatenate(groups), len(combinations))
+
 def run_grid_search():
     start_date, end_date, p1_list, p2_list, bias_list = get_user_inputs()
     
-    stock_files = [f for f in os.listdir(HISTORY_DATA_DIR) if f.endswith('.csv')]
+    stock_codes = list_history_codes(HISTORY_STORE_DIR)
     
-    print(f"\n📡 正在预处理 {len(stock_files)} 只股票的历史数据...")
+    print(f"\n📡 正在预处理 {len(stock_codes)} 只股票的历史数据...")
     start_time = time.time()
     
-    with Pool(processes=NUM_CORES) as pool:
-        args_list = [(file, start_date, end_date) for file in stock_files]
-        results = pool.map(process_single_stock_file, args_list)
-        
-    all_signals = [res for res in results if res is not None and not res.empty]
-    if not all_signals:
+    if USE_PANEL_ENGINE:
+        bars = load_bars(stock_codes, dropna=True)
+        signals = channel_signals(bars)
+        master_history = long_table(bars, signals, list(SIGNAL_COLUMNS), start_date, end_date)
+        master_history.columns = list(SIGNAL_COLUMNS.values())
+    else:
+        with Pool(processes=NUM_CORES) as pool:
+            args_list = [(code, start_date, end_date) for code in stock_codes]
+            results = pool.map(process_single_stock_file, args_list)
+        all_signals = [res for res in results if res is not None and not res.empty]
+        master_history = pd.concat(all_signals, ignore_index=True) if all_signals else pd.DataFrame()
+
+    if master_history.empty:
         print("❌ 在指定日期范围内未找到任何有效数据，程序退出。")
         return
-        
-    master_history = pd.concat(all_signals, ignore_index=True)
     
     # 【排序核心】：按日期正序。同日触发时，优先买入 BIAS 最负（跌得最狠）的股票
     master_history.sort_values(by=['date', 'bias_val'], ascending=[True, True], inplace=True)
+
+    if USE_COMPACT_DTYPES:
+        compact_history = compact_table(master_history, code_column='code')
+        report_compaction(master_history, compact_history)
+        master_history = compact_history
     
     print(f"✅ 数据预处理完成，耗时 {time.time() - start_time:.2f} 秒。共 {len(master_history)} 条日切片数据。")
 
     combinations = list(itertools.product(p1_list, p2_list, bias_list))
+    if PRUNE_MODE:
+        screen_start = time.time()
+        stats = screen_combos(master_history, combinations)
+        keep = select_combos(stats, PRUNE_MODE, PRUNE_TOP_N, PRUNE_MIN_TRADES)
+        report_pruning(combinations, stats, keep, ['P1_上轨偏移(%)', 'P2_下轨偏移(%)', '负乖离要求(<-%)'], time.time() - screen_start)
+        combinations = [combinations[i] for i in keep]
+        stats = stats[keep]
     total_combos = len(combinations)
     print(f"\n⚙️ 即将开始左侧网格搜索，共需枚举计算 {total_combos} 种参数组合...")
     
     final_results = []
-    combo_count = 0
     search_start_time = time.time()
     
-    # 开始枚举计算
-    for p1, p2, bias_thresh in combinations:
-        combo_count += 1
-        print(f"正在计算 [{combo_count}/{total_combos}] -> P1(上轨):{p1}%, P2(下轨):{p2}%, 负乖离:{bias_thresh}%", end='\r')
-        
-        cash = INITIAL_CAPITAL
-        holdings = {}
-        total_trades = 0
-        winning_trades = 0
-        last_close_prices = {} 
-        
-        # 极速遍历算法
-        for row in master_history.itertuples(index=False):
-            code = row.code
-            close_price = row.close
-            high_price = row.high
-            low_price = row.low
-            
-            last_close_prices[code] = close_price
-            
-            # --- 卖出逻辑 ---
-            if code in holdings:
-                info = holdings[code]
-                info['days_held'] += 1
-                
-                # 动态计算上轨卖出线
-                upper_line = row.mid * (1 + p1 / 100.0)
-                
-                # 卖出条件判断
-                s_cond1 = high_price >= upper_line
-                regular_sell = s_cond1 and row.s_cond2 and row.vol_shrink
-                sell_signal = regular_sell and (not row.up_trend) # MACD滤网防止卖飞
-                
-                # 破位止损判断 (绑定买入动作，15日内跌破买入当日最低价)
-                stop_loss = (info['days_held'] <= 15) and (close_price < info['buy_day_low'])
-                
-                if sell_signal or stop_loss:
-                    if row.is_limit_down:
-                        continue # 跌停封死无法卖出
-                        
-                    sell_price = close_price # 回测简化：统一按收盘价撮合
-                    proceeds = info['shares'] * sell_price
-                    cash += proceeds
-                    
-                    pnl_percent = (sell_price / info['buy_price'] - 1) * 100
-                    total_trades += 1
-                    if pnl_percent > 0: winning_trades += 1
-                        
-                    del holdings[code]
-            
-            # --- 买入逻辑 ---
-            if code not in holdings:
-                # 动态计算下轨买入线
-                lower_line = row.mid * (1 - p2 / 100.0)
-                
-                # 买入条件判断
-                bias_ok = row.bias_val < -bias_thresh
-                b_cond1 = (low_price <= lower_line) and bias_ok
-                buy_signal = b_cond1 and row.b_cond2
-                
-                if buy_signal:
-                    if row.is_limit_up:
-                        continue # 涨停封死无法买入
-                        
-                    code_str = str(code).zfill(6)
-                    min_lot = 200 if code_str.startswith('688') else 100
-                    
-                    # 仓位控制：单只股票最多占用总资金的 20%
-                    max_shares = int(min(INITIAL_CAPITAL * 0.20, cash) // close_price)
-                    shares_to_buy = (max_shares // min_lot) * min_lot
-                    
-                    if shares_to_buy >= min_lot:
-                        cash -= shares_to_buy * close_price
-                        holdings[code] = {
-                            'shares': shares_to_buy,
-                            'buy_price': close_price,
-                            'days_held': 0,
-                            'buy_day_low': low_price # 极其关键：记录抄底防守线
-                        }
-                        
-        # 计算期末净值
-        final_value = cash
-        for code, info in holdings.items():
-            final_value += info['shares'] * last_close_prices.get(code, info['buy_price'])
-            
-        total_pnl = final_value - INITIAL_CAPITAL
-        return_pct = (final_value / INITIAL_CAPITAL - 1) * 100
-        win_rate = (winning_trades / total_trades * 100) if total_trades > 0 else 0.0
-        
+    # 参数组合分片到进程池并行枚举，长表写成只读内存映射供各子进程共享
+    with shared_table(master_history, GRID_COLUMNS, code_column='code') as meta:
+        meta['extra']['lots'] = lot_array(meta['codes']).tolist()  # 按共享长表的股票编号排列，取自注册表
+        if USE_BATCH_SIMULATOR:
+            batches = split_batches(combinations, NUM_CORES)
+            metrics = [m for batch in run_sharded(simulate_batch, batches, meta, NUM_CORES) for m in batch]
+        else:
+            metrics = run_sharded(simulate_combo, combinations, meta, NUM_CORES)
+    
+    for (p1, p2, bias_thresh), (total_pnl, return_pct, total_trades, win_rate) in zip(combinations, metrics):
         final_results.append({
             '回测开始': start_date,
             '回测结束': end_date,
@@ -237,6 +343,9 @@ def run_grid_search():
             '总交易笔数': total_trades,
             '胜率(%)': round(win_rate, 2)
         })
+    if PRUNE_MODE:
+        for row, (mean_return, win_rate, count) in zip(final_results, stats.tolist()):
+            row.update(zip(STAT_COLUMNS, (round(mean_return, 2), round(win_rate, 2), int(count))))
 
     print(f"\n\n🎉 左侧网格搜索计算完成！总计耗时 {time.time() - search_start_time:.2f} 秒。")
     
@@ -255,7 +364,7 @@ def run_grid_search():
     print(f"📄 完整的全量枚举结果已保存至: {csv_filename}")
 
 if __name__ == "__main__":
-    if not os.path.exists(HISTORY_DATA_DIR):
-        print(f"错误: 找不到 {HISTORY_DATA_DIR} 目录。请确保历史数据已存在！")
+    if not store_exists(HISTORY_STORE_DIR):
+        print(f"错误: 找不到历史数据仓库 {HISTORY_STORE_DIR}。请先运行 download_history.py 下载，或用 python3 history_store.py import 从 CSV 导入！")
         exit()
     run_grid_search()
\ No newline at end of file
@@ -0,0 +1,154 @@
+import numpy as np
+import pandas as pd
+from history_store import STORE_DIR, store_exists, load_history
+from tdx_adjust import xdxr_event_table, load_xdxr_cached
+from fetch_pipeline import acquire_token
+
+# ==========================================
+# 本地优先的日线获取层 (stock_bao / stock_html / stock_pytdx 共用)
+# ==========================================
+# 预热所需的长历史直接从列式仓库读取，只向数据源请求仓库最后一天之后的尾部K线。
+# 尾部会多取一根与仓库重叠的K线做复权校验，校验不通过时回退到各脚本原来的整段下载函数。
+#
+# 仓库存的是 Baostock 前复权价，只有在返回窗口内与数据源自己的复权序列逐根相同时才拿来拼接，
+# 否则整段向数据源下载，保证同一次运行里每只股票看到的都是该数据源自己的复权口径：
+#   baostock: 与仓库同源同口径，尾部直接拼接；
+#   tdx:      通达信只按送转/配股复权 (不处理现金分红)。窗口内没有任何除权除息事件时
+#             仓库前复权价 = 不复权价 = 通达信复权价，可以拼接；有事件时整段从通达信下载；
+#   akshare:  东方财富前复权对现金分红的处理与 Baostock 不同，又没有事件表可供判定，始终整段下载。
+
+# --- 配置 ---
+HISTORY_STORE_DIR = STORE_DIR
+STORE_VENDORS = ('baostock', 'tdx')     # 可以用仓库拼接的数据源 (见上)
+# 比较重叠K线时允许的绝对误差 (元)：只用于吸收两位小数舍入，复权口径差异由上面的规则单独判定
+VENDOR_PRICE_TOL = {'baostock': 0.0, 'tdx': 0.006}
+# 尾部请求与仓库重叠的K线数。通达信多取几根 (覆盖 xdxr 缓存有效期内的交易日)：
+# 仓库 (每天增量更新) 一旦记入新的除权除息，这几根K线的前复权价就与不复权价对不上，据此刷新 xdxr 缓存；
+# 通达信每次都发这一请求 (仓库已是最新时也一样)，Baostock 只在仓库落后时才请求尾部
+OVERLAP_BARS = {'baostock': 1, 'tdx': 6}
+OHLCV_COLUMNS = ['开盘', '收盘', '最高', '最低', '成交量']
+
+# ==========================================
+# 1. 各数据源的尾部K线获取 (统一返回 日期 + OHLCV，成交量单位统一为"股")
+# ==========================================
+def _fetch_tail_baostock(symbol, start_date, end_date, client=None):
+    """Baostock 前复权尾部K线 (调用方需已 bs.login)"""
+    from download_history import fetch_history
+    df, error_msg = fetch_history(symbol, start_date.strftime('%Y-%m-%d'), end_date.strftime('%Y-%m-%d'))
+    if df is None:
+        raise RuntimeError(f"Baostock 查询失败: {error_msg}")
+    return df
+
+def _fetch_tail_akshare(symbol, start_date, end_date, client=None):
+    """东方财富 (akshare) 前复权尾部K线，成交量从"手"换算为"股"与仓库对齐"""
+    import akshare as ak
+    df = ak.stock_zh_a_hist(symbol=symbol, period="daily", start_date=start_date.strftime('%Y%m%d'),
+                            end_date=end_date.strftime('%Y%m%d'), adjust="qfq")
+    if df is None or df.empty:
+        return pd.DataFrame(columns=['日期'] + OHLCV_COLUMNS)
+    df = df[['日期'] + OHLCV_COLUMNS].copy()
+    df['成交量'] = pd.to_numeric(df['成交量'], errors='coerce') * 100
+    return df
+
+def _fetch_tail_tdx(symbol, start_date, end_date, client):
+    """通达信 (mootdx) 不复权尾部K线；能否与仓库拼接由 _tdx_window_clean 按除权除息事件判定"""
+    # 交易日数不会超过工作日数，多取 2 根保证覆盖重叠K线
+    offset = int(np.busday_count(start_date.date(), end_date.date())) + 2
+    df = client.bars(symbol=symbol, frequency=9, offset=min(offset, 800))
+    if df is None or df.empty:
+        return pd.DataFrame(columns=['日期'] + OHLCV_COLUMNS)
+    df = df.rename(columns={'datetime': '日期', 'open': '开盘', 'high': '最高', 'low': '最低', 'close': '收盘', 'vol': '成交量'})
+    df['日期'] = pd.to_datetime(df['日期']).dt.normalize()
+    df = df[['日期'] + OHLCV_COLUMNS].copy()
+    df['成交量'] = pd.to_numeric(df['成交量'], errors='coerce') * 100
+    return df[(df['日期'] >= start_date) & (df['日期'] <= end_date)]
+
+def _tdx_window_clean(symbol, first_date, end_date, client):
+    """
+    窗口 (first_date, end_date] 内没有任何除权除息事件 (含现金分红) 时返回 True：
+    此时仓库前复权价、不复权价与通达信复权价三者相同，拼接结果就是通达信口径。
+    """
+    events = xdxr_event_table(load_xdxr_cached(client, symbol))
+    return not ((events['date'] > first_date) & (events['date'] <= end_date)).any()
+
+VENDORS = {
+    'baostock': _fetch_tail_baostock,
+    'akshare': _fetch_tail_akshare,
+    'tdx': _fetch_tail_tdx,
+}
+
+# ==========================================
+# 2. 对外接口
+# ==========================================
+def _overlap_changed(local, tail, abs_tol, rel_tol=1e-6):
+    """
+    比较尾部与仓库重叠的全部K线 (价格列)，任何一根对不上或仓库最后一根缺失时返回 True。
+    期间若发生分红送转，前复权价会被改写 (或与不复权价分开)，重叠K线随之对不上。
+    """
+    last_date = local['日期'].iloc[-1]
+    overlap = local.merge(tail[tail['日期'] <= last_date], on='日期', suffixes=('', '_new'))
+    if overlap.empty or overlap['日期'].iloc[-1] != last_date:
+        return True  # 重叠K线缺失，无法确认，按已变化处理
+    for col in ['开盘', '收盘', '最高', '最低']:
+        old, new = overlap[col].to_numpy(), overlap[col + '_new'].to_numpy()
+        if not (np.abs(new - old) <= np.maximum(rel_tol * np.abs(old), abs_tol)).all():  # NaN 也视为已变化
+            return True
+    return False
+
+def _fetch_full_again(fetch_full, symbol, start_date, end_date):
+    """尾部请求之后的整段回退是同一任务内的第二次请求：在抓取流水线中先申请令牌，不绕过限速"""
+    acquire_token()
+    return fetch_full(symbol, start_date, end_date)
+
+def get_daily_bars(symbol, start_date, end_date, vendor, fetch_full, client=None, bars=None):
+    """
+    返回以 日期 为索引、列为 开盘/收盘/最高/最低/成交量 的日线 DataFrame，覆盖 [start_date, end_date]。
+    start_date 为 None 时返回仓库中的全部历史；bars 不为 None 时只保留最后 bars 根 (复权判定也只针对这个窗口)。
+    返回的价格始终是 vendor 自己的复权口径 (见模块开头的说明)。
+
+    vendor:     尾部K线数据源 ('baostock' / 'akshare' / 'tdx')
+    fetch_full: 回退函数 fetch_full(symbol, start_date, end_date)，即各脚本原来的整段下载逻辑，
+                仓库缺失该股票、数据源不能用仓库拼接或复权校验失败时调用，返回格式同上
+    client:     需要连接对象的数据源 (如 mootdx 的 Quotes 客户端)
+    """
+    start_ts = pd.to_datetime(start_date) if start_date is not None else None
+    end_ts = pd.to_datetime(end_date)
+
+    if vendor not in STORE_VENDORS:
+        return fetch_full(symbol, start_date, end_date)
+    local = load_history(symbol, HISTORY_STORE_DIR) if store_exists(HISTORY_STORE_DIR) else None
+    if local is None or local.empty:
+        return fetch_full(symbol, start_date, end_date)
+
+    last_date = local['日期'].iloc[-1]
+    overlap_start = local['日期'].iloc[-min(OVERLAP_BARS[vendor], len(local))]
+    # 通达信在仓库已是最新时也请求重叠K线，用于发现仓库新记入的除权除息
+    if last_date < end_ts or (vendor == 'tdx' and last_date == end_ts):
+        try:
+            tail = VENDORS[vendor](symbol, overlap_start, end_ts, client)
+        except Exception:
+            return _fetch_full_again(fetch_full, symbol, start_date, end_date)
+
+        if tail is not None and not tail.empty:
+            tail = tail.copy()
+            tail['日期'] = pd.to_datetime(tail['日期'])
+            for c in OHLCV_COLUMNS:
+                tail[c] = pd.to_numeric(tail[c], errors='coerce')
+            # 重叠K线对不上，说明前复权价已被改写，仓库里的历史不能再直接拼接
+            if _overlap_changed(local, tail, VENDOR_PRICE_TOL[vendor]):
+                if vendor == 'tdx':
+                    load_xdxr_cached(client, symbol, changed_after=overlap_start)  # 除权迹象：缓存里没有这之后的事件就刷新
+                return _fetch_full_again(fetch_full, symbol, start_date, end_date)
+            local = pd.concat([local, tail[tail['日期'] > last_date]], ignore_index=True)
+
+    local.set_index('日期', inplace=True)
+    if start_ts is not None:
+        local = local[local.index >= start_ts]
+    local = local[local.index <= end_ts]
+    if bars is not None:
+        local = local.tail(bars)
+
+    # 通达信口径：窗口内有除权除息时仓库价与通达信复权价不同，整段改用通达信自己的序列
+    if vendor == 'tdx' and not local.empty and not _tdx_window_clean(symbol, local.index[0], end_ts, client):
+        return _fetch_full_again(fetch_full, symbol, start_date, end_date)
+    return local
@@ -0,0 +1,168 @@
+import heapq
+import numpy as np
+import pandas as pd
+from compact import column_values
+from universe import lot_array
+
+# ==========================================
+# 数组撮合引擎：单参数回测 (主升浪 / 左侧伏击) 的逐笔撮合
+# ==========================================
+# 原来的撮合循环逐行扫描整张长表 (几十万个 股票×交易日)，其实绝大多数行什么都不会发生：
+#   没持仓的股票只有出现买点的那一行才可能成交；
+#   持仓股票的离场日只取决于买入行与它自己的后续K线 (止盈止损 / 持仓天数 / 卖点 / 跌停锁死)，与资金无关。
+# 所以撮合分两步：
+#   1. plan_trades：对每个候选买点 (买点行且未涨停) 假设在该行买入，全部候选一起按持仓天数逐日向量化推进，
+#      得到候选交易表 (买入行, 离场行, 离场原因, 成交价)。这一步只跟参数有关，可在不同资金设置间复用；
+#   2. allocate：按长表顺序走一遍候选买点，套用现金与单只仓位上限，成交后把查表得到的离场事件放进堆里，
+#      处理下一个买点前先把位置在它之前的离场全部结算。
+# 资金、持仓与流水的先后次序都与逐行循环完全一致 (同一行先卖后买、跌停不卖、涨停不买)，交易流水逐字节相同。
+
+def build_book(full_history, columns, code_column='股票代码', date_column='日期'):
+    """
+    把已排序的长表转成撮合用的连续数组 (compact 压缩表与普通长表都可以)。
+    columns: {引擎字段名: 长表列名}，如 {'close': '收盘', 'buy': 'BUY_SIGNAL', ...}
+    """
+    codes = full_history[code_column]
+    if isinstance(codes.dtype, pd.CategoricalDtype):
+        stock = codes.cat.codes.to_numpy().astype(np.int64)
+        names = [str(c) for c in codes.cat.categories]
+    else:
+        stock, uniques = pd.factorize(codes)
+        names = [str(c) for c in uniques]
+    # lot: 按股票整数编号排列的最小买入单位 (取自注册表 universe.npy)，撮合时按编号取值
+    book = {'stock': stock, 'codes': names, 'lot': lot_array(names).tolist(), 'date': full_history[date_column].to_numpy()}
+    for field, col in columns.items():
+        values = column_values(full_history, col)
+        book[field] = values if values.dtype == bool else values.astype(np.float64)
+
+    # 每只股票在长表中的位置 (升序，即按日期)，以及每一行同一股票下一根K线的位置 (最后一根为 -1)
+    order = np.argsort(stock, kind='stable')
+    counts = np.bincount(stock, minlength=len(names))
+    book['stock_rows'] = np.split(order, np.cumsum(counts)[:-1])
+    same = stock[order[1:]] == stock[order[:-1]]
+    next_row = np.full(len(stock), -1, dtype=np.int64)
+    next_row[order[:-1][same]] = order[1:][same]
+    book['next_row'] = next_row
+    return book
+
+def plan_trades(book, exit_rule):
+    """
+    第一步：候选交易表。每个候选买点 (买点行且未涨停) 都假设按收盘价买入，
+    全部候选按持仓天数逐日一起推进，找出第一根触发离场且未跌停的K线。
+    exit_rule(book, rows, days, holding) -> (离场掩码, describe)：
+      rows 为各候选当天所在的长表位置，days 为持仓天数 (从 1 起)，holding 为各候选的 {'buy_price', 'buy_day_low'} 数组，
+      describe(i) 返回下标数组 i 处离场的 (原因数组, 成交价数组)。
+    返回 {'entry': 买入行, 'exit': 离场行 (持有到最后为 -1), 'reason': 离场原因, 'price': 离场成交价}
+    """
+    next_row = book['next_row']
+    entry = np.flatnonzero(book['buy'] & ~book['limit_up'])
+    low = book.get('low')
+    holding = {'buy_price': book['close'][entry],
+               'buy_day_low': low[entry] if low is not None else np.full(len(entry), np.nan)}
+    exit_row = np.full(len(entry), -1, dtype=np.int64)
+    reason = np.empty(len(entry), dtype=object)
+    price = np.full(len(entry), np.nan)
+
+    alive = np.arange(len(entry))          # 尚未离场的候选
+    rows = next_row[entry]                 # 它们下一根K线的位置
+    days = 1
+    while len(alive):
+        has_bar = rows >= 0                # 没有后续K线的候选持有到最后
+        alive, rows = alive[has_bar], rows[has_bar]
+        if not len(alive):
+            break
+        want, describe = exit_rule(book, rows, np.full(len(rows), days),
+                                   {name: values[alive] for name, values in holding.items()})
+        hit = np.flatnonzero(want & ~book['limit_down'][rows])
+        if len(hit):
+            hit_reason, hit_price = describe(hit)
+            exit_row[alive[hit]] = rows[hit]
+            reason[alive[hit]] = [str(r) for r in np.asarray(hit_reason).tolist()]
+            price[alive[hit]] = hit_price
+        keep = np.ones(len(alive), dtype=bool)
+        keep[hit] = False
+        alive, rows = alive[keep], next_row[rows[keep]]
+        days += 1
+    return {'entry': entry, 'exit': exit_row, 'reason': reason, 'price': price}
+
+def allocate(book, plan, initial_capital, buy_reason, position_pct=0.20):
+    """
+    第二步：按长表顺序套用资金约束，返回 (交易流水列表, 期末现金, 期末持仓 {代码: 持仓信息})。
+    plan 为 plan_trades 的候选交易表，同一张表可以用不同的 initial_capital / position_pct 反复撮合。
+    """
+    cash = initial_capital
+    holdings = {}
+    trade_log = []
+    exits = []                   # 堆：(离场位置, 代码)
+    pending = {}                 # 代码 -> (原因, 成交价)
+    close, low = book['close'], book.get('low')
+
+    def settle(position):
+        nonlocal cash
+        while exits and exits[0][0] <= position:
+            pos, code = heapq.heappop(exits)
+            reason, sell_price = pending.pop(code)
+            info = holdings.pop(code)
+            proceeds = info['shares'] * sell_price
+            cash += proceeds
+            trade_log.append({
+                "Date": pd.Timestamp(book['date'][pos]).strftime('%Y-%m-%d'),
+                "StockCode": code,
+                "Action": "SELL",
+                "Shares": info['shares'],
+                "Price": round(sell_price, 2),
+                "Amount": round(proceeds, 2),
+                "PnL_Amount": round(proceeds - info['cost_basis'], 2),
+                "PnL_Percent": round((sell_price / info['buy_price'] - 1) * 100, 2),
+                "Reason": reason,
+                "Cash_Remaining": round(cash, 2)
+            })
+
+    for j, p in enumerate(plan['entry'].tolist()):
+        settle(p)
+        stock = book['stock'][p]
+        code = book['codes'][stock]
+        if code in holdings:
+            continue  # 已持仓 (涨停板在候选交易表里已剔除)
+        price_to_buy = float(close[p])
+        min_lot_size = book['lot'][stock]
+        # 严格风控：单只股票最多占用总资金的 position_pct
+        max_shares_for_position = int((initial_capital * position_pct) // price_to_buy)
+        max_shares_for_cash = int(cash // price_to_buy)
+        shares_to_buy = (min(max_shares_for_position, max_shares_for_cash) // min_lot_size) * min_lot_size
+        if shares_to_buy < min_lot_size:
+            continue
+        cost = shares_to_buy * price_to_buy
+        cash -= cost
+        holdings[code] = {'stock': int(stock), 'shares': shares_to_buy,
+                          'buy_price': price_to_buy, 'cost_basis': cost,
+                          'buy_day_low': float(low[p]) if low is not None else None}
+        trade_log.append({
+            "Date": pd.Timestamp(book['date'][p]).strftime('%Y-%m-%d'),
+            "StockCode": code,
+            "Action": "BUY",
+            "Shares": shares_to_buy,
+            "Price": round(price_to_buy, 2),
+            "Amount": round(cost, 2),
+            "PnL_Amount": 0,
+            "PnL_Percent": 0,
+            "Reason": buy_reason,
+            "Cash_Remaining": round(cash, 2)
+        })
+        exit_row = int(plan['exit'][j])
+        if exit_row >= 0:
+            pending[code] = (plan['reason'][j], float(plan['price'][j]))
+            heapq.heappush(exits, (exit_row, code))
+    settle(len(book['stock']))
+    return trade_log, cash, holdings
+
+def match(book, exit_rule, initial_capital, buy_reason, position_pct=0.20):
+    """两步撮合一次完成：plan_trades 生成候选交易表，再由 allocate 套用资金约束"""
+    return allocate(book, plan_trades(book, exit_rule), initial_capital, buy_reason, position_pct)
+
+def portfolio_value(book, cash, holdings):
+    """期末总值 = 现金 + 剩余持仓按各自最后一根K线收盘价估值 (按买入先后累加)"""
+    value = cash
+    for code, info in holdings.items():
+        value += info['shares'] * float(book['close'][book['stock_rows'][info['stock']][-1]])
+    return value
@@ -0,0 +1,228 @@
+import numpy as np
+import pandas as pd
+from history_store import STORE_DIR
+from history_panel import PANEL_DIR, load_panel
+from indicators import sma_panel, rolling_extrema
+from universe import limit_array
+
+# ==========================================
+# 面板指标引擎：一次性对 (K线序号 × 股票) 二维数组计算全部策略指标
+# ==========================================
+# 原来每只股票单独构造 DataFrame、逐列 rolling/ewm，股票越多 pandas 的固定开销越大。
+# 这里先把对齐面板 (交易日 × 股票) 按每只股票"自己的K线序号"左对齐：
+#   第 j 列的第 k 行 = 该股票的第 k 根有效K线，停牌日/上市前不占行，末尾用 NaN 补齐。
+# 这样沿时间轴的 rolling / ewm / shift 与逐只计算的语义完全一致 (窗口数的是K线根数而不是日历天数)，
+# 而每个算子只需对整个二维数组调用一次。算完后可按原掩码散回日历面板，或直接展开成回测用的长表。
+
+# ==========================================
+# 1. 左对齐 / 散回
+# ==========================================
+def left_justify(values, valid):
+    """把日历对齐的 (天, 股票) 数组按有效掩码左对齐为 (最大K线数, 股票)，空位为 NaN"""
+    lengths = valid.sum(axis=0)
+    rows = np.cumsum(valid, axis=0) - 1
+    day_idx, stock_idx = np.nonzero(valid)
+    packed = np.full((int(lengths.max()) if len(lengths) else 0, valid.shape[1]), np.nan)
+    packed[rows[day_idx, stock_idx], stock_idx] = values[day_idx, stock_idx]
+    return packed
+
+def scatter_back(packed, valid):
+    """left_justify 的逆操作：把左对齐结果放回日历位置，其余位置为 NaN"""
+    rows = np.cumsum(valid, axis=0) - 1
+    day_idx, stock_idx = np.nonzero(valid)
+    out = np.full(valid.shape, np.nan)
+    out[day_idx, stock_idx] = packed[rows[day_idx, stock_idx], stock_idx]
+    return out
+
+def load_bars(codes=None, dropna=False, panel_dir=PANEL_DIR, store_dir=STORE_DIR):
+    """
+    从对齐面板读取指定股票并左对齐，返回字典：
+      codes / raw_lengths (仓库中的K线数) / lengths (参与计算的K线数) / valid (左对齐后的有效位置)
+      date / 开盘 / 收盘 / 最高 / 最低 / 成交量 (左对齐的二维数组)
+      calendar_valid (日历面板上的有效掩码，用于 scatter_back)
+    dropna=True 时 OHLCV 任一为 NaN 的K线视为无效 (对应原脚本中的 df.dropna)。
+    """
+    panel = load_panel(panel_dir, store_dir)
+    codes = panel['codes'].tolist() if codes is None else [str(c).zfill(6) for c in codes]
+    cols = np.array([panel['index'][c] for c in codes], dtype=np.int64)
+
+    data = np.asarray(panel['data'][:, cols, :])
+    mask = np.asarray(panel['mask'][:, cols])
+    valid = mask.copy()
+    if dropna:
+        valid &= ~np.isnan(data).any(axis=2)
+
+    bars = {
+        'codes': codes,
+        'raw_lengths': mask.sum(axis=0),
+        'lengths': valid.sum(axis=0),
+        'calendar_valid': valid,
+    }
+    names = {'open': '开盘', 'close': '收盘', 'high': '最高', 'low': '最低', 'volume': '成交量'}
+    for k, name in enumerate(panel['fields']):
+        bars[names[name]] = left_justify(data[:, :, k], valid)
+
+    day_numbers = np.broadcast_to(np.arange(len(panel['calendar']), dtype=np.float64)[:, None], valid.shape)
+    packed_days = left_justify(day_numbers, valid)
+    dates = np.full(packed_days.shape, np.datetime64('NaT'), dtype='datetime64[ns]')
+    has_day = ~np.isnan(packed_days)
+    dates[has_day] = panel['calendar'][packed_days[has_day].astype(np.int64)]
+    bars['date'] = dates
+    bars['valid'] = has_day
+    return bars
+
+# ==========================================
+# 2. 沿时间轴的二维算子 (每列独立，与 Series 上的同名操作逐位一致)
+# ==========================================
+def shift(x, periods=1):
+    out = np.full(x.shape, np.nan)
+    if periods > 0:
+        out[periods:] = x[:-periods]
+    elif periods < 0:
+        out[:periods] = x[-periods:]
+    else:
+        out[:] = x
+    return out
+
+def rolling_mean(x, window, min_periods=None):
+    return pd.DataFrame(x).rolling(window, min_periods=min_periods).mean().to_numpy()
+
+def rolling_std(x, window, min_periods=None):
+    return pd.DataFrame(x).rolling(window, min_periods=min_periods).std().to_numpy()
+
+def rolling_max(x, window, min_periods=None):
+    return rolling_extrema(x, [window], 'max', min_periods)[window]
+
+def rolling_min(x, window, min_periods=None):
+    return rolling_extrema(x, [window], 'min', min_periods)[window]
+
+def ema(x, span):
+    """通达信 EMA (= ewm(adjust=False))"""
+    return pd.DataFrame(x).ewm(span=span, adjust=False).mean().to_numpy()
+
+def _ma20_angle(ma20):
+    return np.degrees(np.arctan((ma20 / shift(ma20) - 1) * 100))
+
+def _limit_flags(bars, close):
+    """涨跌停判定：阈值按每只股票的板块广播"""
+    threshold = limit_array(bars['codes'])
+    pct_change = (close / shift(close) - 1) * 100
+    return pct_change, pct_change >= threshold, pct_change <= -threshold
+
+# ==========================================
+# 3. 策略指标
+# ==========================================
+@np.errstate(divide='ignore', invalid='ignore')
+def main_wave_signals(bars, min_periods=1, slope_threshold=None):
+    """策略3 / 主升浪 (RIGHT_SIDE_PRO)：均线、MA20 角度、MACD、买卖点与涨跌停标记"""
+    c, o, v = bars['收盘'], bars['开盘'], bars['成交量']
+    out = {
+        'MA5': rolling_mean(c, 5, min_periods),
+        'MA10': rolling_mean(c, 10, min_periods),
+        'MA20': rolling_mean(c, 20, min_periods),
+        'MA60': rolling_mean(c, 60, min_periods),
+        'VOL_MA5': rolling_mean(v, 5, min_periods),
+    }
+    out['MA20_ANGLE'] = _ma20_angle(out['MA20'])
+    out['DIF'] = ema(c, 12) - ema(c, 26)
+    out['DEA'] = ema(out['DIF'], 9)
+
+    cond_trend = (c > out['MA10']) & (out['MA5'] > out['MA20']) & (out['MA20'] > out['MA60']) & (out['MA60'] > shift(out['MA60']))
+    cond_power = (c / shift(c) > 1.03) & (c > o)
+    cond_vol = v > out['VOL_MA5']
+    cond_macd = (out['DIF'] > 0) & (out['DIF'] > out['DEA'])
+    out['BASE_BUY'] = cond_trend & cond_power & cond_vol & cond_macd
+    if slope_threshold is not None:
+        out['BUY_SIGNAL'] = (out['MA20_ANGLE'] > slope_threshold) & out['BASE_BUY']
+
+    cross_ma10 = (shift(c) >= shift(out['MA10'])) & (c < out['MA10'])
+    ma20_bad = (out['MA20_ANGLE'] < 0) & (c < out['MA20'])
+    out['SELL_SIGNAL'] = cross_ma10 | ma20_bad
+    out['pct_change'], out['is_limit_up'], out['is_limit_down'] = _limit_flags(bars, c)
+    return out
+
+@np.errstate(divide='ignore', invalid='ignore')
+def channel_signals(bars, p1=None, p2=None, bias_thresh=None):
+    """左侧伏击：VAR1/MID 通道、MA20 乖离、K线形态、缩量、MACD 滤网；给出 p1/p2/bias_thresh 时同时生成买卖点"""
+    c, o, h, l, v = bars['收盘'], bars['开盘'], bars['最高'], bars['最低'], bars['成交量']
+    out = {'VAR1': (c + h + o + l) / 4}
+    out['MID'] = ema(out['VAR1'], 32)
+    out['MA20'] = rolling_mean(c, 20, 1)
+    out['BIAS_VAL'] = (c - out['MA20']) / out['MA20'] * 100
+    out['B_COND2'] = (c > o) & ((c - l) > (h - c))
+    body = np.abs(c - o)
+    upper_shadow = h - np.maximum(c, o)
+    out['S_COND2'] = (c < o) | (upper_shadow > body * 1.5)
+    out['vol_shrink'] = v < shift(v)
+    out['DIF'] = ema(c, 12) - ema(c, 26)
+    out['DEA'] = ema(out['DIF'], 9)
+    out['up_trend'] = (out['DIF'] > 0) & (out['DEA'] > 0) & (out['DIF'] > out['DEA'])
+
+    if p1 is not None:
+        upper = out['MID'] * (1 + p1 / 100.0)
+        lower = out['MID'] * (1 - p2 / 100.0)
+        out['BUY_SIGNAL'] = (l <= lower) & (out['BIAS_VAL'] < -bias_thresh) & out['B_COND2']
+        out['SELL_SIGNAL'] = (h >= upper) & out['S_COND2'] & out['vol_shrink'] & (~out['up_trend'])
+    out['pct_change'], out['is_limit_up'], out['is_limit_down'] = _limit_flags(bars, c)
+    return out
+
+@np.errstate(divide='ignore', invalid='ignore')
+def deep_bottom_signals(bars, min_periods=None):
+    """策略1 / 历史大底：HHV/LLV 三档均值通道、SMA 比值 RC、RD/RE/RF 与原始信号值"""
+    c, h, l = bars['收盘'], bars['最高'], bars['最低']
+    out = {}
+    hhv = rolling_extrema(h, [500, 250, 90], 'max', min_periods)
+    llv = rolling_extrema(l, [500, 250, 90], 'min', min_periods)
+    for p in [500, 250, 90]:
+        out[f'R_HHV{p}'] = rolling_mean(hhv[p], 21, min_periods)
+        out[f'R_LLV{p}'] = rolling_mean(llv[p], 21, min_periods)
+    r7 = (out['R_LLV500']*0.96 + out['R_LLV250']*0.96 + out['R_LLV90']*0.96 +
+          out['R_HHV500']*0.558 + out['R_HHV250']*0.558 + out['R_HHV90']*0.558) / 6
+    r8 = (out['R_LLV500']*1.25 + out['R_LLV250']*1.23 + out['R_LLV90']*1.2 +
+          out['R_HHV500']*0.55 + out['R_HHV250']*0.55 + out['R_HHV90']*0.65) / 6
+    r9 = (out['R_LLV500']*1.3 + out['R_LLV250']*1.3 + out['R_LLV90']*1.3 +
+          out['R_HHV500']*0.68 + out['R_HHV250']*0.68 + out['R_HHV90']*0.68) / 6
+    out['RA'] = rolling_mean((r7*3 + r8*2 + r9) / 6 * 1.738, 21, min_periods)
+
+    diff = l - shift(l)
+    # SMA 递推是因果的，补齐行的取值不影响有效行；填 0 避免补齐行上反复触发 NaN 重启
+    padding = ~bars['valid']
+    sma_abs = sma_panel(np.where(padding, 0.0, np.abs(diff)), 3, 1)
+    sma_max = sma_panel(np.where(padding, 0.0, np.clip(diff, 0, None)), 3, 1)
+    out['RC'] = np.where(sma_max != 0, (sma_abs / sma_max) * 100, 0)
+
+    out['RD'] = rolling_mean(np.where(c*1.35 <= out['RA'], out['RC']*10, out['RC']/10), 3, min_periods)
+    out['RE'] = rolling_min(l, 30, min_periods)
+    out['RF'] = rolling_max(out['RD'], 30, min_periods)
+    out['R10'] = (~np.isnan(rolling_mean(c, 58, min_periods))).astype(int)
+    out['raw_signal'] = np.where(l <= out['RE'], (out['RD'] + out['RF']*2)/2, 0)
+    return out
+
+# ==========================================
+# 4. 展开为回测用长表
+# ==========================================
+def long_table(bars, arrays, columns, start_date=None, end_date=None, min_bars=60):
+    """
+    把左对齐数组展开成与逐只 pd.concat 完全相同的长表 (按股票顺序、股票内按日期升序)。
+    columns:  输出列名列表，可使用 日期 / 股票代码 / 开盘 等原始列以及 arrays 中的指标列
+    min_bars: 仓库中K线数少于该值的股票整只跳过 (对应原脚本的 len(df) < 60)
+    """
+    keep = bars['valid'] & (bars['raw_lengths'] >= min_bars)[None, :]
+    if start_date is not None:
+        keep &= bars['date'] >= np.datetime64(pd.to_datetime(start_date))
+    if end_date is not None:
+        keep &= bars['date'] <= np.datetime64(pd.to_datetime(end_date))
+
+    # 转置后按行优先取值，即"先股票、后日期"的顺序
+    keep_t = keep.T
+    result = {}
+    for col in columns:
+        if col == '股票代码':
+            counts = keep_t.sum(axis=1)
+            result[col] = np.repeat(np.array(bars['codes'], dtype=object), counts)
+        elif col == '日期':
+            result[col] = bars['date'].T[keep_t]
+        else:
+            source = arrays[col] if col in arrays else bars[col]
+            result[col] = source.T[keep_t]
+    return pd.DataFrame(result, columns=columns)
@@ -0,0 +1,155 @@
+import sys
+import math
+import time
+import pickle
+import warnings
+import pandas as pd
+from multiprocessing import Pool, cpu_count
+import indicators
+import stock_bao
+import stock_pytdx
+from history_store import STORE_DIR, store_exists, list_history_codes, load_history
+from indicator_state import ScreenerState, iter_bars
+warnings.filterwarnings('ignore')
+
+# ==========================================
+# 逐日增量指标 与 批量重算 的对照回放
+# ==========================================
+# 把仓库中的历史日线逐日喂给 indicator_state.ScreenerState，和选股脚本的 compute_signals 批量结果逐日比对，
+# 每只股票报告第一个出现分歧的日期与字段。两种对照：
+#   全程：整段历史批量算一次，与逐日推进得到的每一天逐行比较 (因果公式下等价于每天各跑一次批量)；
+#   逐日重算：最后 RECHECK_DAYS 天，每天按选股脚本的真实取数窗口 (bao 往前 1000 天 / tdx 最近 800 根)
+#            整段重算一次，取最后一行与当天的逐日结果比较，能发现用到未来数据或依赖窗口起点的公式。
+# 逐日重算开始前，状态会经过一次 pickle 往返，顺带验证持久化不会改变结果。
+
+# --- 配置 ---
+HISTORY_STORE_DIR = STORE_DIR
+REPORT_FILE = 'replay_report.csv'
+RECHECK_DAYS = 5                      # 末尾逐日整段重算的天数
+VALUE_RTOL = 1e-9                     # 指标数值的相对容差；信号标记与连续天数必须完全一致
+VALUE_ATOL = 1e-9                     # 绝对容差 (MA20 角度在 0 附近时相对容差无意义)
+NUM_CORES = max(1, cpu_count() - 1)
+MIN_BARS = {'bao': 200, 'tdx': 60}    # 与两个选股脚本的最少K线数一致
+BAO_LOOKBACK_DAYS = 1000              # stock_bao 往前取的预热天数
+TDX_WINDOW = 800                      # stock_pytdx 只保留最近 800 根K线
+
+FLAG_FIELDS = ['S1_Signal', 'S1_Streak', 'S2_Signal', 'S2_Streak', 'S3_Signal', 'S3_Streak']
+VALUE_FIELDS = ['收盘', 'MA20_Angle', 'BBI', 'MA60', '波动率%']
+SCREENERS = {'bao': stock_bao, 'tdx': stock_pytdx}
+
+# 每天的前缀数据都不同，对照时不写指标缓存
+indicators.INDICATOR_CACHE_ENABLED = False
+
+def _same_value(a, b):
+    a, b = float(a), float(b)
+    if a == b or (math.isnan(a) and math.isnan(b)):
+        return True
+    if math.isnan(a) or math.isnan(b):
+        return False
+    return abs(a - b) <= VALUE_ATOL + VALUE_RTOL * max(abs(a), abs(b))
+
+def first_difference(batch_row, stream_row):
+    """返回第一个不一致的 (字段, 批量值, 逐日值)，完全一致时返回 None"""
+    for field in FLAG_FIELDS:
+        if batch_row[field] != stream_row[field]:
+            return field, batch_row[field], stream_row[field]
+    for field in VALUE_FIELDS:
+        if not _same_value(batch_row[field], stream_row[field]):
+            return field, batch_row[field], stream_row[field]
+    return None
+
+def production_window(df, end, profile):
+    """选股脚本在 end 当天收盘后实际会拿到的那段日线"""
+    df = df.iloc[:end + 1]
+    if profile == 'tdx':
+        return df.tail(TDX_WINDOW)
+    return df[df.index >= df.index[-1] - pd.Timedelta(days=BAO_LOOKBACK_DAYS)]
+
+def _record(code, profile, check, days, divergences):
+    record = {'股票代码': code, '口径': profile, '检查方式': check, '对照天数': days,
+              '分歧天数': len(divergences), '首个分歧日期': '', '分歧字段': '', '批量值': '', '逐日值': ''}
+    if divergences:
+        date, (field, batch_value, stream_value) = divergences[0]
+        record.update({'首个分歧日期': date.strftime('%Y-%m-%d'), '分歧字段': field,
+                       '批量值': batch_value.item() if hasattr(batch_value, 'item') else batch_value,
+                       '逐日值': stream_value})
+    return record
+
+def replay_stock(args):
+    """单只股票的两种对照，返回报告记录列表 (数据不足时为空)"""
+    code, profile, recheck_days = args
+    try:
+        df = load_history(code, HISTORY_STORE_DIR)
+        if df is None or len(df) < MIN_BARS[profile]:
+            return []
+        df = df.set_index('日期')
+        screener = SCREENERS[profile]
+
+        # --- 全程对照 ---
+        batch = screener.compute_signals(df.copy())[FLAG_FIELDS + VALUE_FIELDS].to_dict('records')
+        recheck_from = max(len(df) - recheck_days, MIN_BARS[profile] - 1)
+        state = ScreenerState(profile)
+        divergences = []
+        stream_rows = {}
+        for i, bar in enumerate(iter_bars(df)):
+            if i == recheck_from:
+                state = pickle.loads(pickle.dumps(state))
+            row = state.update(bar)
+            diff = first_difference(batch[i], row)
+            if diff:
+                divergences.append((df.index[i], diff))
+            if i >= recheck_from:
+                stream_rows[i] = dict(row)
+        records = [_record(code, profile, '全程', len(df), divergences)]
+
+        # --- 逐日重算对照 ---
+        divergences = []
+        for i, row in stream_rows.items():
+            window = production_window(df, i, profile)
+            if len(window) < MIN_BARS[profile]:
+                continue
+            batch_row = screener.compute_signals(window.copy()).iloc[-1]
+            diff = first_difference(batch_row, row)
+            if diff:
+                divergences.append((df.index[i], diff))
+        records.append(_record(code, profile, '逐日重算', len(stream_rows), divergences))
+        return records
+    except Exception as e:
+        print(f"[{code}] 回放失败: {e}")
+        return []
+
+def run_replay(profiles, codes=None, recheck_days=RECHECK_DAYS, report_file=REPORT_FILE):
+    codes = codes or list_history_codes(HISTORY_STORE_DIR)
+    jobs = [(code, profile, recheck_days) for profile in profiles for code in codes]
+    print(f"📼 回放 {len(codes)} 只股票，口径 {', '.join(profiles)}，末尾逐日重算 {recheck_days} 天...")
+    start_time = time.time()
+    with Pool(processes=NUM_CORES) as pool:
+        results = pool.map(replay_stock, jobs)
+    report = pd.DataFrame([r for records in results for r in records])
+    if report.empty:
+        print("❌ 没有可回放的股票。")
+        return report
+    report.to_csv(report_file, index=False, encoding='utf-8-sig')
+
+    print(f"✅ 回放完成，耗时 {time.time() - start_time:.1f} 秒。")
+    for (profile, check), group in report.groupby(['口径', '检查方式'], sort=False):
+        diverged = group[group['分歧天数'] > 0]
+        print(f"  [{profile}] {check}: {len(group)} 只股票，{len(group) - len(diverged)} 只完全一致，{len(diverged)} 只出现分歧")
+        if not diverged.empty:
+            print("    分歧字段分布: " + ', '.join(f"{k} {v}" for k, v in diverged['分歧字段'].value_counts().items()))
+            for _, r in diverged.head(3).iterrows():
+                print(f"    {r['股票代码']} {r['首个分歧日期']} {r['分歧字段']}: 批量 {r['批量值']!r} / 逐日 {r['逐日值']!r}")
+    print(f"📄 逐股明细已保存至: {report_file}")
+    return report
+
+if __name__ == '__main__':
+    # python3 replay_signals.py                 两种口径、全部股票
+    # python3 replay_signals.py tdx 000001 ...  指定口径与股票
+    if not store_exists(HISTORY_STORE_DIR):
+        print(f"错误: 找不到历史数据仓库 {HISTORY_STORE_DIR}。请先运行 download_history.py 下载！")
+        sys.exit(1)
+    args = sys.argv[1:]
+    profiles = ['bao', 'tdx']
+    if args and args[0] in profiles:
+        profiles = [args.pop(0)]
+    run_replay(profiles, [str(c).zfill(6) for c in args] or None)
@@ -10,43 +10,13 @@ import numpy as np
 import datetime
 import os
 from concurrent.futures import ThreadPoolExecutor, as_completed
+from universe import load_stock_list
+from indicators import sma, signal_flag, render_signal
 
 # ==========================================
 # 1. 核心算法函数定义 (保持不变)
 # ==========================================
 
-def sma(series, n, m):
-    """
-    策略1核心：通达信SMA递归算法
-    公式: Y = (X*M + Y'*(N-M)) / N
-    """
-    sma_values = []
-    # 为了加速，转换为numpy array处理
-    series_array = series.values
-    
-    # 初始值处理
-    # 模拟通达信：前N-1个无效，第N个为简单平均，之后递归
-    # 但为了Python计算方便，通常从第一个有效值开始递归
-    
-    val = np.nan
-    for i, x in enumerate(series_array):
-        if i < n - 1:
-            sma_values.append(np.nan)
-        elif i == n - 1:
-            # 初始值：取前n个的平均值作为启动值
-            val = np.nanmean(series_array[:n])
-            sma_values.append(val)
-        else:
-            if np.isnan(val):
-                # 如果前值是NaN，尝试重新初始化
-                val = np.nanmean(series_array[:i+1])
-            else:
-                # 递归公式
-                val = (x * m + val * (n - m)) / n
-            sma_values.append(val)
-            
-    return pd.Series(sma_values, index=series.index)
-
 def calculate_xma(series, window):
     """策略2核心：EMA算法 (XMA)"""
     return series.ewm(span=window, adjust=False).mean()
@@ -55,6 +25,83 @@ def calculate_xma(series, window):
 # 2. 单只股票处理引擎
 # ==========================================
 
+def compute_signals(df):
+    """计算通用指标与策略1、策略2的信号列 (日期索引、升序的日线 DataFrame，原地追加列后返回)"""
+    # ==========================================
+    # 计算通用指标 (BBI, MA60, 波动率)
+    # ==========================================
+    # MA60
+    df['MA60'] = df['收盘'].rolling(60).mean()
+
+    # BBI: (MA3 + MA6 + MA12 + MA24) / 4
+    ma3 = df['收盘'].rolling(3).mean()
+    ma6 = df['收盘'].rolling(6).mean()
+    ma12 = df['收盘'].rolling(12).mean()
+    ma24 = df['收盘'].rolling(24).mean()
+    df['BBI'] = (ma3 + ma6 + ma12 + ma24) / 4
+
+    # 波动率 (20日年化波动率)
+    df['Log_Ret'] = np.log(df['收盘'] / df['收盘'].shift(1))
+    df['波动率%'] = df['Log_Ret'].rolling(20).std() * np.sqrt(252) * 100
+
+    # ==========================================
+    # 计算策略 1: 历史大底 (Deep Bottom)
+    # ==========================================
+    # 这里的参数完全保留了您提供的第一段代码逻辑
+    for p in [500, 250, 90]:
+        df[f'HHV{p}'] = df['最高'].rolling(p).max()
+        df[f'LLV{p}'] = df['最低'].rolling(p).min()
+        df[f'R_HHV{p}'] = df[f'HHV{p}'].rolling(21).mean()
+        df[f'R_LLV{p}'] = df[f'LLV{p}'].rolling(21).mean()
+
+    df['R7'] = (df['R_LLV500']*0.96 + df['R_LLV250']*0.96 + df['R_LLV90']*0.96 + 
+                df['R_HHV500']*0.558 + df['R_HHV250']*0.558 + df['R_HHV90']*0.558) / 6
+    df['R8'] = (df['R_LLV500']*1.25 + df['R_LLV250']*1.23 + df['R_LLV90']*1.2 + 
+                df['R_HHV500']*0.55 + df['R_HHV250']*0.55 + df['R_HHV90']*0.65) / 6
+    df['R9'] = (df['R_LLV500']*1.3 + df['R_LLV250']*1.3 + df['R_LLV90']*1.3 + 
+                df['R_HHV500']*0.68 + df['R_HHV250']*0.68 + df['R_HHV90']*0.68) / 6
+
+    # 核心基准线 RA
+    df['RA'] = (df['R7']*3 + df['R8']*2 + df['R9']) / 6 * 1.738
+    df['RA'] = df['RA'].rolling(21).mean()
+
+    # 情绪指标 RC & RD
+    df['RB'] = df['最低'].shift(1)
+    df['ABS_LOW_RB'] = (df['最低'] - df['RB']).abs()
+    df['MAX_LOW_RB'] = (df['最低'] - df['RB']).clip(lower=0)
+    df['SMA_ABS'] = sma(df['ABS_LOW_RB'], 3, 1)
+    df['SMA_MAX'] = sma(df['MAX_LOW_RB'], 3, 1)
+
+    # 防止除零错误
+    with np.errstate(divide='ignore', invalid='ignore'):
+        df['RC'] = np.where(df['SMA_MAX'] != 0, (df['SMA_ABS'] / df['SMA_MAX']) * 100, 0)
+
+    df['RD'] = np.where(df['收盘']*1.35 <= df['RA'], df['RC']*10, df['RC']/10)
+    df['RD'] = df['RD'].rolling(3).mean()
+    df['RE'] = df['最低'].rolling(30).min()
+    df['RF'] = df['RD'].rolling(30).max()
+
+    # 信号判定
+    df['R10'] = df['收盘'].rolling(58).mean().notna().astype(int)
+    raw_signal = np.where(df['最低'] <= df['RE'], (df['RD'] + df['RF']*2)/2, 0)
+    df['S1_Raw_Val'] = raw_signal * df['R10']
+    df['S1_Trigger'] = (df['S1_Raw_Val'] > 0).astype(int)
+
+    # *** 信号优化：连续标记3天 (如果今天、昨天、前天触发，今天都标Y) ***
+    df['S1_Final_Flag'] = df['S1_Trigger'].rolling(window=3, min_periods=1).max()
+    df['S1_Signal'] = signal_flag(df['S1_Final_Flag'] > 0)
+
+    # ==========================================
+    # 计算策略 2: EMA波段 (Pullback)
+    # ==========================================
+    df['VAR1'] = (df['收盘'] + df['最高'] + df['开盘'] + df['最低']) / 4
+    # 买入线：32日 EMA 下沉4%
+    df['S2_BuyLine'] = calculate_xma(df['VAR1'], 32) * (1 - 4/100)
+
+    # 信号生成
+    df['S2_Signal'] = signal_flag(df['收盘'] < df['S2_BuyLine'])
+    return df
+
 def process_stock(stock_info, start_date, end_date):
     """
     处理单只股票的所有指标和信号
@@ -81,79 +128,7 @@ def process_stock(stock_info, start_date, end_date):
         for c in ['开盘', '收盘', '最高', '最低']:
             df[c] = pd.to_numeric(df[c], errors='coerce')
 
-        # ==========================================
-        # 计算通用指标 (BBI, MA60, 波动率)
-        # ==========================================
-        # MA60
-        df['MA60'] = df['收盘'].rolling(60).mean()
-        
-        # BBI: (MA3 + MA6 + MA12 + MA24) / 4
-        ma3 = df['收盘'].rolling(3).mean()
-        ma6 = df['收盘'].rolling(6).mean()
-        ma12 = df['收盘'].rolling(12).mean()
-        ma24 = df['收盘'].rolling(24).mean()
-        df['BBI'] = (ma3 + ma6 + ma12 + ma24) / 4
-        
-        # 波动率 (20日年化波动率)
-        df['Log_Ret'] = np.log(df['收盘'] / df['收盘'].shift(1))
-        df['波动率%'] = df['Log_Ret'].rolling(20).std() * np.sqrt(252) * 100
-
-        # ==========================================
-        # 计算策略 1: 历史大底 (Deep Bottom)
-        # ==========================================
-        # 这里的参数完全保留了您提供的第一段代码逻辑
-        for p in [500, 250, 90]:
-            df[f'HHV{p}'] = df['最高'].rolling(p).max()
-            df[f'LLV{p}'] = df['最低'].rolling(p).min()
-            df[f'R_HHV{p}'] = df[f'HHV{p}'].rolling(21).mean()
-            df[f'R_LLV{p}'] = df[f'LLV{p}'].rolling(21).mean()
-            
-        df['R7'] = (df['R_LLV500']*0.96 + df['R_LLV250']*0.96 + df['R_LLV90']*0.96 + 
-                    df['R_HHV500']*0.558 + df['R_HHV250']*0.558 + df['R_HHV90']*0.558) / 6
-        df['R8'] = (df['R_LLV500']*1.25 + df['R_LLV250']*1.23 + df['R_LLV90']*1.2 + 
-                    df['R_HHV500']*0.55 + df['R_HHV250']*0.55 + df['R_HHV90']*0.65) / 6
-        df['R9'] = (df['R_LLV500']*1.3 + df['R_LLV250']*1.3 + df['R_LLV90']*1.3 + 
-                    df['R_HHV500']*0.68 + df['R_HHV250']*0.68 + df['R_HHV90']*0.68) / 6
-        
-        # 核心基准线 RA
-        df['RA'] = (df['R7']*3 + df['R8']*2 + df['R9']) / 6 * 1.738
-        df['RA'] = df['RA'].rolling(21).mean()
-        
-        # 情绪指标 RC & RD
-        df['RB'] = df['最低'].shift(1)
-        df['ABS_LOW_RB'] = (df['最低'] - df['RB']).abs()
-        df['MAX_LOW_RB'] = (df['最低'] - df['RB']).clip(lower=0)
-        df['SMA_ABS'] = sma(df['ABS_LOW_RB'], 3, 1)
-        df['SMA_MAX'] = sma(df['MAX_LOW_RB'], 3, 1)
-        
-        # 防止除零错误
-        with np.errstate(divide='ignore', invalid='ignore'):
-            df['RC'] = np.where(df['SMA_MAX'] != 0, (df['SMA_ABS'] / df['SMA_MAX']) * 100, 0)
-        
-        df['RD'] = np.where(df['收盘']*1.35 <= df['RA'], df['RC']*10, df['RC']/10)
-        df['RD'] = df['RD'].rolling(3).mean()
-        df['RE'] = df['最低'].rolling(30).min()
-        df['RF'] = df['RD'].rolling(30).max()
-        
-        # 信号判定
-        df['R10'] = df['收盘'].rolling(58).mean().notna().astype(int)
-        raw_signal = np.where(df['最低'] <= df['RE'], (df['RD'] + df['RF']*2)/2, 0)
-        df['S1_Raw_Val'] = raw_signal * df['R10']
-        df['S1_Trigger'] = (df['S1_Raw_Val'] > 0).astype(int)
-        
-        # *** 信号优化：连续标记3天 (如果今天、昨天、前天触发，今天都标Y) ***
-        df['S1_Final_Flag'] = df['S1_Trigger'].rolling(window=3, min_periods=1).max()
-        df['策略1_大底信号'] = np.where(df['S1_Final_Flag'] > 0, 'Y', '')
-
-        # ==========================================
-        # 计算策略 2: EMA波段 (Pullback)
-        # ==========================================
-        df['VAR1'] = (df['收盘'] + df['最高'] + df['开盘'] + df['最低']) / 4
-        # 买入线：32日 EMA 下沉4%
-        df['S2_BuyLine'] = calculate_xma(df['VAR1'], 32) * (1 - 4/100)
-        
-        # 信号生成
-        df['策略2_波段信号'] = np.where(df['收盘'] < df['S2_BuyLine'], 'Y', '')
+        df = compute_signals(df)
 
         # ==========================================
         # 数据截取与输出构建
@@ -165,7 +140,8 @@ def process_stock(stock_info, start_date, end_date):
             return None
 
         output_list = []
-        for date, row in result_df.iterrows():
+        # 信号列已是整数，按 object 逐行取值，避免整行被提升为 float64 后 round 的进位结果变化
+        for date, row in result_df.astype(object).iterrows():
             output_list.append({
                 '股票代码': stock_info['code'],
                 '股票简称': stock_info['name'],      # 对应 B列
@@ -174,8 +150,8 @@ def process_stock(stock_info, start_date, end_date):
                 '类型': stock_info['type'],         # 对应 E列
                 '日期': date.strftime('%Y-%m-%d'),
                 '收盘价': round(row['收盘'], 2),
-                '策略1_大底(连续3天)': row['策略1_大底信号'],
-                '策略2_波段(跌破)': row['策略2_波段信号'],
+                '策略1_大底(连续3天)': render_signal(row['S1_Signal'], 'Y'),
+                '策略2_波段(跌破)': render_signal(row['S2_Signal'], 'Y'),
                 'BBI': round(row['BBI'], 2),
                 'MA60': round(row['MA60'], 2),
                 '波动率(%)': round(row['波动率%'], 2)
@@ -205,26 +181,8 @@ if __name__ == '__main__':
 
     print(f"正在读取 {input_file} ...")
     try:
-        # 使用 usecols 读取 A-E 列
-        meta_df = pd.read_excel(input_file, usecols=[0, 1, 2, 3, 4])
-        meta_df.columns = ['code', 'name', 'industry', 'area', 'type']
-        
-        # ==========================================
-        # 【关键修复】过滤空行
-        # ==========================================
-        # 1. 删除代码列为空的行
-        meta_df.dropna(subset=['code'], inplace=True)
-        # 2. 删除代码列为空字符的行
-        meta_df = meta_df[meta_df['code'].astype(str).str.strip() != '']
-        
-        # 数据清洗：
-        # 有时候Excel读取数字会变成 600519.0 (浮点数)，需要去掉 .0
-        meta_df['code'] = meta_df['code'].astype(str).str.replace(r'\.0$', '', regex=True)
-        # 补齐6位
-        meta_df['code'] = meta_df['code'].str.zfill(6)
-        
-        # 构建待处理列表
-        stock_list = meta_df.to_dict('records')
+        # 股票列表走编译好的注册表 universe.npy (表格未变化时不再重新解析 xlsx)
+        stock_list = load_stock_list()
         
         # 打印修正后的数量，这里应该显示 570 左右
         print(f"成功加载 {len(stock_list)} 只有效股票信息。")
@@ -6,13 +6,38 @@ from multiprocessing import Pool, cpu_count
 import time
 import itertools
 import warnings
+from history_store import STORE_DIR, store_exists, list_history_codes, load_history
+from universe import limit_pct, lot_array
+from indicators import cached_indicators, main_wave_specs
+from panel_engine import load_bars, main_wave_signals, long_table
+from compact import compact_table, report_compaction
+from grid_pool import shared_table, iter_columns, run_sharded
+from grid_batch import BatchPortfolios, scan, last_close, split_batches
+from grid_prune import STAT_COLUMNS, trade_stats, select_combos, report_pruning
+from match_engine import build_book, plan_trades
+from stock_backtest_pro import main_wave_exit
 warnings.filterwarnings('ignore')
 
 # --- 配置区域 ---
-HISTORY_DATA_DIR = "./history_data"
+HISTORY_STORE_DIR = STORE_DIR
 OUTPUT_DIR = "./"
 INITIAL_CAPITAL = 1_000_000.0
 NUM_CORES = max(1, cpu_count() - 1)
+MAIN_WAVE_SPECS = main_wave_specs(min_periods=1)  # 与原 rolling(n, min_periods=1) 写法一致
+USE_PANEL_ENGINE = True   # True: 面板引擎一次性计算全部股票；False: 退回逐只 DataFrame 多进程预处理
+USE_BATCH_SIMULATOR = True  # True: 每批组合共用一次长表扫描、按掩码同时推进 (见 grid_batch.py)；False: 每个组合单独扫描一遍
+PRUNE_MODE = None          # 两阶段寻优：None 全量精确撮合；'top' 粗筛后取平均每笔收益前 PRUNE_TOP_N 名；'pareto' 取 (平均收益, 胜率) 的帕累托前沿；两种方式都可能剪掉最优组合 (见 grid_prune.py)
+PRUNE_TOP_N = 50
+PRUNE_MIN_TRADES = 30      # 粗筛交易笔数少于此数的组合视为样本不足，直接剪掉
+USE_COMPACT_DTYPES = False  # True: 撮合前把长表压成 float32 价格 / 分类股票代码 / 位打包信号 (见 compact.py)，数值误差在 float32 舍入以内
+# 预处理输出列 -> 枚举时使用的英文列名
+SIGNAL_COLUMNS = {'日期': 'date', '股票代码': 'code', '开盘': 'open', '收盘': 'close', 'MA20_ANGLE': 'angle',
+                  'BASE_BUY': 'base_buy', 'SELL_SIGNAL': 'sell_signal', 'is_limit_up': 'is_limit_up', 'is_limit_down': 'is_limit_down'}
+# 粗筛用的撮合引擎字段 -> 长表列名
+SCREEN_COLUMNS = {'open': 'open', 'close': 'close', 'angle': 'angle', 'buy': 'base_buy', 'sell': 'sell_signal',
+                  'limit_up': 'is_limit_up', 'limit_down': 'is_limit_down'}
+# 枚举撮合逐行读取的列 (顺序即 simulate_combo 中的解包顺序)
+GRID_COLUMNS = ['code', 'open', 'close', 'angle', 'base_buy', 'sell_signal', 'is_limit_up', 'is_limit_down']
 
 def parse_input_list(prompt, type_func):
     """解析用户输入的逗号分隔的参数列表"""
@@ -44,23 +69,16 @@ def get_user_inputs():
 
 def process_single_stock_file(args):
     """单只股票数据预处理（一次性计算好，供后续快速枚举）"""
-    file, start_date, end_date = args
-    filepath = os.path.join(HISTORY_DATA_DIR, file)
+    stock_code, start_date, end_date = args
     try:
-        df = pd.read_csv(filepath)
-        df['日期'] = pd.to_datetime(df['日期'])
-        df.sort_values('日期', inplace=True)
+        # 仓库中的数据已是按日期升序的 datetime64 / float64，无需再解析
+        df = load_history(stock_code, HISTORY_STORE_DIR)
 
-        if len(df) < 60: return None
+        if df is None or len(df) < 60: return None
 
-        for c in ['开盘', '收盘', '最高', '最低', '成交量']:
-            df[c] = pd.to_numeric(df[c], errors='coerce')
-
-        df['MA5'] = df['收盘'].rolling(5, min_periods=1).mean()
-        df['MA10'] = df['收盘'].rolling(10, min_periods=1).mean()
-        df['MA20'] = df['收盘'].rolling(20, min_periods=1).mean()
-        df['MA60'] = df['收盘'].rolling(60, min_periods=1).mean()
-        df['VOL_MA5'] = df['成交量'].rolling(5, min_periods=1).mean()
+        # 均线 / 均量 / MACD 走公共指标库 (按内容哈希缓存，数据未变的股票直接读缓存)
+        for name, values in cached_indicators(df, MAIN_WAVE_SPECS, stock_code).items():
+            df[name] = values
 
         # 预先计算独立于参数的指标
         df['MA20_ANGLE'] = np.degrees(np.arctan((df['MA20'] / df['MA20'].shift(1) - 1) * 100))
@@ -68,8 +86,6 @@ def process_single_stock_file(args):
         cond_power = (df['收盘'] / df['收盘'].shift(1) > 1.03) & (df['收盘'] > df['开盘'])
         cond_vol = df['成交量'] > df['VOL_MA5']
 
-        df['DIF'] = df['收盘'].ewm(span=12, adjust=False).mean() - df['收盘'].ewm(span=26, adjust=False).mean()
-        df['DEA'] = df['DIF'].ewm(span=9, adjust=False).mean()
         cond_macd = (df['DIF'] > 0) & (df['DIF'] > df['DEA'])
 
         # 基础买入条件 (不含斜率阈值，斜率在枚举时动态判断)
@@ -80,8 +96,7 @@ def process_single_stock_file(args):
         ma20_bad = (df['MA20_ANGLE'] < 0) & (df['收盘'] < df['MA20'])
         df['SELL_SIGNAL'] = cross_ma10 | ma20_bad
         # =================【新增：涨跌停判定】=================
-        stock_code = file.replace('.csv', '')
-        limit_threshold = 19.8 if stock_code.startswith('688') or stock_code.startswith('30') else 9.8
+        limit_threshold = limit_pct(stock_code)
         df['pct_change'] = (df['收盘'] / df['收盘'].shift(1) - 1) * 100
         df['is_limit_up'] = df['pct_change'] >= limit_threshold
         df['is_limit_down'] = df['pct_change'] <= -limit_threshold
@@ -91,139 +106,216 @@ def process_single_stock_file(args):
         
         if df.empty: return None
 
-        df['股票代码'] = file.replace('.csv', '')
+        df['股票代码'] = stock_code
         
         # 英文列名以便于极速迭代器 itertuples 调用
-        df = df[['日期', '股票代码', '开盘', '收盘', 'MA20_ANGLE', 'BASE_BUY', 'SELL_SIGNAL', 'is_limit_up', 'is_limit_down']]
-        df.columns = ['date', 'code', 'open', 'close', 'angle', 'base_buy', 'sell_signal', 'is_limit_up', 'is_limit_down']
+        df = df[list(SIGNAL_COLUMNS)]
+        df.columns = list(SIGNAL_COLUMNS.values())
         return df.copy()
 
         
     except Exception:
         return None
 
+def simulate_combo(table, combo):
+    """单个参数组合的全量撮合 (在进程池子进程中运行)，返回 (绝对盈亏, 总收益率%, 总交易笔数, 胜率%)"""
+    tp_pct, sl_pct, max_days, slope_thresh = combo
+    lots = table['extra']['lots']
+    
+    cash = INITIAL_CAPITAL
+    holdings = {}
+    total_trades = 0
+    winning_trades = 0
+    last_close_prices = {} # 用于记录期末未平仓股票的最新价
+    
+    tp_ratio = tp_pct / 100.0
+    sl_ratio = sl_pct / 100.0
+    
+    # 极速遍历算法
+    for stock, open_price, close_price, angle, base_buy, sell_signal, is_limit_up, is_limit_down in iter_columns(table, GRID_COLUMNS, decode_codes=False):
+        # 更新股票的最新价格
+        last_close_prices[stock] = close_price
+        
+        # --- 卖出判断 ---
+        if stock in holdings:
+            info = holdings[stock]
+            info['days_held'] += 1
+            sell_reason = False
+            
+            if open_price != 0:
+                profit_ratio = (open_price / info['buy_price']) - 1
+                if profit_ratio >= tp_ratio or profit_ratio <= -sl_ratio:
+                    sell_reason = True
+            
+            if not sell_reason and (info['days_held'] >= max_days or sell_signal):
+                sell_reason = True
+                
+            if sell_reason:
+                # 【新增跌停拦截】
+                if is_limit_down:
+                    continue # 🔒跌停无法卖出，强制继续持有
+                # 判断是以开盘价还是收盘价卖出
+                if open_price != 0 and (profit_ratio >= tp_ratio or profit_ratio <= -sl_ratio):
+                    sell_price = open_price
+                else:
+                    sell_price = close_price
+                    
+                proceeds = info['shares'] * sell_price
+                cash += proceeds
+                
+                pnl_percent = (sell_price / info['buy_price'] - 1) * 100
+                total_trades += 1
+                if pnl_percent > 0: winning_trades += 1
+                    
+                del holdings[stock]
+        
+        # --- 买入判断 ---
+        # 动态判定当前斜率是否大于本轮枚举的阈值
+        buy_signal = base_buy and (angle > slope_thresh)
+        
+        if buy_signal and stock not in holdings:
+            # 【新增涨停拦截】
+            if is_limit_up:
+                continue # 🚫涨停无法买入，直接跳过
+            min_lot = lots[stock]
+            
+            max_shares = int(min(INITIAL_CAPITAL * 0.20, cash) // close_price)
+            shares_to_buy = (max_shares // min_lot) * min_lot
+            
+            if shares_to_buy >= min_lot:
+                cash -= shares_to_buy * close_price
+                holdings[stock] = {
+                    'shares': shares_to_buy,
+                    'buy_price': close_price,
+                    'days_held': 0
+                }
+                
+    # 计算本轮组合的最终净值
+    final_value = cash
+    for stock, info in holdings.items():
+        final_value += info['shares'] * last_close_prices.get(stock, info['buy_price'])
+        
+    total_pnl = final_value - INITIAL_CAPITAL
+    return_pct = (final_value / INITIAL_CAPITAL - 1) * 100
+    win_rate = (winning_trades / total_trades * 100) if total_trades > 0 else 0.0
+    return total_pnl, return_pct, total_trades, win_rate
+
+def simulate_batch(table, combos):
+    """一批参数组合共用一次长表扫描 (见 grid_batch.py)，返回与 combos 同顺序、与 simulate_combo 逐位相同的结果"""
+    tp_pct, sl_pct, max_days, slope_thresh = (np.array(values) for values in zip(*combos))
+    tp_ratio = tp_pct / 100.0
+    sl_ratio = sl_pct / 100.0
+    lots = table['extra']['lots']
+    book = BatchPortfolios(len(combos), len(table['codes']), INITIAL_CAPITAL)
+    no_hit = np.zeros(len(combos), dtype=bool)
+    
+    # 只有本批最低斜率阈值都达不到的买点行，对所有组合都不会成交
+    candidate = table['base_buy'] & (table['angle'] > slope_thresh.min()) & ~table['is_limit_up']
+    columns = ['open', 'close', 'angle', 'base_buy', 'sell_signal', 'is_limit_up', 'is_limit_down']
+    with np.errstate(divide='ignore', invalid='ignore'):  # 未持仓组合的买入价为 0，除出来的 inf 会被持仓掩码滤掉
+        for row, s, rank, open_price, close_price, angle, base_buy, sell_signal, is_limit_up, is_limit_down in scan(table, columns, candidate, book):
+            # --- 卖出判断：止盈止损按开盘价，持仓超时 / 卖点按收盘价，跌停卖不出 ---
+            if book.held_count[s]:
+                hit = no_hit
+                if open_price != 0:
+                    profit_ratio = (open_price / book.buy_price[s]) - 1
+                    hit = (profit_ratio >= tp_ratio) | (profit_ratio <= -sl_ratio)
+                want = (book.shares[s] > 0) & (hit | (rank - book.entry_rank[s] >= max_days) | sell_signal)
+                if not is_limit_down:
+                    book.sell(s, want, np.where(hit, open_price, close_price))
+            
+            # --- 买入判断：斜率超过各自阈值且未持有，涨停买不进 ---
+            if base_buy and not is_limit_up:
+                book.buy(s, (book.shares[s] == 0) & (angle > slope_thresh), close_price, lots[s], rank, row)
+    return book.results(last_close(table))
+
+def screen_combos(master_history, combinations):
+    """
+    两阶段寻优的第一阶段：不计资金，每个候选买点都按收盘价买入一笔，返回每个组合的
+    [平均每笔收益%, 胜率%, 交易笔数] (见 grid_prune.py)。离场只与止盈 / 止损 / 期限有关，
+    同一组 (止盈, 止损, 期限) 只生成一次候选交易表，各斜率阈值从中按买入当日斜率筛选。
+    """
+    book = build_book(master_history, SCREEN_COLUMNS, code_column='code', date_column='date')
+    base_buy, angle, close = book['buy'], book['angle'], book['close']
+    stock_last_close = np.array([close[rows[-1]] for rows in book['stock_rows']])
+    by_exit = {}
+    for i, (tp_pct, sl_pct, max_days, slope_thresh) in enumerate(combinations):
+        by_exit.setdefault((tp_pct, sl_pct, max_days), []).append(i)
+    
+    returns, groups = [], []
+    for (tp_pct, sl_pct, max_days), members in by_exit.items():
+        slopes = np.array([combinations[i][3] for i in members])
+        book['buy'] = base_buy & (angle > slopes.min())
+        plan = plan_trades(book, main_wave_exit(tp_pct / 100.0, sl_pct / 100.0, max_days))
+        entry = plan['entry']
+        # 持有到最后的交易按该股票最后一根K线的收盘价估值
+        exit_price = np.where(plan['exit'] >= 0, plan['price'], stock_last_close[book['stock'][entry]])
+        trade_return = (exit_price / close[entry] - 1) * 100
+        for i, slope_thresh in zip(members, slopes):
+            hit = angle[entry] > slope_thresh
+            returns.append(trade_return[hit])
+            groups.append(np.full(int(hit.sum()), i))
+    return trade_stats(np.concatenate(returns), np.concatenate(groups), len(combinations))
+
 def run_grid_search():
     start_date, end_date, tp_list, sl_list, days_list, slope_list = get_user_inputs()
     
-    stock_files = [f for f in os.listdir(HISTORY_DATA_DIR) if f.endswith('.csv')]
+    stock_codes = list_history_codes(HISTORY_STORE_DIR)
     
-    print(f"\n📡 正在预处理 {len(stock_files)} 只股票的历史数据...")
+    print(f"\n📡 正在预处理 {len(stock_codes)} 只股票的历史数据...")
     start_time = time.time()
     
-    with Pool(processes=NUM_CORES) as pool:
-        args_list = [(file, start_date, end_date) for file in stock_files]
-        results = pool.map(process_single_stock_file, args_list)
-        
-    all_signals = [res for res in results if res is not None and not res.empty]
-    if not all_signals:
+    if USE_PANEL_ENGINE:
+        bars = load_bars(stock_codes)
+        signals = main_wave_signals(bars, min_periods=1)
+        master_history = long_table(bars, signals, list(SIGNAL_COLUMNS), start_date, end_date)
+        master_history.columns = list(SIGNAL_COLUMNS.values())
+    else:
+        with Pool(processes=NUM_CORES) as pool:
+            args_list = [(code, start_date, end_date) for code in stock_codes]
+            results = pool.map(process_single_stock_file, args_list)
+        all_signals = [res for res in results if res is not None and not res.empty]
+        master_history = pd.concat(all_signals, ignore_index=True) if all_signals else pd.DataFrame()
+
+    if master_history.empty:
         print("❌ 在指定日期范围内未找到任何数据，程序退出。")
         return
-        
-    master_history = pd.concat(all_signals, ignore_index=True)
     
     # 【核心优化】先按日期正序，同日按MA20斜率倒序！同等条件下优先买入斜率最猛的龙头！
     master_history.sort_values(by=['date', 'angle'], ascending=[True, False], inplace=True)
+
+    if USE_COMPACT_DTYPES:
+        compact_history = compact_table(master_history, code_column='code')
+        report_compaction(master_history, compact_history)
+        master_history = compact_history
     
     print(f"✅ 数据预处理完成，耗时 {time.time() - start_time:.2f} 秒。共 {len(master_history)} 条日切片数据。")
 
     # 生成所有参数组合
     combinations = list(itertools.product(tp_list, sl_list, days_list, slope_list))
+    if PRUNE_MODE:
+        screen_start = time.time()
+        stats = screen_combos(master_history, combinations)
+        keep = select_combos(stats, PRUNE_MODE, PRUNE_TOP_N, PRUNE_MIN_TRADES)
+        report_pruning(combinations, stats, keep, ['止盈(%)', '止损(%)', '最大持仓(天)', '斜率阈值(°)'], time.time() - screen_start)
+        combinations = [combinations[i] for i in keep]
+        stats = stats[keep]
     total_combos = len(combinations)
     print(f"\n⚙️ 即将开始网格搜索，共需枚举计算 {total_combos} 种参数组合...")
     
     final_results = []
-    
-    combo_count = 0
     search_start_time = time.time()
     
-    # 开始枚举计算
-    for tp_pct, sl_pct, max_days, slope_thresh in combinations:
-        combo_count += 1
-        print(f"正在计算 [{combo_count}/{total_combos}] -> 止盈:{tp_pct}%, 止损:{sl_pct}%, 期限:{max_days}天, 斜率:{slope_thresh}°", end='\r')
-        
-        cash = INITIAL_CAPITAL
-        holdings = {}
-        total_trades = 0
-        winning_trades = 0
-        last_close_prices = {} # 用于记录期末未平仓股票的最新价
-        
-        tp_ratio = tp_pct / 100.0
-        sl_ratio = sl_pct / 100.0
-        
-        # 极速遍历算法
-        for row in master_history.itertuples(index=False):
-            code = row.code
-            close_price = row.close
-            open_price = row.open
-            is_limit_up = row.is_limit_up
-            is_limit_down = row.is_limit_down
-            # 更新股票的最新价格
-            last_close_prices[code] = close_price
-            
-            # --- 卖出判断 ---
-            if code in holdings:
-                info = holdings[code]
-                info['days_held'] += 1
-                sell_reason = False
-                
-                if open_price != 0:
-                    profit_ratio = (open_price / info['buy_price']) - 1
-                    if profit_ratio >= tp_ratio or profit_ratio <= -sl_ratio:
-                        sell_reason = True
-                
-                if not sell_reason and (info['days_held'] >= max_days or row.sell_signal):
-                    sell_reason = True
-                    
-                if sell_reason:
-                    # 【新增跌停拦截】
-                    if is_limit_down:
-                        continue # 🔒跌停无法卖出，强制继续持有
-                    # 判断是以开盘价还是收盘价卖出
-                    if open_price != 0 and (profit_ratio >= tp_ratio or profit_ratio <= -sl_ratio):
-                        sell_price = open_price
-                    else:
-                        sell_price = close_price
-                        
-                    proceeds = info['shares'] * sell_price
-                    cash += proceeds
-                    
-                    pnl_percent = (sell_price / info['buy_price'] - 1) * 100
-                    total_trades += 1
-                    if pnl_percent > 0: winning_trades += 1
-                        
-                    del holdings[code]
-            
-            # --- 买入判断 ---
-            # 动态判定当前斜率是否大于本轮枚举的阈值
-            buy_signal = row.base_buy and (row.angle > slope_thresh)
-            
-            if buy_signal and code not in holdings:
-                # 【新增涨停拦截】
-                if is_limit_up:
-                    continue # 🚫涨停无法买入，直接跳过
-                code_str = str(code).zfill(6)
-                min_lot = 200 if code_str.startswith('688') else 100
-                
-                max_shares = int(min(INITIAL_CAPITAL * 0.20, cash) // close_price)
-                shares_to_buy = (max_shares // min_lot) * min_lot
-                
-                if shares_to_buy >= min_lot:
-                    cash -= shares_to_buy * close_price
-                    holdings[code] = {
-                        'shares': shares_to_buy,
-                        'buy_price': close_price,
-                        'days_held': 0
-                    }
-                    
-        # 计算本轮组合的最终净值
-        final_value = cash
-        for code, info in holdings.items():
-            final_value += info['shares'] * last_close_prices.get(code, info['buy_price'])
-            
-        total_pnl = final_value - INITIAL_CAPITAL
-        return_pct = (final_value / INITIAL_CAPITAL - 1) * 100
-        win_rate = (winning_trades / total_trades * 100) if total_trades > 0 else 0.0
-        
+    # 参数组合分片到进程池并行枚举，长表写成只读内存映射供各子进程共享
+    with shared_table(master_history, GRID_COLUMNS, code_column='code') as meta:
+        meta['extra']['lots'] = lot_array(meta['codes']).tolist()  # 按共享长表的股票编号排列，取自注册表
+        if USE_BATCH_SIMULATOR:
+            batches = split_batches(combinations, NUM_CORES)
+            metrics = [m for batch in run_sharded(simulate_batch, batches, meta, NUM_CORES) for m in batch]
+        else:
+            metrics = run_sharded(simulate_combo, combinations, meta, NUM_CORES)
+    
+    for (tp_pct, sl_pct, max_days, slope_thresh), (total_pnl, return_pct, total_trades, win_rate) in zip(combinations, metrics):
         final_results.append({
             '回测开始日期': start_date,
             '回测结束日期': end_date,
@@ -236,6 +328,9 @@ def run_grid_search():
             '总交易笔数': total_trades,
             '胜率(%)': round(win_rate, 2)
         })
+    if PRUNE_MODE:
+        for row, (mean_return, win_rate, count) in zip(final_results, stats.tolist()):
+            row.update(zip(STAT_COLUMNS, (round(mean_return, 2), round(win_rate, 2), int(count))))
 
     print(f"\n\n🎉 网格搜索计算完成！总计耗时 {time.time() - search_start_time:.2f} 秒。")
     
@@ -254,7 +349,7 @@ def run_grid_search():
     print(f"📄 完整的全量枚举结果已保存至: {csv_filename}")
 
 if __name__ == "__main__":
-    if not os.path.exists(HISTORY_DATA_DIR):
-        print(f"错误: 找不到 {HISTORY_DATA_DIR} 目录。请先运行下载脚本！")
+    if not store_exists(HISTORY_STORE_DIR):
+        print(f"错误: 找不到历史数据仓库 {HISTORY_STORE_DIR}。请先运行 download_history.py 下载，或用 python3 history_store.py import 从 CSV 导入！")
         exit()
     run_grid_search()
\ No newline at end of file
@@ -5,17 +5,30 @@ from datetime import datetime
 from multiprocessing import Pool, cpu_count
 import time
 import warnings
+from history_store import STORE_DIR, store_exists, list_history_codes, load_history
+from universe import limit_pct
+from indicators import cached_indicators, main_wave_specs
+from panel_engine import load_bars, main_wave_signals, long_table
+from compact import compact_table, report_compaction
+from match_engine import build_book, plan_trades, allocate, portfolio_value
 warnings.filterwarnings('ignore') # 忽略pandas的一些计算警告
 
 # --- 配置区域 ---
-# 数据文件存放的根目录 (请确保与您下载历史数据的目录一致)
-HISTORY_DATA_DIR = "./history_data"
+# 历史数据列式仓库目录 (download_history.py 直接写入，或用 history_store.py import 从 CSV 导入)
+HISTORY_STORE_DIR = STORE_DIR
 # 结果文件保存目录
 OUTPUT_DIR = "./"
 # 初始资金
 INITIAL_CAPITAL = 1_000_000.0
 # 使用的核心数量 (留1个核心给系统防卡顿)
 NUM_CORES = max(1, cpu_count() - 1) 
+MAIN_WAVE_SPECS = main_wave_specs(min_periods=1)  # 与原 rolling(n, min_periods=1) 写法一致
+USE_PANEL_ENGINE = True   # True: 面板引擎一次性计算全部股票；False: 退回逐只 DataFrame 多进程预处理
+USE_COMPACT_DTYPES = False  # True: 撮合前把长表压成 float32 价格 / 分类股票代码 / 位打包信号 (见 compact.py)，数值误差在 float32 舍入以内
+SIGNAL_COLUMNS = ['日期', '股票代码', '开盘', '收盘', '最高', '最低', '成交量', 'MA20_ANGLE', 'BUY_SIGNAL', 'SELL_SIGNAL', 'is_limit_up', 'is_limit_down']
+# 撮合引擎字段 -> 长表列名
+BOOK_COLUMNS = {'open': '开盘', 'close': '收盘', 'buy': 'BUY_SIGNAL', 'sell': 'SELL_SIGNAL',
+                'limit_up': 'is_limit_up', 'limit_down': 'is_limit_down'}
 
 def get_user_inputs():
     """获取用户输入的回测参数"""
@@ -32,25 +45,18 @@ def get_user_inputs():
 
 def process_single_stock_file(args):
     """单只股票处理引擎：100% 对齐通达信 RIGHT_SIDE_PRO 公式"""
-    file, start_date, end_date, slope_threshold = args
-    filepath = os.path.join(HISTORY_DATA_DIR, file)
+    stock_code, start_date, end_date, slope_threshold = args
     try:
-        df = pd.read_csv(filepath)
-        df['日期'] = pd.to_datetime(df['日期'])
-        df.sort_values('日期', inplace=True)
+        # 仓库中的数据已是按日期升序的 datetime64 / float64，无需再解析
+        df = load_history(stock_code, HISTORY_STORE_DIR)
 
-        if len(df) < 60:
+        if df is None or len(df) < 60:
             return None
 
-        for c in ['开盘', '收盘', '最高', '最低', '成交量']:
-            df[c] = pd.to_numeric(df[c], errors='coerce')
-
         # ========== 基础均线 ==========
-        df['MA5'] = df['收盘'].rolling(5, min_periods=1).mean()
-        df['MA10'] = df['收盘'].rolling(10, min_periods=1).mean()
-        df['MA20'] = df['收盘'].rolling(20, min_periods=1).mean()
-        df['MA60'] = df['收盘'].rolling(60, min_periods=1).mean()
-        df['VOL_MA5'] = df['成交量'].rolling(5, min_periods=1).mean()
+        # 均线 / 均量 / MACD 走公共指标库 (按内容哈希缓存，数据未变的股票直接读缓存)
+        for name, values in cached_indicators(df, MAIN_WAVE_SPECS, stock_code).items():
+            df[name] = values
 
         # ========== 核心逻辑 ==========
         
@@ -71,9 +77,7 @@ def process_single_stock_file(args):
         cond_vol = df['成交量'] > df['VOL_MA5']
 
         # 5. MACD 水上金叉/多头
-        # 注意：通达信的 EMA 等同于 Pandas的 ewm(adjust=False)
-        df['DIF'] = df['收盘'].ewm(span=12, adjust=False).mean() - df['收盘'].ewm(span=26, adjust=False).mean()
-        df['DEA'] = df['DIF'].ewm(span=9, adjust=False).mean()
+        # 注意：通达信的 EMA 等同于 Pandas的 ewm(adjust=False)，DIF/DEA 已由指标库算好
         cond_macd = (df['DIF'] > 0) & (df['DIF'] > df['DEA'])
 
         # ========== 最终买点 ==========
@@ -88,8 +92,7 @@ def process_single_stock_file(args):
         df['SELL_SIGNAL'] = cross_ma10 | ma20_bad
 
         # ========== 涨跌停判定 (新增) ==========
-        stock_code = file.replace('.csv', '')
-        limit_threshold = 19.8 if stock_code.startswith('688') or stock_code.startswith('30') else 9.8
+        limit_threshold = limit_pct(stock_code)
         df['pct_change'] = (df['收盘'] / df['收盘'].shift(1) - 1) * 100
         df['is_limit_up'] = df['pct_change'] >= limit_threshold
         df['is_limit_down'] = df['pct_change'] <= -limit_threshold
@@ -103,133 +106,69 @@ def process_single_stock_file(args):
 
         df['股票代码'] = stock_code
         # 修改后：把 is_limit_up 和 is_limit_down 一起传给回测引擎
-        return df[['日期', '股票代码', '开盘', '收盘', '最高', '最低', '成交量', 'MA20_ANGLE', 'BUY_SIGNAL', 'SELL_SIGNAL', 'is_limit_up', 'is_limit_down']].copy()
+        return df[SIGNAL_COLUMNS].copy()
        
         
     except Exception as e:
         return None
 
-def run_backtest(stock_files, start_date, end_date, take_profit_pct, stop_loss_pct, max_holding_days, slope_threshold):
-    print(f"\n🚀 开始并行处理 {len(stock_files)} 个股票文件...")
+def main_wave_exit(take_profit_pct, stop_loss_pct, max_holding_days):
+    """主升浪离场规则 (优先级)：开盘价止盈 / 止损 > 持仓超时 > 策略S点 (破均线)；止盈止损按开盘价成交，其余按收盘价 (对一组候选交易向量化求值)"""
+    def rule(book, rows, days, holding):
+        open_price = book['open'][rows]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            profit_ratio = open_price / holding['buy_price'] - 1
+        has_open = open_price != 0
+        take_profit = has_open & (profit_ratio >= take_profit_pct)
+        stop_loss = has_open & ~take_profit & (profit_ratio <= -stop_loss_pct)
+        timeout = days >= max_holding_days
+        want = take_profit | stop_loss | timeout | book['sell'][rows]
+
+        def describe(i):
+            reason = np.select([take_profit[i], stop_loss[i], timeout[i]],
+                               ["止盈", "止损", f"超时强平({max_holding_days}天)"], "策略S点(破均线)")
+            price = np.where(take_profit[i] | stop_loss[i], open_price[i], book['close'][rows[i]])
+            return reason, price
+        return want, describe
+    return rule
+
+def run_backtest(stock_codes, start_date, end_date, take_profit_pct, stop_loss_pct, max_holding_days, slope_threshold):
+    print(f"\n🚀 开始并行处理 {len(stock_codes)} 只股票...")
     start_time = time.time()
 
-    args_list = [(file, start_date, end_date, slope_threshold) for file in stock_files]
-
-    with Pool(processes=NUM_CORES) as pool:
-        results = pool.map(process_single_stock_file, args_list)
+    if USE_PANEL_ENGINE:
+        bars = load_bars(stock_codes)
+        signals = main_wave_signals(bars, min_periods=1, slope_threshold=slope_threshold)
+        full_history = long_table(bars, signals, SIGNAL_COLUMNS, start_date, end_date)
+    else:
+        args_list = [(code, start_date, end_date, slope_threshold) for code in stock_codes]
+        with Pool(processes=NUM_CORES) as pool:
+            results = pool.map(process_single_stock_file, args_list)
+        all_signals = [result for result in results if result is not None and not result.empty]
+        full_history = pd.concat(all_signals, ignore_index=True) if all_signals else pd.DataFrame()
     
     print(f"✅ 数据处理完成，耗时 {time.time() - start_time:.2f} 秒。开始撮合交易...")
 
-    all_signals = [result for result in results if result is not None and not result.empty]
-    if not all_signals:
+    if full_history.empty:
         print("❌ 在指定日期范围内没有找到任何有效数据。")
         return
 
-    full_history = pd.concat(all_signals, ignore_index=True)
     # 修改后：按日期正序，同日按斜率倒序，优先买入最猛的龙头！
     full_history.sort_values(by=['日期', 'MA20_ANGLE'], ascending=[True, False], inplace=True)
 
-    cash = INITIAL_CAPITAL
-    holdings = {} 
-    trade_log = [] 
-
-    for index, row in full_history.iterrows():
-        current_date = row['日期']
-        stock_code = row['股票代码']
-        buy_signal = row['BUY_SIGNAL']
-        sell_signal = row['SELL_SIGNAL']
-        open_price = row['开盘']
-        close_price = row['收盘']
-        is_limit_up = row['is_limit_up']       # <--- 新增
-        is_limit_down = row['is_limit_down']   # <--- 新增
-
-        # --- 1. 检查卖出条件 ---
-        if stock_code in holdings:
-            holding_info = holdings[stock_code]
-            holding_info['days_held'] += 1
-            sell_reason = ""
-            
-            if open_price != 0:
-                profit_ratio = (open_price / holding_info['buy_price']) - 1
-                if profit_ratio >= take_profit_pct: sell_reason = "止盈"
-                elif profit_ratio <= -stop_loss_pct: sell_reason = "止损"
-
-            if not sell_reason and holding_info['days_held'] >= max_holding_days:
-                sell_reason = f"超时强平({max_holding_days}天)"
-
-            if not sell_reason and sell_signal:
-                sell_reason = "策略S点(破均线)"
-            
-            if sell_reason:
-                if is_limit_down:
-                    continue # 🔒【新增】跌停板锁死，今天想卖也卖不掉，硬扛到明天！
-                shares_to_sell = holding_info['shares']
-                sell_price = open_price if sell_reason in ["止盈", "止损"] else close_price
-                proceeds = shares_to_sell * sell_price
-                
-                cash += proceeds
-                pnl_amount = proceeds - holding_info['cost_basis']
-                pnl_percent = (sell_price / holding_info['buy_price'] - 1) * 100
-
-                trade_log.append({
-                    "Date": current_date.strftime('%Y-%m-%d'),
-                    "StockCode": stock_code,
-                    "Action": "SELL",
-                    "Shares": shares_to_sell,
-                    "Price": round(sell_price, 2),
-                    "Amount": round(proceeds, 2),
-                    "PnL_Amount": round(pnl_amount, 2),
-                    "PnL_Percent": round(pnl_percent, 2),
-                    "Reason": sell_reason,
-                    "Cash_Remaining": round(cash, 2)
-                })
-                del holdings[stock_code]
-
-        # --- 2. 检查买入条件 ---
-        if buy_signal and stock_code not in holdings:
-            if is_limit_up:
-                continue # 🚫【新增】涨停板封死，买不进，直接跳过寻找下一个！
-            stock_code_str = str(stock_code).zfill(6)
-            price_to_buy = close_price 
-            
-            min_lot_size = 200 if stock_code_str.startswith('688') else 100
-            # 严格风控：单只股票最多占用总资金的 20%
-            max_shares_for_20_percent = int((INITIAL_CAPITAL * 0.20) // price_to_buy)
-            max_shares_for_cash = int(cash // price_to_buy)
-            shares_before_rounding = min(max_shares_for_20_percent, max_shares_for_cash)
-            
-            shares_to_buy = (shares_before_rounding // min_lot_size) * min_lot_size
-            
-            if shares_to_buy >= min_lot_size:
-                cost = shares_to_buy * price_to_buy
-                cash -= cost
-
-                holdings[stock_code] = {
-                    'shares': shares_to_buy,
-                    'buy_price': price_to_buy,
-                    'buy_date': current_date,
-                    'days_held': 0,
-                    'cost_basis': cost
-                }
-
-                trade_log.append({
-                    "Date": current_date.strftime('%Y-%m-%d'),
-                    "StockCode": stock_code,
-                    "Action": "BUY",
-                    "Shares": shares_to_buy,
-                    "Price": round(price_to_buy, 2),
-                    "Amount": round(cost, 2),
-                    "PnL_Amount": 0,
-                    "PnL_Percent": 0,
-                    "Reason": "主升浪启动",
-                    "Cash_Remaining": round(cash, 2)
-                })
+    if USE_COMPACT_DTYPES:
+        compact_history = compact_table(full_history, code_column='股票代码')
+        report_compaction(full_history, compact_history)
+        full_history = compact_history
 
-    # --- 回测结束计算 ---
-    final_value = cash
-    for stock, info in holdings.items():
-        last_close = full_history[full_history['股票代码']==stock]['收盘'].iloc[-1]
-        final_value += info['shares'] * last_close
+    # 两步撮合：先向量化算出全部候选交易 (只与参数有关)，再按日期顺序套用资金约束，流水与逐行循环完全一致
+    match_start = time.time()
+    book = build_book(full_history, BOOK_COLUMNS)
+    plan = plan_trades(book, main_wave_exit(take_profit_pct, stop_loss_pct, max_holding_days))
+    plan_time = time.time() - match_start
+    trade_log, cash, holdings = allocate(book, plan, INITIAL_CAPITAL, "主升浪启动")
+    final_value = portfolio_value(book, cash, holdings)
+    print(f"✅ 撮合完成，耗时 {time.time() - match_start:.2f} 秒 (候选交易 {len(plan['entry'])} 笔，生成耗时 {plan_time:.2f} 秒)。")
 
     total_pnl = final_value - INITIAL_CAPITAL
     total_return_pct = (final_value / INITIAL_CAPITAL - 1) * 100
@@ -260,10 +199,10 @@ def run_backtest(stock_files, start_date, end_date, take_profit_pct, stop_loss_p
         print("\n⚠️ 在本次回测期间内没有产生任何满足要求的交易。")
 
 if __name__ == "__main__":
-    if not os.path.exists(HISTORY_DATA_DIR):
-        print(f"错误: 找不到历史数据目录 {HISTORY_DATA_DIR}。请先运行下载脚本获取数据！")
+    if not store_exists(HISTORY_STORE_DIR):
+        print(f"错误: 找不到历史数据仓库 {HISTORY_STORE_DIR}。请先运行 download_history.py 下载，或用 python3 history_store.py import 从 CSV 导入！")
         exit()
         
     start_date, end_date, take_profit_pct, stop_loss_pct, max_holding_days, slope_threshold = get_user_inputs()
-    stock_files = [f for f in os.listdir(HISTORY_DATA_DIR) if f.endswith('.csv')]
-    run_backtest(stock_files, start_date, end_date, take_profit_pct, stop_loss_pct, max_holding_days, slope_threshold)
\ No newline at end of file
+    stock_codes = list_history_codes(HISTORY_STORE_DIR)
+    run_backtest(stock_codes, start_date, end_date, take_profit_pct, stop_loss_pct, max_holding_days, slope_threshold)
\ No newline at end of file
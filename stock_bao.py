@@ -8,32 +8,21 @@ import plotly.io as pio
 import plotly.express as px
 import pandas as pd
 from concurrent.futures import ThreadPoolExecutor, as_completed
+from market_data import get_daily_bars
+from universe import load_stock_list, baostock_code
+from indicators import sma, rolling_extrema, cached_indicators, main_wave_specs, signal_flag, signal_streak, render_signal
+from indicator_state import advance
+
+# --- 指标配置 ---
+SCREENER_SPECS = {**main_wave_specs(), 'VAR1': ('VAR1',)}  # 与原 rolling(n) 写法一致 (窗口未满为 NaN)
+# True: 单日选股时用持久化的逐日指标状态 (indicator_state.py 'bao' 口径) 只推进新K线；False: 每天整段重算
+# 'bao' 口径经 replay_signals.py 回放与整段重算逐日一致；多日区间仍走整段重算
+USE_INDICATOR_STATE = False
 
 # ==========================================
 # 1. 核心算法函数定义 (保持不变)
 # ==========================================
 
-def sma(series, n, m):
-    """
-    策略1核心：通达信SMA递归算法
-    """
-    sma_values = []
-    series_array = series.values
-    val = np.nan
-    for i, x in enumerate(series_array):
-        if i < n - 1:
-            sma_values.append(np.nan)
-        elif i == n - 1:
-            val = np.nanmean(series_array[:n])
-            sma_values.append(val)
-        else:
-            if np.isnan(val):
-                val = np.nanmean(series_array[:i+1])
-            else:
-                val = (x * m + val * (n - m)) / n
-            sma_values.append(val)
-    return pd.Series(sma_values, index=series.index)
-
 def calculate_xma(series, window):
     """策略2核心：EMA算法 (XMA)"""
     return series.ewm(span=window, adjust=False).mean()
@@ -41,162 +30,162 @@ def calculate_xma(series, window):
 # ==========================================
 # 2. 单只股票处理引擎 (保持 qfq 修正)
 # ==========================================
+def fetch_full_history(symbol, fetch_start, fetch_end):
+    """整段从 Baostock 下载前复权日线 (本地仓库缺失或复权校验失败时的回退路径)"""
+    # adjustflag="2" 是前复权
+    rs = bs.query_history_k_data_plus(baostock_code(symbol),
+        "date,open,high,low,close,volume",
+        start_date=fetch_start, end_date=fetch_end,
+        frequency="d", adjustflag="2")
+
+    data_list = []
+    while (rs.error_code == '0') & rs.next():
+        data_list.append(rs.get_row_data())
+        
+    if not data_list:
+        return None
+        
+    df = pd.DataFrame(data_list, columns=rs.fields)
+    
+    # 数据清洗：Baostock 返回的都是字符串
+    df.rename(columns={'date': '日期', 'open': '开盘', 'high': '最高', 'low': '最低', 'close': '收盘', 'volume': '成交量'}, inplace=True)
+    df['日期'] = pd.to_datetime(df['日期'])
+    df.set_index('日期', inplace=True)
+    
+    # 强制转数字
+    for c in ['开盘', '最高', '最低', '收盘', '成交量']:
+        df[c] = pd.to_numeric(df[c], errors='coerce')
+    return df
+
+def compute_signals(df, symbol=None):
+    """
+    批量计算三个策略的全部指标与信号列 (日期索引、升序的日线 DataFrame，原地追加列后返回)。
+    逐日增量状态 indicator_state.py 的 'bao' 口径以此为准，replay_signals.py 用它做逐日对照。
+    """
+    # --- 基础指标 ---
+    # 均线 / 均量 / MACD / VAR1 走公共指标库 (按内容哈希缓存，数据未变的股票直接读缓存)
+    for name, values in cached_indicators(df, SCREENER_SPECS, symbol).items():
+        df[name] = values
+    
+    # BBI
+    ma3 = df['收盘'].rolling(3).mean()
+    ma6 = df['收盘'].rolling(6).mean()
+    ma12 = df['收盘'].rolling(12).mean()
+    ma24 = df['收盘'].rolling(24).mean()
+    df['BBI'] = (ma3 + ma6 + ma12 + ma24) / 4
+    
+    # 波动率
+    df['Log_Ret'] = np.log(df['收盘'] / df['收盘'].shift(1))
+    df['波动率%'] = df['Log_Ret'].rolling(20).std() * np.sqrt(252) * 100
+
+    # --- 策略1：历史大底 ---
+    hhv = rolling_extrema(df['最高'], [500, 250, 90], 'max')
+    llv = rolling_extrema(df['最低'], [500, 250, 90], 'min')
+    for p in [500, 250, 90]:
+        df[f'HHV{p}'] = hhv[p]
+        df[f'LLV{p}'] = llv[p]
+        df[f'R_HHV{p}'] = df[f'HHV{p}'].rolling(21).mean()
+        df[f'R_LLV{p}'] = df[f'LLV{p}'].rolling(21).mean()
+        
+    df['R7'] = (df['R_LLV500']*0.96 + df['R_LLV250']*0.96 + df['R_LLV90']*0.96 + 
+                df['R_HHV500']*0.558 + df['R_HHV250']*0.558 + df['R_HHV90']*0.558) / 6
+    df['R8'] = (df['R_LLV500']*1.25 + df['R_LLV250']*1.23 + df['R_LLV90']*1.2 + 
+                df['R_HHV500']*0.55 + df['R_HHV250']*0.55 + df['R_HHV90']*0.65) / 6
+    df['R9'] = (df['R_LLV500']*1.3 + df['R_LLV250']*1.3 + df['R_LLV90']*1.3 + 
+                df['R_HHV500']*0.68 + df['R_HHV250']*0.68 + df['R_HHV90']*0.68) / 6
+    
+    df['RA'] = (df['R7']*3 + df['R8']*2 + df['R9']) / 6 * 1.738
+    df['RA'] = df['RA'].rolling(21).mean()
+    df['RB'] = df['最低'].shift(1)
+    df['ABS_LOW_RB'] = (df['最低'] - df['RB']).abs()
+    df['MAX_LOW_RB'] = (df['最低'] - df['RB']).clip(lower=0)
+    df['SMA_ABS'] = sma(df['ABS_LOW_RB'], 3, 1)
+    df['SMA_MAX'] = sma(df['MAX_LOW_RB'], 3, 1)
+    
+    with np.errstate(divide='ignore', invalid='ignore'):
+        df['RC'] = np.where(df['SMA_MAX'] != 0, (df['SMA_ABS'] / df['SMA_MAX']) * 100, 0)
+    
+    df['RD'] = np.where(df['收盘']*1.35 <= df['RA'], df['RC']*10, df['RC']/10)
+    df['RD'] = df['RD'].rolling(3).mean()
+    df['RE'] = df['最低'].rolling(30).min()
+    df['RF'] = df['RD'].rolling(30).max()
+    df['R10'] = df['收盘'].rolling(58).mean().notna().astype(int)
+    raw_signal = np.where(df['最低'] <= df['RE'], (df['RD'] + df['RF']*2)/2, 0)
+    df['S1_Raw_Val'] = raw_signal * df['R10']
+    df['S1_Trigger'] = (df['S1_Raw_Val'] > 0).astype(int)
+    df['S1_Final_Flag'] = df['S1_Trigger'].rolling(window=3, min_periods=1).max()
+    df['S1_Signal'] = signal_flag(df['S1_Final_Flag'] > 0)
+
+    # --- 策略2：波段回调 ---
+    df['S2_BuyLine'] = calculate_xma(df['VAR1'], 32) * (1 - 4/100)
+    df['S2_Signal'] = signal_flag(df['收盘'] < df['S2_BuyLine'])
+
+    # --- 策略3：主升浪 ---
+    df['MA20_Slope'] = (df['MA20'] / df['MA20'].shift(1) - 1) * 100
+    df['MA20_Angle'] = np.degrees(np.arctan(df['MA20_Slope']))
+    
+    cond_angle = df['MA20_Angle'] > 25
+    cond_trend = (df['收盘'] > df['MA10']) & (df['MA5'] > df['MA20']) & (df['MA20'] > df['MA60']) & (df['MA60'] > df['MA60'].shift(1))
+    cond_power = (df['收盘'] / df['收盘'].shift(1) > 1.03) & (df['收盘'] > df['开盘'])
+    cond_vol = df['成交量'] > df['VOL_MA5']
+    cond_macd = (df['DIF'] > 0) & (df['DIF'] > df['DEA'])
+    df['S3_Signal'] = signal_flag(cond_angle & cond_trend & cond_power & cond_vol & cond_macd)
+
+    # --- 连续信号计数 (xN)：内部只存 int8 标记与 int16 连续天数，输出时再渲染成字符串 ---
+    for k in (1, 2, 3):
+        df[f'S{k}_Streak'] = signal_streak(df[f'S{k}_Signal'])
+    return df
+
+def build_output_row(stock_info, date, row):
+    """row 为批量计算的某一行或逐日状态返回的输出行，两者列名相同"""
+    return {
+        '股票代码': stock_info['code'], # 注意这里用回原始代码
+        '股票简称': stock_info['name'],
+        '主营行业': stock_info['industry'],
+        '地区': stock_info['area'],
+        '类型': stock_info['type'],
+        '日期': date.strftime('%Y-%m-%d'),
+        '收盘价': round(row['收盘'], 2),
+        '策略1': render_signal(row['S1_Streak'], 'Y'), 
+        '策略2': render_signal(row['S2_Streak'], 'Y'),
+        '策略3': render_signal(row['S3_Streak'], '🔥'),
+        'BBI': round(row['BBI'], 2),
+        'MA60': round(row['MA60'], 2),
+        '波动率': round(row['波动率%'], 2)
+    }
+
 def process_stock(stock_info, start_date, end_date):
     symbol = stock_info['code']
-    name = stock_info['name']
-    
-    # 1. Baostock 代码格式转换 (sh.600000 / sz.000001)
-    if symbol.startswith('6'):
-        bs_code = f"sh.{symbol}"
-    elif symbol.startswith('8') or symbol.startswith('4'): # 北交所
-        bs_code = f"bj.{symbol}"
-    else:
-        bs_code = f"sz.{symbol}"
 
     try:
-        # 2. 往前推 1000 天 (Baostock 历史数据很全，不用省)
+        # 往前推 1000 天作为指标预热窗口
         fetch_start = (pd.to_datetime(start_date) - datetime.timedelta(days=1000)).strftime('%Y-%m-%d')
         fetch_end = pd.to_datetime(end_date).strftime('%Y-%m-%d')
 
-        # 3. 获取日线数据 (adjustflag="2" 是前复权)
-        rs = bs.query_history_k_data_plus(bs_code,
-            "date,open,high,low,close,volume",
-            start_date=fetch_start, end_date=fetch_end,
-            frequency="d", adjustflag="2")
-
-        # 4. 转换格式
-        data_list = []
-        while (rs.error_code == '0') & rs.next():
-            data_list.append(rs.get_row_data())
-            
-        if not data_list:
+        # 复权口径：Baostock 前复权，与本地仓库同源同口径。预热历史直接读仓库，只向 Baostock 请求仓库之后的新K线
+        df = get_daily_bars(symbol, fetch_start, fetch_end, vendor='baostock', fetch_full=fetch_full_history)
+        if df is None:
             return None
-            
-        df = pd.DataFrame(data_list, columns=rs.fields)
-        
-        # 数据清洗：Baostock 返回的都是字符串
-        df.rename(columns={'date': '日期', 'open': '开盘', 'high': '最高', 'low': '最低', 'close': '收盘', 'volume': '成交量'}, inplace=True)
-        df['日期'] = pd.to_datetime(df['日期'])
-        df.set_index('日期', inplace=True)
-        
-        # 强制转数字
-        for c in ['开盘', '最高', '最低', '收盘', '成交量']:
-            df[c] = pd.to_numeric(df[c], errors='coerce')
         
         # 过滤数据量不足的新股
         if len(df) < 200:
             return None
 
-        # ==========================================
-        # 以下策略逻辑完全保持不变 (直接复制原来的即可)
-        # ==========================================
-        
-        # --- 基础指标 ---
-        df['MA20'] = df['收盘'].rolling(20).mean()
-        df['MA60'] = df['收盘'].rolling(60).mean()
-        
-        # BBI
-        ma3 = df['收盘'].rolling(3).mean()
-        ma6 = df['收盘'].rolling(6).mean()
-        ma12 = df['收盘'].rolling(12).mean()
-        ma24 = df['收盘'].rolling(24).mean()
-        df['BBI'] = (ma3 + ma6 + ma12 + ma24) / 4
-        
-        # 波动率
-        df['Log_Ret'] = np.log(df['收盘'] / df['收盘'].shift(1))
-        df['波动率%'] = df['Log_Ret'].rolling(20).std() * np.sqrt(252) * 100
-
-        # --- 策略1：历史大底 ---
-        for p in [500, 250, 90]:
-            df[f'HHV{p}'] = df['最高'].rolling(p).max()
-            df[f'LLV{p}'] = df['最低'].rolling(p).min()
-            df[f'R_HHV{p}'] = df[f'HHV{p}'].rolling(21).mean()
-            df[f'R_LLV{p}'] = df[f'LLV{p}'].rolling(21).mean()
-            
-        df['R7'] = (df['R_LLV500']*0.96 + df['R_LLV250']*0.96 + df['R_LLV90']*0.96 + 
-                    df['R_HHV500']*0.558 + df['R_HHV250']*0.558 + df['R_HHV90']*0.558) / 6
-        df['R8'] = (df['R_LLV500']*1.25 + df['R_LLV250']*1.23 + df['R_LLV90']*1.2 + 
-                    df['R_HHV500']*0.55 + df['R_HHV250']*0.55 + df['R_HHV90']*0.65) / 6
-        df['R9'] = (df['R_LLV500']*1.3 + df['R_LLV250']*1.3 + df['R_LLV90']*1.3 + 
-                    df['R_HHV500']*0.68 + df['R_HHV250']*0.68 + df['R_HHV90']*0.68) / 6
-        
-        df['RA'] = (df['R7']*3 + df['R8']*2 + df['R9']) / 6 * 1.738
-        df['RA'] = df['RA'].rolling(21).mean()
-        df['RB'] = df['最低'].shift(1)
-        df['ABS_LOW_RB'] = (df['最低'] - df['RB']).abs()
-        df['MAX_LOW_RB'] = (df['最低'] - df['RB']).clip(lower=0)
-        df['SMA_ABS'] = sma(df['ABS_LOW_RB'], 3, 1)
-        df['SMA_MAX'] = sma(df['MAX_LOW_RB'], 3, 1)
-        
-        with np.errstate(divide='ignore', invalid='ignore'):
-            df['RC'] = np.where(df['SMA_MAX'] != 0, (df['SMA_ABS'] / df['SMA_MAX']) * 100, 0)
-        
-        df['RD'] = np.where(df['收盘']*1.35 <= df['RA'], df['RC']*10, df['RC']/10)
-        df['RD'] = df['RD'].rolling(3).mean()
-        df['RE'] = df['最低'].rolling(30).min()
-        df['RF'] = df['RD'].rolling(30).max()
-        df['R10'] = df['收盘'].rolling(58).mean().notna().astype(int)
-        raw_signal = np.where(df['最低'] <= df['RE'], (df['RD'] + df['RF']*2)/2, 0)
-        df['S1_Raw_Val'] = raw_signal * df['R10']
-        df['S1_Trigger'] = (df['S1_Raw_Val'] > 0).astype(int)
-        df['S1_Final_Flag'] = df['S1_Trigger'].rolling(window=3, min_periods=1).max()
-        df['策略1_大底信号'] = np.where(df['S1_Final_Flag'] > 0, 'Y', '')
-
-        # --- 策略2：波段回调 ---
-        df['VAR1'] = (df['收盘'] + df['最高'] + df['开盘'] + df['最低']) / 4
-        df['S2_BuyLine'] = calculate_xma(df['VAR1'], 32) * (1 - 4/100)
-        df['策略2_波段信号'] = np.where(df['收盘'] < df['S2_BuyLine'], 'Y', '')
-
-        # --- 策略3：主升浪 ---
-        df['MA20_Slope'] = (df['MA20'] / df['MA20'].shift(1) - 1) * 100
-        df['MA20_Angle'] = np.degrees(np.arctan(df['MA20_Slope']))
-        exp12 = df['收盘'].ewm(span=12, adjust=False).mean()
-        exp26 = df['收盘'].ewm(span=26, adjust=False).mean()
-        df['DIF'] = exp12 - exp26
-        df['DEA'] = df['DIF'].ewm(span=9, adjust=False).mean()
-        df['VOL_MA5'] = df['成交量'].rolling(5).mean()
-        df['MA5'] = df['收盘'].rolling(5).mean()
-        df['MA10'] = df['收盘'].rolling(10).mean()
-        
-        cond_angle = df['MA20_Angle'] > 25
-        cond_trend = (df['收盘'] > df['MA10']) & (df['MA5'] > df['MA20']) & (df['MA20'] > df['MA60']) & (df['MA60'] > df['MA60'].shift(1))
-        cond_power = (df['收盘'] / df['收盘'].shift(1) > 1.03) & (df['收盘'] > df['开盘'])
-        cond_vol = df['成交量'] > df['VOL_MA5']
-        cond_macd = (df['DIF'] > 0) & (df['DIF'] > df['DEA'])
-        df['策略3_主升浪'] = np.where(cond_angle & cond_trend & cond_power & cond_vol & cond_macd, '🔥', '')
-
-        # --- 连续信号标记 (xN) ---
-        check_list = {'策略1_大底信号': 'Y', '策略2_波段信号': 'Y', '策略3_主升浪': '🔥'}
-        for col, marker in check_list.items():
-            condition = df[col] == marker
-            groups = (condition != condition.shift()).cumsum()
-            df['temp_count'] = df.groupby(groups).cumcount() + 1
-            mask = condition & (df['temp_count'] > 1)
-            df.loc[mask, col] = marker + ' x' + df['temp_count'].astype(str)
-        if 'temp_count' in df.columns: del df['temp_count']
+        if USE_INDICATOR_STATE and start_date == end_date:
+            row = advance(symbol, df, 'bao')
+            if not pd.Timestamp(start_date) <= row['日期'] <= pd.Timestamp(end_date):
+                return None
+            return [build_output_row(stock_info, row['日期'], row)]
+
+        df = compute_signals(df, symbol)
 
         # --- 截取结果 ---
         result_df = df[start_date:end_date].copy()
         if result_df.empty:
             return None
 
-        output_list = []
-        for date, row in result_df.iterrows():
-            output_list.append({
-                '股票代码': symbol, # 注意这里用回原始代码
-                '股票简称': name,
-                '主营行业': stock_info['industry'],
-                '地区': stock_info['area'],
-                '类型': stock_info['type'],
-                '日期': date.strftime('%Y-%m-%d'),
-                '收盘价': round(row['收盘'], 2),
-                '策略1': row['策略1_大底信号'], 
-                '策略2': row['策略2_波段信号'],
-                '策略3': row['策略3_主升浪'],
-                'BBI': round(row['BBI'], 2),
-                'MA60': round(row['MA60'], 2),
-                '波动率': round(row['波动率%'], 2)
-            })
+        # 信号列已是整数，按 object 逐行取值，避免整行被提升为 float64 后 round 的进位结果变化
+        output_list = [build_output_row(stock_info, date, row) for date, row in result_df.astype(object).iterrows()]
         return output_list
 
     except Exception as e:
@@ -474,14 +463,8 @@ if __name__ == '__main__':
 
     print(f"正在读取 {input_file} ...")
     try:
-        meta_df = pd.read_excel(input_file, usecols=[0, 1, 2, 3, 4])
-        meta_df.columns = ['code', 'name', 'industry', 'area', 'type']
-        meta_df.dropna(subset=['code'], inplace=True)
-        meta_df = meta_df[meta_df['code'].astype(str).str.strip() != '']
-        # 去除可能存在的 .0 后缀并补齐6位
-        meta_df['code'] = meta_df['code'].astype(str).str.replace(r'\.0$', '', regex=True).str.zfill(6)
-        
-        stock_list = meta_df.to_dict('records')
+        # 股票列表走编译好的注册表 universe.npy (表格未变化时不再重新解析 xlsx)
+        stock_list = load_stock_list()
         print(f"成功加载 {len(stock_list)} 只有效股票信息。")
         
     except Exception as e:
@@ -9,33 +9,29 @@ import plotly.express as px
 import plotly.io as pio
 import plotly.express as px
 import pandas as pd
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from market_data import get_daily_bars
+from fetch_pipeline import fetch_all, write_failure_report
+from universe import load_stock_list
+from indicators import sma, rolling_extrema, cached_indicators, main_wave_specs, signal_flag, signal_streak, render_signal
+from indicator_state import advance
+
+# --- 指标配置 ---
+SCREENER_SPECS = {**main_wave_specs(), 'VAR1': ('VAR1',)}  # 与原 rolling(n) 写法一致 (窗口未满为 NaN)
+# True: 单日选股时用持久化的逐日指标状态 (indicator_state.py 'bao' 口径) 只推进新K线；False: 每天整段重算
+# 'bao' 口径经 replay_signals.py 回放与整段重算逐日一致；多日区间仍走整段重算
+USE_INDICATOR_STATE = False
+
+# --- 抓取配置 ---
+FETCH_RATE = 3.0          # 每秒最多发起的请求数 (令牌桶速率)
+FETCH_BURST = 3           # 允许的瞬时突发请求数
+FETCH_CONCURRENCY = 6     # 同时在途的请求数上限
+FETCH_TIMEOUT = 20.0      # 单次请求超时 (秒)
+FETCH_RETRIES = 4         # 失败后的最大重试次数
 
 # ==========================================
 # 1. 核心算法函数定义 (保持不变)
 # ==========================================
 
-def sma(series, n, m):
-    """
-    策略1核心：通达信SMA递归算法
-    """
-    sma_values = []
-    series_array = series.values
-    val = np.nan
-    for i, x in enumerate(series_array):
-        if i < n - 1:
-            sma_values.append(np.nan)
-        elif i == n - 1:
-            val = np.nanmean(series_array[:n])
-            sma_values.append(val)
-        else:
-            if np.isnan(val):
-                val = np.nanmean(series_array[:i+1])
-            else:
-                val = (x * m + val * (n - m)) / n
-            sma_values.append(val)
-    return pd.Series(sma_values, index=series.index)
-
 def calculate_xma(series, window):
     """策略2核心：EMA算法 (XMA)"""
     return series.ewm(span=window, adjust=False).mean()
@@ -43,176 +39,176 @@ def calculate_xma(series, window):
 # ==========================================
 # 2. 单只股票处理引擎 (保持 qfq 修正)
 # ==========================================
-def process_stock(stock_info, start_date, end_date):
+def fetch_full_history(symbol, fetch_start, fetch_end):
+    """整段从东方财富 (akshare) 下载前复权日线"""
+    # 使用 qfq (前复权)
+    df = ak.stock_zh_a_hist(symbol=symbol, period="daily", start_date=pd.to_datetime(fetch_start).strftime('%Y%m%d'),
+                            end_date=pd.to_datetime(fetch_end).strftime('%Y%m%d'), adjust="qfq")
+    if df is None or df.empty:
+        return None
+
+    df['日期'] = pd.to_datetime(df['日期'])
+    df.set_index('日期', inplace=True)
+    df.sort_index(inplace=True)
+    
+    # 【注意】这里增加了 '成交量' 的数值转换，防止报错
+    for c in ['开盘', '收盘', '最高', '最低', '成交量']:
+        df[c] = pd.to_numeric(df[c], errors='coerce')
+    # 成交量统一为"股" (东方财富返回"手")，与本地仓库一致
+    df['成交量'] = df['成交量'] * 100
+    return df
+
+def load_bars(symbol, start_date, end_date):
+    """抓取阶段：返回计算所需的日线 (往前推约 3 年用于长期均线)；网络异常直接抛出，由抓取流水线重试"""
+    fetch_start = (pd.to_datetime(start_date) - datetime.timedelta(days=1000)).strftime('%Y-%m-%d')
+    fetch_end = pd.to_datetime(end_date).strftime('%Y-%m-%d')
+    # 复权口径：始终是东方财富前复权，与原脚本一致。东方财富对现金分红的复权方式与仓库 (Baostock 前复权) 不同，
+    # 无法判定两者何时相同，所以不拼接本地仓库，每只股票都整段下载 (见 market_data.py)
+    return get_daily_bars(symbol, fetch_start, fetch_end, vendor='akshare', fetch_full=fetch_full_history)
+
+def compute_signals(df, symbol=None):
+    """批量计算三个策略的全部指标与信号列 (日期索引、升序的日线 DataFrame，原地追加列后返回)"""
+    # --- 基础指标 ---
+    # 均线 / 均量 / MACD / VAR1 走公共指标库 (按内容哈希缓存，数据未变的股票直接读缓存)
+    for name, values in cached_indicators(df, SCREENER_SPECS, symbol).items():
+        df[name] = values
+
+    # BBI
+    ma3 = df['收盘'].rolling(3).mean()
+    ma6 = df['收盘'].rolling(6).mean()
+    ma12 = df['收盘'].rolling(12).mean()
+    ma24 = df['收盘'].rolling(24).mean()
+    df['BBI'] = (ma3 + ma6 + ma12 + ma24) / 4
+
+    # 波动率
+    df['Log_Ret'] = np.log(df['收盘'] / df['收盘'].shift(1))
+    df['波动率%'] = df['Log_Ret'].rolling(20).std() * np.sqrt(252) * 100
+
+    # ==========================================
+    # 策略1：历史大底 (Deep Bottom) - 保持不变
+    # ==========================================
+    hhv = rolling_extrema(df['最高'], [500, 250, 90], 'max')
+    llv = rolling_extrema(df['最低'], [500, 250, 90], 'min')
+    for p in [500, 250, 90]:
+        df[f'HHV{p}'] = hhv[p]
+        df[f'LLV{p}'] = llv[p]
+        df[f'R_HHV{p}'] = df[f'HHV{p}'].rolling(21).mean()
+        df[f'R_LLV{p}'] = df[f'LLV{p}'].rolling(21).mean()
+
+    df['R7'] = (df['R_LLV500']*0.96 + df['R_LLV250']*0.96 + df['R_LLV90']*0.96 + 
+                df['R_HHV500']*0.558 + df['R_HHV250']*0.558 + df['R_HHV90']*0.558) / 6
+    df['R8'] = (df['R_LLV500']*1.25 + df['R_LLV250']*1.23 + df['R_LLV90']*1.2 + 
+                df['R_HHV500']*0.55 + df['R_HHV250']*0.55 + df['R_HHV90']*0.65) / 6
+    df['R9'] = (df['R_LLV500']*1.3 + df['R_LLV250']*1.3 + df['R_LLV90']*1.3 + 
+                df['R_HHV500']*0.68 + df['R_HHV250']*0.68 + df['R_HHV90']*0.68) / 6
+
+    df['RA'] = (df['R7']*3 + df['R8']*2 + df['R9']) / 6 * 1.738
+    df['RA'] = df['RA'].rolling(21).mean()
+
+    df['RB'] = df['最低'].shift(1)
+    df['ABS_LOW_RB'] = (df['最低'] - df['RB']).abs()
+    df['MAX_LOW_RB'] = (df['最低'] - df['RB']).clip(lower=0)
+    df['SMA_ABS'] = sma(df['ABS_LOW_RB'], 3, 1)
+    df['SMA_MAX'] = sma(df['MAX_LOW_RB'], 3, 1)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        df['RC'] = np.where(df['SMA_MAX'] != 0, (df['SMA_ABS'] / df['SMA_MAX']) * 100, 0)
+
+    df['RD'] = np.where(df['收盘']*1.35 <= df['RA'], df['RC']*10, df['RC']/10)
+    df['RD'] = df['RD'].rolling(3).mean()
+    df['RE'] = df['最低'].rolling(30).min()
+    df['RF'] = df['RD'].rolling(30).max()
+
+    df['R10'] = df['收盘'].rolling(58).mean().notna().astype(int)
+    raw_signal = np.where(df['最低'] <= df['RE'], (df['RD'] + df['RF']*2)/2, 0)
+    df['S1_Raw_Val'] = raw_signal * df['R10']
+    df['S1_Trigger'] = (df['S1_Raw_Val'] > 0).astype(int)
+    df['S1_Final_Flag'] = df['S1_Trigger'].rolling(window=3, min_periods=1).max()
+    df['S1_Signal'] = signal_flag(df['S1_Final_Flag'] > 0)
+
+    # ==========================================
+    # 策略2：波段回调 (EMA Pullback) - 保持不变
+    # ==========================================
+    df['S2_BuyLine'] = calculate_xma(df['VAR1'], 32) * (1 - 4/100)
+    df['S2_Signal'] = signal_flag(df['收盘'] < df['S2_BuyLine'])
+
+    # ==========================================
+    # 策略3：右侧强趋势 (RIGHT_SIDE_PRO) - 【新增】
+    # ==========================================
+    # 1. 计算 MA20 角度 (斜率)
+    # 用 atan 计算弧度，再转角度。为了让斜率更明显，通常会 * 100
+    df['MA20_Slope'] = (df['MA20'] / df['MA20'].shift(1) - 1) * 100
+    df['MA20_Angle'] = np.degrees(np.arctan(df['MA20_Slope']))
+
+    # 2. MACD (DIF/DEA) 与 3. 成交量均线 / MA5 / MA10 已由指标库算好
+
+    # 4. 组合条件
+    # 条件A: 角度 > 25度 (强趋势)
+    cond_angle = df['MA20_Angle'] > 25
+    # 条件B: 多头排列 (股价 > 20日线 > 60日线，且60日线向上)
+    cond_trend = (df['收盘'] > df['MA10']) & \
+                 (df['MA5'] > df['MA20']) & \
+                 (df['MA20'] > df['MA60']) & \
+                 (df['MA60'] > df['MA60'].shift(1))
+    # 条件C: 动能 (涨幅 > 3% 且 阳线)
+    cond_power = (df['收盘'] / df['收盘'].shift(1) > 1.03) & (df['收盘'] > df['开盘'])
+    # 条件D: 放量
+    cond_vol = df['成交量'] > df['VOL_MA5']
+    # 条件E: MACD 水上金叉或多头
+    cond_macd = (df['DIF'] > 0) & (df['DIF'] > df['DEA'])
+
+    # 最终信号 (输出时用 '🔥' 标识)
+    df['S3_Signal'] = signal_flag(cond_angle & cond_trend & cond_power & cond_vol & cond_macd)
+    # 【新增】连续信号标记逻辑 (Streak Counter)
+    # ==========================================
+    # 内部只存 int8 标记与 int16 连续天数 (遇 0 归零的累加)，输出时再渲染成 "Y x3" / "🔥 x2"
+    for k in (1, 2, 3):
+        df[f'S{k}_Streak'] = signal_streak(df[f'S{k}_Signal'])
+    return df
+
+def build_output_row(stock_info, date, row):
+    """row 为批量计算的某一行或逐日状态返回的输出行，两者列名相同"""
+    return {
+        '股票代码': stock_info['code'],
+        '股票简称': stock_info['name'],
+        '主营行业': stock_info['industry'],
+        '地区': stock_info['area'],
+        '类型': stock_info['type'],
+        '日期': date.strftime('%Y-%m-%d'),
+        '收盘价': round(row['收盘'], 2),
+        '策略1': render_signal(row['S1_Streak'], 'Y'), 
+        '策略2': render_signal(row['S2_Streak'], 'Y'),
+        '策略3': render_signal(row['S3_Streak'], '🔥'), # 新增这一列
+        'BBI': round(row['BBI'], 2),
+        'MA60': round(row['MA60'], 2),
+        '波动率': round(row['波动率%'], 2)
+    }
+
+def process_stock(stock_info, start_date, end_date, df=None):
+    """计算阶段：df 为抓取阶段已取得的日线，为 None 时现场抓取"""
     symbol = stock_info['code']
     try:
-        # 往前推3年获取数据用于计算长期均线
-        fetch_start = (pd.to_datetime(start_date) - datetime.timedelta(days=1000)).strftime('%Y%m%d')
-        fetch_end = pd.to_datetime(end_date).strftime('%Y%m%d')
-        
-        # 使用 qfq (前复权)
-        df = ak.stock_zh_a_hist(symbol=symbol, period="daily", start_date=fetch_start, end_date=fetch_end, adjust="qfq")
+        if df is None:
+            df = load_bars(symbol, start_date, end_date)
         
-        if df.empty or len(df) < 500:
+        if df is None or df.empty or len(df) < 500:
             return None
-            
-        df['日期'] = pd.to_datetime(df['日期'])
-        df.set_index('日期', inplace=True)
-        df.sort_index(inplace=True)
-        
-        # 【注意】这里增加了 '成交量' 的数值转换，防止报错
-        for c in ['开盘', '收盘', '最高', '最低', '成交量']:
-            df[c] = pd.to_numeric(df[c], errors='coerce')
 
-        # --- 基础指标 ---
-        df['MA20'] = df['收盘'].rolling(20).mean() # 新增 MA20
-        df['MA60'] = df['收盘'].rolling(60).mean()
-        
-        # BBI
-        ma3 = df['收盘'].rolling(3).mean()
-        ma6 = df['收盘'].rolling(6).mean()
-        ma12 = df['收盘'].rolling(12).mean()
-        ma24 = df['收盘'].rolling(24).mean()
-        df['BBI'] = (ma3 + ma6 + ma12 + ma24) / 4
-        
-        # 波动率
-        df['Log_Ret'] = np.log(df['收盘'] / df['收盘'].shift(1))
-        df['波动率%'] = df['Log_Ret'].rolling(20).std() * np.sqrt(252) * 100
-
-        # ==========================================
-        # 策略1：历史大底 (Deep Bottom) - 保持不变
-        # ==========================================
-        for p in [500, 250, 90]:
-            df[f'HHV{p}'] = df['最高'].rolling(p).max()
-            df[f'LLV{p}'] = df['最低'].rolling(p).min()
-            df[f'R_HHV{p}'] = df[f'HHV{p}'].rolling(21).mean()
-            df[f'R_LLV{p}'] = df[f'LLV{p}'].rolling(21).mean()
-            
-        df['R7'] = (df['R_LLV500']*0.96 + df['R_LLV250']*0.96 + df['R_LLV90']*0.96 + 
-                    df['R_HHV500']*0.558 + df['R_HHV250']*0.558 + df['R_HHV90']*0.558) / 6
-        df['R8'] = (df['R_LLV500']*1.25 + df['R_LLV250']*1.23 + df['R_LLV90']*1.2 + 
-                    df['R_HHV500']*0.55 + df['R_HHV250']*0.55 + df['R_HHV90']*0.65) / 6
-        df['R9'] = (df['R_LLV500']*1.3 + df['R_LLV250']*1.3 + df['R_LLV90']*1.3 + 
-                    df['R_HHV500']*0.68 + df['R_HHV250']*0.68 + df['R_HHV90']*0.68) / 6
-        
-        df['RA'] = (df['R7']*3 + df['R8']*2 + df['R9']) / 6 * 1.738
-        df['RA'] = df['RA'].rolling(21).mean()
-        
-        df['RB'] = df['最低'].shift(1)
-        df['ABS_LOW_RB'] = (df['最低'] - df['RB']).abs()
-        df['MAX_LOW_RB'] = (df['最低'] - df['RB']).clip(lower=0)
-        df['SMA_ABS'] = sma(df['ABS_LOW_RB'], 3, 1)
-        df['SMA_MAX'] = sma(df['MAX_LOW_RB'], 3, 1)
-        
-        with np.errstate(divide='ignore', invalid='ignore'):
-            df['RC'] = np.where(df['SMA_MAX'] != 0, (df['SMA_ABS'] / df['SMA_MAX']) * 100, 0)
-        
-        df['RD'] = np.where(df['收盘']*1.35 <= df['RA'], df['RC']*10, df['RC']/10)
-        df['RD'] = df['RD'].rolling(3).mean()
-        df['RE'] = df['最低'].rolling(30).min()
-        df['RF'] = df['RD'].rolling(30).max()
-        
-        df['R10'] = df['收盘'].rolling(58).mean().notna().astype(int)
-        raw_signal = np.where(df['最低'] <= df['RE'], (df['RD'] + df['RF']*2)/2, 0)
-        df['S1_Raw_Val'] = raw_signal * df['R10']
-        df['S1_Trigger'] = (df['S1_Raw_Val'] > 0).astype(int)
-        df['S1_Final_Flag'] = df['S1_Trigger'].rolling(window=3, min_periods=1).max()
-        df['策略1_大底信号'] = np.where(df['S1_Final_Flag'] > 0, 'Y', '')
-
-        # ==========================================
-        # 策略2：波段回调 (EMA Pullback) - 保持不变
-        # ==========================================
-        df['VAR1'] = (df['收盘'] + df['最高'] + df['开盘'] + df['最低']) / 4
-        df['S2_BuyLine'] = calculate_xma(df['VAR1'], 32) * (1 - 4/100)
-        df['策略2_波段信号'] = np.where(df['收盘'] < df['S2_BuyLine'], 'Y', '')
-
-        # ==========================================
-        # 策略3：右侧强趋势 (RIGHT_SIDE_PRO) - 【新增】
-        # ==========================================
-        # 1. 计算 MA20 角度 (斜率)
-        # 用 atan 计算弧度，再转角度。为了让斜率更明显，通常会 * 100
-        df['MA20_Slope'] = (df['MA20'] / df['MA20'].shift(1) - 1) * 100
-        df['MA20_Angle'] = np.degrees(np.arctan(df['MA20_Slope']))
-        
-        # 2. 计算 MACD
-        exp12 = df['收盘'].ewm(span=12, adjust=False).mean()
-        exp26 = df['收盘'].ewm(span=26, adjust=False).mean()
-        df['DIF'] = exp12 - exp26
-        df['DEA'] = df['DIF'].ewm(span=9, adjust=False).mean()
-        
-        # 3. 计算成交量均线
-        df['VOL_MA5'] = df['成交量'].rolling(5).mean()
-        df['MA5'] = df['收盘'].rolling(5).mean()
-        df['MA10'] = df['收盘'].rolling(10).mean()
-
-        # 4. 组合条件
-        # 条件A: 角度 > 25度 (强趋势)
-        cond_angle = df['MA20_Angle'] > 25
-        # 条件B: 多头排列 (股价 > 20日线 > 60日线，且60日线向上)
-        cond_trend = (df['收盘'] > df['MA10']) & \
-                     (df['MA5'] > df['MA20']) & \
-                     (df['MA20'] > df['MA60']) & \
-                     (df['MA60'] > df['MA60'].shift(1))
-        # 条件C: 动能 (涨幅 > 3% 且 阳线)
-        cond_power = (df['收盘'] / df['收盘'].shift(1) > 1.03) & (df['收盘'] > df['开盘'])
-        # 条件D: 放量
-        cond_vol = df['成交量'] > df['VOL_MA5']
-        # 条件E: MACD 水上金叉或多头
-        cond_macd = (df['DIF'] > 0) & (df['DIF'] > df['DEA'])
-
-        # 最终信号：用 '🔥' 标识
-        df['策略3_主升浪'] = np.where(cond_angle & cond_trend & cond_power & cond_vol & cond_macd, '🔥', '')
-        # 【新增】连续信号标记逻辑 (Streak Counter)
-        # ==========================================
-        # 定义需要统计连续天数的列和对应的原始标记
-        check_list = {
-            '策略1_大底信号': 'Y',
-            '策略2_波段信号': 'Y',
-            '策略3_主升浪': '🔥'
-        }
-
-        for col, marker in check_list.items():
-            # 1. 找出满足条件的行 (True/False)
-            condition = df[col] == marker
-            
-            # 2. 利用 Pandas 分组计算连续出现的次数
-            # (condition != condition.shift()) 用于判断状态是否切换
-            # .cumsum() 给每一段连续的状态分配一个唯一的组ID
-            groups = (condition != condition.shift()).cumsum()
-            
-            # .cumcount() + 1 计算组内的累积计数
-            df['temp_count'] = df.groupby(groups).cumcount() + 1
-            
-            # 3. 只修改连续出现天数 > 1 的行
-            # 逻辑：如果是第2天及以上，且当前确实有信号，就改为 "标记 xN"
-            mask = condition & (df['temp_count'] > 1)
-            df.loc[mask, col] = marker + ' x' + df['temp_count'].astype(str)
-
-        # 清理临时列
-        if 'temp_count' in df.columns:
-            del df['temp_count']
+        if USE_INDICATOR_STATE and start_date == end_date:
+            row = advance(symbol, df, 'bao')
+            if not pd.Timestamp(start_date) <= row['日期'] <= pd.Timestamp(end_date):
+                return None
+            return [build_output_row(stock_info, row['日期'], row)]
+
+        df = compute_signals(df, symbol)
+
         # --- 截取结果 ---
         result_df = df[start_date:end_date].copy()
         if result_df.empty:
             return None
 
-        output_list = []
-        for date, row in result_df.iterrows():
-            output_list.append({
-                '股票代码': stock_info['code'],
-                '股票简称': stock_info['name'],
-                '主营行业': stock_info['industry'],
-                '地区': stock_info['area'],
-                '类型': stock_info['type'],
-                '日期': date.strftime('%Y-%m-%d'),
-                '收盘价': round(row['收盘'], 2),
-                '策略1': row['策略1_大底信号'], 
-                '策略2': row['策略2_波段信号'],
-                '策略3': row['策略3_主升浪'], # 新增这一列
-                'BBI': round(row['BBI'], 2),
-                'MA60': round(row['MA60'], 2),
-                '波动率': round(row['波动率%'], 2)
-            })
+        # 信号列已是整数，按 object 逐行取值，避免整行被提升为 float64 后 round 的进位结果变化
+        output_list = [build_output_row(stock_info, date, row) for date, row in result_df.astype(object).iterrows()]
             
         return output_list
 
@@ -479,6 +475,7 @@ if __name__ == '__main__':
     # ================= 配置区 =================
     input_file = 'stock_list.xlsx'
     output_html = 'index.html'    # Gitee Pages 默认入口通常是 index.html
+    failure_report = 'fetch_failures.csv'   # 抓取失败明细
     today_str = today_str = datetime.date.today().strftime('%Y-%m-%d')
     start_date = today_str     # 你的日期
     end_date = today_str
@@ -491,13 +488,8 @@ if __name__ == '__main__':
 
     print(f"正在读取 {input_file} ...")
     try:
-        meta_df = pd.read_excel(input_file, usecols=[0, 1, 2, 3, 4])
-        meta_df.columns = ['code', 'name', 'industry', 'area', 'type']
-        meta_df.dropna(subset=['code'], inplace=True)
-        meta_df = meta_df[meta_df['code'].astype(str).str.strip() != '']
-        meta_df['code'] = meta_df['code'].astype(str).str.replace(r'\.0$', '', regex=True).str.zfill(6)
-        
-        stock_list = meta_df.to_dict('records')
+        # 股票列表走编译好的注册表 universe.npy (表格未变化时不再重新解析 xlsx)
+        stock_list = load_stock_list()
         print(f"成功加载 {len(stock_list)} 只有效股票信息。")
         
     except Exception as e:
@@ -507,20 +499,30 @@ if __name__ == '__main__':
     print(f"开始计算，时间范围: {start_date} 至 {end_date} ...")
     all_results = []
     
-    with ThreadPoolExecutor(max_workers=3) as executor:
-        futures = {executor.submit(process_stock, stock, start_date, end_date): stock['code'] for stock in stock_list}
-        count = 0
-        total = len(futures)
-        for future in as_completed(futures):
-            try:
-                data = future.result()
-                if data:
-                    all_results.extend(data)
-            except Exception:
-                pass
-            count += 1
-            if count % 10 == 0 or count == total:
-                print(f"进度: {count}/{total}", end='\r')
+    # 第一阶段：异步抓取 (令牌桶限速 + 超时 + 抖动指数退避重试)，重试耗尽的股票写入失败报告
+    def show_fetch_progress(done, total, failed):
+        if done % 10 == 0 or done == total:
+            print(f"抓取进度: {done}/{total} (失败: {failed})", end='\r')
+
+    jobs = {stock['code']: (stock['code'], start_date, end_date) for stock in stock_list}
+    bars, failures = fetch_all(load_bars, jobs, rate=FETCH_RATE, burst=FETCH_BURST, concurrency=FETCH_CONCURRENCY,
+                               timeout=FETCH_TIMEOUT, max_retries=FETCH_RETRIES, on_done=show_fetch_progress)
+    if write_failure_report(failures, failure_report):
+        print(f"\n⚠️ {len(failures)} 只股票在 {FETCH_RETRIES} 次重试后仍抓取失败，明细见 {failure_report}")
+
+    # 第二阶段：逐只计算信号 (纯 CPU，不再占用网络配额)
+    count = 0
+    total = len(bars)
+    for stock in stock_list:
+        df = bars.get(stock['code'])
+        if df is None:
+            continue
+        data = process_stock(stock, start_date, end_date, df)
+        if data:
+            all_results.extend(data)
+        count += 1
+        if count % 10 == 0 or count == total:
+            print(f"计算进度: {count}/{total}    ", end='\r')
 
     if all_results:
         final_df = pd.DataFrame(all_results)
@@ -1,4 +1,3 @@
-import time
 import datetime
 import os
 import numpy as np
@@ -6,29 +5,23 @@ import pandas as pd
 import plotly.express as px
 import plotly.io as pio
 from concurrent.futures import ThreadPoolExecutor, as_completed
-from mootdx.quotes import Quotes
+from tdx_pool import TdxClientPool
+from market_data import get_daily_bars
+from tdx_adjust import adjust_qfq_for_tdx, load_xdxr_cached
+from universe import load_stock_list
+from indicators import sma, rolling_extrema, cached_indicators, main_wave_specs, signal_flag, signal_streak, render_signal
+from indicator_state import advance
+
+# --- 指标配置 ---
+SCREENER_SPECS = {**main_wave_specs(min_periods=1), 'VAR1': ('VAR1',)}  # 与原 rolling(n, min_periods=1) 写法一致
+# True: 用持久化的逐日指标状态 (indicator_state.py) 只推进新K线；False: 每天对最近 800 根K线整段重算
+# 注意：开启后发布的策略2连续天数 (xN) 会与整段重算不同 —— 逐日推进按每天收盘时的下轨计数，
+#       不会被原 XMA 向历史平移后的值回溯改写 (replay_signals.py tdx 口径回放中约半数股票的 S2 连续天数不一致)
+USE_INDICATOR_STATE = False
 
 # ==========================================
 # 1. 核心算法函数定义
 # ==========================================
-def sma(series, n, m):
-    sma_values = []
-    series_array = series.values
-    val = np.nan
-    for i, x in enumerate(series_array):
-        if i < n - 1:
-            sma_values.append(np.nan)
-        elif i == n - 1:
-            val = np.nanmean(series_array[:n])
-            sma_values.append(val)
-        else:
-            if np.isnan(val):
-                val = np.nanmean(series_array[:i+1])
-            else:
-                val = (x * m + val * (n - m)) / n
-            sma_values.append(val)
-    return pd.Series(sma_values, index=series.index)
-
 def calculate_xma(series, window):
     # 【修复】完全对齐通达信的 XMA 算法 (向历史平移)
     shift_num = int((window - 1) / 2)
@@ -37,170 +30,155 @@ def calculate_xma(series, window):
     return xma.fillna(ma_fallback)
 
 # ==========================================
-# 2. 通达信动态前复权 (QFQ) 算法核心
+# 2. 单只股票处理引擎
 # ==========================================
-def adjust_qfq_for_tdx(df_kline, df_xdxr):
-    if df_xdxr is None or df_xdxr.empty:
-        return df_kline
-    df_xdxr = df_xdxr[df_xdxr['category'] == 1].copy()
-    if df_xdxr.empty:
-        return df_kline
-    df_xdxr['date'] = pd.to_datetime(df_xdxr['year'].astype(str) + '-' + df_xdxr['month'].astype(str) + '-' + df_xdxr['day'].astype(str))
-    df_xdxr.set_index('date', inplace=True)
-    df_xdxr.sort_index(ascending=False, inplace=True)
-    df_kline['adj_factor'] = 1.0
-    for date, row in df_xdxr.iterrows():
-        songzhuan = row.get('songzhuangu', 0) or 0
-        fenhong = row.get('fenhong', 0) or 0
-        peigu = row.get('peigu', 0) or 0
-        peigujia = row.get('peigujia', 0) or 0
-        mask = df_kline.index < date
-        denominator = 1 + (songzhuan / 10.0) + (peigu / 10.0)
-        df_kline.loc[mask, 'adj_factor'] = df_kline.loc[mask, 'adj_factor'] / denominator
-    for col in ['开盘', '收盘', '最高', '最低']:
-        df_kline[col] = df_kline[col] * df_kline['adj_factor']
-    return df_kline
+def fetch_full_history(symbol, client):
+    """整段从通达信获取最近 800 个交易日并做本地前复权 (本地仓库缺失、窗口内有除权除息或复权校验失败时的回退路径)"""
+    df = client.bars(symbol=symbol, frequency=9, offset=800)
+    if df is None or df.empty:
+        return None
+        
+    df.rename(columns={'datetime': '日期', 'open': '开盘', 'high': '最高', 'low': '最低', 'close': '收盘', 'vol': '成交量'}, inplace=True)
+    df['日期'] = pd.to_datetime(df['日期']).dt.normalize()
+    df.set_index('日期', inplace=True)
+    df.sort_index(inplace=True)
+
+    for c in ['开盘', '收盘', '最高', '最低', '成交量']:
+        df[c] = pd.to_numeric(df[c], errors='coerce')
+    # 成交量统一为"股" (通达信返回"手")，与本地仓库一致
+    df['成交量'] = df['成交量'] * 100
+        
+    # 除权除息信息走本地缓存，缓存过期或尾部校验发现除权迹象时才重新请求
+    df_xdxr = load_xdxr_cached(client, symbol)
+    return adjust_qfq_for_tdx(df, df_xdxr)
+
+def compute_signals(df, symbol=None):
+    """
+    批量计算三个策略的全部指标与信号列 (日期索引、升序的日线 DataFrame，原地追加列后返回)。
+    逐日增量状态 indicator_state.py 的 'tdx' 口径以此为准，replay_signals.py 用它做逐日对照。
+    """
+    # 均线 / 均量 / MACD / VAR1 走公共指标库 (按内容哈希缓存，数据未变的股票直接读缓存)
+    for name, values in cached_indicators(df, SCREENER_SPECS, symbol).items():
+        df[name] = values
+    
+    ma3 = df['收盘'].rolling(3, min_periods=1).mean()
+    ma6 = df['收盘'].rolling(6, min_periods=1).mean()
+    ma12 = df['收盘'].rolling(12, min_periods=1).mean()
+    ma24 = df['收盘'].rolling(24, min_periods=1).mean()
+    df['BBI'] = (ma3 + ma6 + ma12 + ma24) / 4
+    
+    df['Log_Ret'] = np.log(df['收盘'] / df['收盘'].shift(1))
+    df['波动率%'] = df['Log_Ret'].rolling(20, min_periods=1).std() * np.sqrt(252) * 100
+
+    # --- 策略1：历史大底 ---
+    # 【修复】加入 min_periods=1，兼容不足 500 天的股票
+    hhv = rolling_extrema(df['最高'], [500, 250, 90], 'max', min_periods=1)
+    llv = rolling_extrema(df['最低'], [500, 250, 90], 'min', min_periods=1)
+    for p in [500, 250, 90]:
+        df[f'HHV{p}'] = hhv[p]
+        df[f'LLV{p}'] = llv[p]
+        df[f'R_HHV{p}'] = df[f'HHV{p}'].rolling(21, min_periods=1).mean()
+        df[f'R_LLV{p}'] = df[f'LLV{p}'].rolling(21, min_periods=1).mean()
+        
+    df['R7'] = (df['R_LLV500']*0.96 + df['R_LLV250']*0.96 + df['R_LLV90']*0.96 + 
+                df['R_HHV500']*0.558 + df['R_HHV250']*0.558 + df['R_HHV90']*0.558) / 6
+    df['R8'] = (df['R_LLV500']*1.25 + df['R_LLV250']*1.23 + df['R_LLV90']*1.2 + 
+                df['R_HHV500']*0.55 + df['R_HHV250']*0.55 + df['R_HHV90']*0.65) / 6
+    df['R9'] = (df['R_LLV500']*1.3 + df['R_LLV250']*1.3 + df['R_LLV90']*1.3 + 
+                df['R_HHV500']*0.68 + df['R_HHV250']*0.68 + df['R_HHV90']*0.68) / 6
+    
+    df['RA'] = (df['R7']*3 + df['R8']*2 + df['R9']) / 6 * 1.738
+    df['RA'] = df['RA'].rolling(21, min_periods=1).mean()
+    
+    df['RB'] = df['最低'].shift(1)
+    df['ABS_LOW_RB'] = (df['最低'] - df['RB']).abs()
+    df['MAX_LOW_RB'] = (df['最低'] - df['RB']).clip(lower=0)
+    df['SMA_ABS'] = sma(df['ABS_LOW_RB'], 3, 1)
+    df['SMA_MAX'] = sma(df['MAX_LOW_RB'], 3, 1)
+    
+    with np.errstate(divide='ignore', invalid='ignore'):
+        df['RC'] = np.where(df['SMA_MAX'] != 0, (df['SMA_ABS'] / df['SMA_MAX']) * 100, 0)
+    
+    df['RD'] = np.where(df['收盘']*1.35 <= df['RA'], df['RC']*10, df['RC']/10)
+    df['RD'] = df['RD'].rolling(3, min_periods=1).mean()
+    df['RE'] = df['最低'].rolling(30, min_periods=1).min()
+    df['RF'] = df['RD'].rolling(30, min_periods=1).max()
+    df['R10'] = df['收盘'].rolling(58, min_periods=1).mean().notna().astype(int)
+    
+    # 【修复】大底建仓最终公式对齐通达信
+    # 【修改后：严格对齐通达信的红柱 COLORSTICK】
+    raw_signal = np.where(df['最低'] <= df['RE'], (df['RD'] + df['RF']*2)/2, 0)
+    df['S1_Raw_Val'] = pd.Series(raw_signal, index=df.index).rolling(3, min_periods=1).mean() / 618 * df['R10']
+    
+    # 只要公式计算结果大于 0，就对应通达信里画出红色柱子，绝不擅自延长
+    df['S1_Signal'] = signal_flag(df['S1_Raw_Val'] > 0)
+
+    # --- 策略2：波段回调 (做T) ---
+    # 【修改后：引入通达信的 CROSS 逻辑】
+    df['S2_BuyLine'] = calculate_xma(df['VAR1'], 32) * (1 - 4/100)
+    df['S2_Signal'] = signal_flag((df['S2_BuyLine'].notna()) & (df['最低'] <= df['S2_BuyLine']))
+
+
+    # --- 策略3：主升浪 ---
+    df['MA20_Slope'] = (df['MA20'] / df['MA20'].shift(1) - 1) * 100
+    df['MA20_Angle'] = np.degrees(np.arctan(df['MA20_Slope']))
+
+    cond_angle = df['MA20_Angle'] > 25
+    cond_trend = (df['收盘'] > df['MA10']) & (df['MA5'] > df['MA20']) & (df['MA20'] > df['MA60']) & (df['MA60'] > df['MA60'].shift(1))
+    cond_power = (df['收盘'] / df['收盘'].shift(1) > 1.03) & (df['收盘'] > df['开盘'])
+    cond_vol = df['成交量'] > df['VOL_MA5']
+    cond_macd = (df['DIF'] > 0) & (df['DIF'] > df['DEA'])
+
+    df['S3_Signal'] = signal_flag(cond_angle & cond_trend & cond_power & cond_vol & cond_macd)
+
+    # --- 连续信号计数 (xN)：内部只存 int8 标记与 int16 连续天数，输出时再渲染成字符串 ---
+    for k in (1, 2, 3):
+        df[f'S{k}_Streak'] = signal_streak(df[f'S{k}_Signal'])
+    return df
+
+def build_output_row(stock_info, latest_date, row):
+    """row 为批量计算的最后一行或逐日状态返回的输出行，两者列名相同"""
+    return {
+        '股票代码': stock_info['code'],
+        '股票简称': stock_info['name'],
+        '主营行业': stock_info['industry'],
+        '地区': stock_info['area'],
+        '类型': stock_info['type'],
+        '日期': latest_date.strftime('%Y-%m-%d'),
+        '收盘价': round(row['收盘'], 2),
+        '策略1': render_signal(row['S1_Streak'], 'Y'), 
+        '策略2': render_signal(row['S2_Streak'], 'Y'),
+        '策略3': render_signal(row['S3_Streak'], '🔥'), 
+        'MA20斜率': round(row['MA20_Angle'], 2),
+        'BBI': round(row['BBI'], 2),
+        'MA60': round(row['MA60'], 2),
+        '波动率': round(row['波动率%'], 2)
+    }
 
-# ==========================================
-# 3. 单只股票处理引擎
-# ==========================================
 def process_stock(stock_info, start_date, end_date, client):
     symbol = stock_info['code']
     try:
-        # 获取最近 800 个交易日
-        df = client.bars(symbol=symbol, frequency=9, offset=800)
+        # 复权口径：始终是通达信送转/配股复权 (不处理现金分红)，与原脚本一致。
+        # 最近 800 个交易日内没有除权除息时直接读本地仓库 + 通达信新K线 (此时三种价格相同)，否则整段从通达信下载
+        df = get_daily_bars(symbol, None, end_date, vendor='tdx', client=client, bars=800,
+                            fetch_full=lambda s, a, b: fetch_full_history(s, client))
         
         # 【修复】放宽到 60 天，兼容创业板次新股
         if df is None or df.empty or len(df) < 60:
             return None
-            
-        df.rename(columns={'datetime': '日期', 'open': '开盘', 'high': '最高', 'low': '最低', 'close': '收盘', 'vol': '成交量'}, inplace=True)
-        df['日期'] = pd.to_datetime(df['日期']).dt.normalize()
-        df.set_index('日期', inplace=True)
-        df.sort_index(inplace=True)
-
-        for c in ['开盘', '收盘', '最高', '最低', '成交量']:
-            df[c] = pd.to_numeric(df[c], errors='coerce')
-            
-        df_xdxr = client.xdxr(symbol=symbol)
-        df = adjust_qfq_for_tdx(df, df_xdxr)
-
-        df['MA20'] = df['收盘'].rolling(20, min_periods=1).mean() 
-        df['MA60'] = df['收盘'].rolling(60, min_periods=1).mean()
-        
-        ma3 = df['收盘'].rolling(3, min_periods=1).mean()
-        ma6 = df['收盘'].rolling(6, min_periods=1).mean()
-        ma12 = df['收盘'].rolling(12, min_periods=1).mean()
-        ma24 = df['收盘'].rolling(24, min_periods=1).mean()
-        df['BBI'] = (ma3 + ma6 + ma12 + ma24) / 4
-        
-        df['Log_Ret'] = np.log(df['收盘'] / df['收盘'].shift(1))
-        df['波动率%'] = df['Log_Ret'].rolling(20, min_periods=1).std() * np.sqrt(252) * 100
-
-        # --- 策略1：历史大底 ---
-        for p in [500, 250, 90]:
-            # 【修复】加入 min_periods=1，兼容不足 500 天的股票
-            df[f'HHV{p}'] = df['最高'].rolling(p, min_periods=1).max()
-            df[f'LLV{p}'] = df['最低'].rolling(p, min_periods=1).min()
-            df[f'R_HHV{p}'] = df[f'HHV{p}'].rolling(21, min_periods=1).mean()
-            df[f'R_LLV{p}'] = df[f'LLV{p}'].rolling(21, min_periods=1).mean()
-            
-        df['R7'] = (df['R_LLV500']*0.96 + df['R_LLV250']*0.96 + df['R_LLV90']*0.96 + 
-                    df['R_HHV500']*0.558 + df['R_HHV250']*0.558 + df['R_HHV90']*0.558) / 6
-        df['R8'] = (df['R_LLV500']*1.25 + df['R_LLV250']*1.23 + df['R_LLV90']*1.2 + 
-                    df['R_HHV500']*0.55 + df['R_HHV250']*0.55 + df['R_HHV90']*0.65) / 6
-        df['R9'] = (df['R_LLV500']*1.3 + df['R_LLV250']*1.3 + df['R_LLV90']*1.3 + 
-                    df['R_HHV500']*0.68 + df['R_HHV250']*0.68 + df['R_HHV90']*0.68) / 6
-        
-        df['RA'] = (df['R7']*3 + df['R8']*2 + df['R9']) / 6 * 1.738
-        df['RA'] = df['RA'].rolling(21, min_periods=1).mean()
-        
-        df['RB'] = df['最低'].shift(1)
-        df['ABS_LOW_RB'] = (df['最低'] - df['RB']).abs()
-        df['MAX_LOW_RB'] = (df['最低'] - df['RB']).clip(lower=0)
-        df['SMA_ABS'] = sma(df['ABS_LOW_RB'], 3, 1)
-        df['SMA_MAX'] = sma(df['MAX_LOW_RB'], 3, 1)
-        
-        with np.errstate(divide='ignore', invalid='ignore'):
-            df['RC'] = np.where(df['SMA_MAX'] != 0, (df['SMA_ABS'] / df['SMA_MAX']) * 100, 0)
-        
-        df['RD'] = np.where(df['收盘']*1.35 <= df['RA'], df['RC']*10, df['RC']/10)
-        df['RD'] = df['RD'].rolling(3, min_periods=1).mean()
-        df['RE'] = df['最低'].rolling(30, min_periods=1).min()
-        df['RF'] = df['RD'].rolling(30, min_periods=1).max()
-        df['R10'] = df['收盘'].rolling(58, min_periods=1).mean().notna().astype(int)
-        
-        # 【修复】大底建仓最终公式对齐通达信
-        # 【修改后：严格对齐通达信的红柱 COLORSTICK】
-        raw_signal = np.where(df['最低'] <= df['RE'], (df['RD'] + df['RF']*2)/2, 0)
-        df['S1_Raw_Val'] = pd.Series(raw_signal, index=df.index).rolling(3, min_periods=1).mean() / 618 * df['R10']
-        
-        # 只要公式计算结果大于 0，就对应通达信里画出红色柱子，绝不擅自延长
-        df['策略1_大底信号'] = np.where(df['S1_Raw_Val'] > 0, 'Y', '')
-
-        # --- 策略2：波段回调 (做T) ---
-        # 【修改后：引入通达信的 CROSS 逻辑】
-        df['VAR1'] = (df['收盘'] + df['最高'] + df['开盘'] + df['最低']) / 4
-        df['S2_BuyLine'] = calculate_xma(df['VAR1'], 32) * (1 - 4/100)
-        df['策略2_波段信号'] = np.where(
-            (df['S2_BuyLine'].notna()) & (df['最低'] <= df['S2_BuyLine']), 
-            'Y', ''
-        )
-
-
-        # --- 策略3：主升浪 ---
-        df['MA20_Slope'] = (df['MA20'] / df['MA20'].shift(1) - 1) * 100
-        df['MA20_Angle'] = np.degrees(np.arctan(df['MA20_Slope']))
-        exp12 = df['收盘'].ewm(span=12, adjust=False).mean()
-        exp26 = df['收盘'].ewm(span=26, adjust=False).mean()
-        df['DIF'] = exp12 - exp26
-        df['DEA'] = df['DIF'].ewm(span=9, adjust=False).mean()
-        
-        df['VOL_MA5'] = df['成交量'].rolling(5, min_periods=1).mean()
-        df['MA5'] = df['收盘'].rolling(5, min_periods=1).mean()
-        df['MA10'] = df['收盘'].rolling(10, min_periods=1).mean()
-
-        cond_angle = df['MA20_Angle'] > 25
-        cond_trend = (df['收盘'] > df['MA10']) & (df['MA5'] > df['MA20']) & (df['MA20'] > df['MA60']) & (df['MA60'] > df['MA60'].shift(1))
-        cond_power = (df['收盘'] / df['收盘'].shift(1) > 1.03) & (df['收盘'] > df['开盘'])
-        cond_vol = df['成交量'] > df['VOL_MA5']
-        cond_macd = (df['DIF'] > 0) & (df['DIF'] > df['DEA'])
-
-        df['策略3_主升浪'] = np.where(cond_angle & cond_trend & cond_power & cond_vol & cond_macd, '🔥', '')
-
-        # --- 连续信号标记逻辑 ---
-        check_list = {'策略1_大底信号': 'Y', '策略2_波段信号': 'Y', '策略3_主升浪': '🔥'}
-        for col, marker in check_list.items():
-            condition = df[col] == marker
-            groups = (condition != condition.shift()).cumsum()
-            df['temp_count'] = df.groupby(groups).cumcount() + 1
-            mask = condition & (df['temp_count'] > 1)
-            df.loc[mask, col] = marker + ' x' + df['temp_count'].astype(str)
-
-        if 'temp_count' in df.columns:
-            del df['temp_count']
-            
+        df = df.tail(800).copy()
+
+        if USE_INDICATOR_STATE:
+            row = advance(symbol, df, 'tdx')
+            return [build_output_row(stock_info, row['日期'], row)]
+
+        df = compute_signals(df, symbol)
+
         latest_date = df.index[-1]
-        row = df.iloc[-1]
-
-        output_list = [{
-            '股票代码': stock_info['code'],
-            '股票简称': stock_info['name'],
-            '主营行业': stock_info['industry'],
-            '地区': stock_info['area'],
-            '类型': stock_info['type'],
-            '日期': latest_date.strftime('%Y-%m-%d'),
-            '收盘价': round(row['收盘'], 2),
-            '策略1': row['策略1_大底信号'], 
-            '策略2': row['策略2_波段信号'],
-            '策略3': row['策略3_主升浪'], 
-            'MA20斜率': round(row['MA20_Angle'], 2),
-            'BBI': round(row['BBI'], 2),
-            'MA60': round(row['MA60'], 2),
-            '波动率': round(row['波动率%'], 2)
-        }]
-        # 增加极其短暂的休眠，防止连接太快被通达信封锁
-        time.sleep(0.02)
+        row = df.iloc[-1:].astype(object).iloc[0]  # 按 object 取整行，round 与旧的字符串信号列时一致
+
+        output_list = [build_output_row(stock_info, latest_date, row)]
+        # 限速由连接池按主站控制，这里不再逐只休眠
         return output_list
 
     except Exception as e:
@@ -209,7 +187,7 @@ def process_stock(stock_info, start_date, end_date, client):
         return None
 
 # ==========================================
-# 4. HTML 生成器
+# 3. HTML 生成器
 # ==========================================
 def generate_html_report(df, filename, date_str):
     target_columns = [
@@ -345,7 +323,7 @@ def generate_html_report(df, filename, date_str):
     return filename
 
 # ==========================================
-# 5. 主程序入口
+# 4. 主程序入口
 # ==========================================
 if __name__ == '__main__':
     input_file = 'stock_list.xlsx'
@@ -361,26 +339,21 @@ if __name__ == '__main__':
 
     print(f"正在读取 {input_file} ...")
     try:
-        meta_df = pd.read_excel(input_file, usecols=[0, 1, 2, 3, 4])
-        meta_df.columns = ['code', 'name', 'industry', 'area', 'type']
-        meta_df.dropna(subset=['code'], inplace=True)
-        meta_df = meta_df[meta_df['code'].astype(str).str.strip() != '']
-        meta_df['code'] = meta_df['code'].astype(str).str.replace(r'\.0$', '', regex=True).str.zfill(6)
-        
-        stock_list = meta_df.to_dict('records')
+        # 股票列表走编译好的注册表 universe.npy (表格未变化时不再重新解析 xlsx)
+        stock_list = load_stock_list()
         print(f"成功加载 {len(stock_list)} 只有效股票信息。")
     except Exception as e:
         print(f"读取 Excel 文件失败: {e}")
         exit()
 
-    print(f"📡 正在连接通达信主推服务器 (极速版)...")
-    client = Quotes.factory(market='std', multithread=True, heartbeat=True)
+    print(f"📡 正在连接通达信主站连接池 (极速版)...")
+    client = TdxClientPool()
 
     print(f"开始计算，时间范围: {start_date} 至 {end_date} ...")
     all_results = []
     
-    # 【修复】必须锁定单线程！否则通达信服务器会断开您的连接
-    with ThreadPoolExecutor(max_workers=1) as executor:
+    # 每个主站同一时间只跑一个请求并各自限速，线程数与主站数一致即可安全并行
+    with ThreadPoolExecutor(max_workers=client.size) as executor:
         futures = {executor.submit(process_stock, stock, start_date, end_date, client): stock['code'] for stock in stock_list}
         count = 0
         total = len(futures)
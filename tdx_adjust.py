@@ -0,0 +1,88 @@
+import os
+import datetime
+import threading
+import numpy as np
+import pandas as pd
+
+# ==========================================
+# 通达信前复权 (QFQ) 与除权除息 (xdxr) 本地缓存
+# ==========================================
+
+# --- 配置 ---
+XDXR_CACHE_DIR = './tdx_cache/xdxr'   # 每只股票一个 pickle: {'checked': 'YYYY-MM-DD', 'data': DataFrame}
+XDXR_CACHE_DAYS = 7                   # 缓存超过这么多天重新拉取一次；期间只有发现除权迹象时才提前刷新
+
+def xdxr_event_table(df_xdxr):
+    """从 xdxr 原始表中取出除权除息事件 (category == 1)，按日期升序返回 [date, denominator]"""
+    if df_xdxr is None or df_xdxr.empty:
+        return pd.DataFrame(columns=['date', 'denominator'])
+    events = df_xdxr[df_xdxr['category'] == 1]
+    if events.empty:
+        return pd.DataFrame(columns=['date', 'denominator'])
+
+    songzhuan = events['songzhuangu'].fillna(0) if 'songzhuangu' in events else 0
+    peigu = events['peigu'].fillna(0) if 'peigu' in events else 0
+    table = pd.DataFrame({
+        'date': pd.to_datetime(events['year'].astype(str) + '-' + events['month'].astype(str) + '-' + events['day'].astype(str)),
+        'denominator': 1 + (songzhuan / 10.0) + (peigu / 10.0),
+    })
+    return table.sort_values('date', kind='stable').reset_index(drop=True)
+
+def qfq_factor(dates, df_xdxr):
+    """
+    计算每根K线的前复权因子，可用于行情本身或原始价格存储。
+    K线日期早于某次事件时，因子要依次除以该事件之后 (含) 所有事件的分母。
+    事件之后的日期越晚，被除的事件越少，因此"日期晚于 t 的事件"恰好是按日期倒序的一个前缀：
+    先对倒序分母做一次累积除法，再用 searchsorted 为每根K线找到前缀长度即可，复杂度 O(事件数 + K线数)。
+    """
+    dates = np.asarray(pd.to_datetime(dates), dtype='datetime64[ns]')
+    events = xdxr_event_table(df_xdxr)
+    if events.empty:
+        return np.ones(len(dates))
+
+    event_dates = events['date'].to_numpy(dtype='datetime64[ns]')
+    # 与原逐事件循环相同的运算顺序：1.0 / d_最新 / d_次新 / ...
+    prefix = np.divide.accumulate(np.concatenate([[1.0], events['denominator'].to_numpy(dtype=np.float64)[::-1]]))
+    later_events = len(event_dates) - np.searchsorted(event_dates, dates, side='right')
+    return prefix[later_events]
+
+def adjust_qfq_for_tdx(df_kline, df_xdxr):
+    """对以日期为索引的通达信K线做前复权 (只处理送转股与配股，与原算法一致)"""
+    if df_xdxr is None or df_xdxr.empty:
+        return df_kline
+    if xdxr_event_table(df_xdxr).empty:
+        return df_kline
+    df_kline['adj_factor'] = qfq_factor(df_kline.index, df_xdxr)
+    for col in ['开盘', '收盘', '最高', '最低']:
+        df_kline[col] = df_kline[col] * df_kline['adj_factor']
+    return df_kline
+
+# ==========================================
+# xdxr 本地缓存
+# ==========================================
+def load_xdxr_cached(client, symbol, changed_after=None):
+    """
+    读取 xdxr 缓存；缓存缺失或超过 XDXR_CACHE_DAYS 天时向服务器重新拉取。
+    changed_after: 调用方发现了除权除息的迹象 (不复权价与仓库价在该日期之后的重叠K线上对不上) 时传入，
+                   缓存里没有晚于该日期的事件才提前刷新。每根新K线本身不触发刷新，日常扫描基本只读缓存。
+    """
+    path = os.path.join(XDXR_CACHE_DIR, f"{symbol}.pkl")
+    today = datetime.date.today()
+
+    if os.path.exists(path):
+        cached = pd.read_pickle(path)
+        checked = pd.to_datetime(cached['checked']).date()
+        fresh = (today - checked).days < XDXR_CACHE_DAYS
+        if fresh and changed_after is not None:
+            fresh = (xdxr_event_table(cached['data'])['date'] > pd.Timestamp(changed_after)).any()
+        if fresh:
+            return cached['data']
+
+    df_xdxr = client.xdxr(symbol=symbol)
+    if not os.path.exists(XDXR_CACHE_DIR):
+        os.makedirs(XDXR_CACHE_DIR, exist_ok=True)
+    # 先写临时文件再替换，多线程扫描时不会读到写了一半的缓存
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    pd.to_pickle({'checked': today.strftime('%Y-%m-%d'), 'data': df_xdxr}, tmp_path)
+    os.replace(tmp_path, path)
+    return df_xdxr
@@ -0,0 +1,430 @@
+import re
+import sys
+import math
+import numpy as np
+from indicators import sma_panel, rolling_extrema
+from panel_engine import shift, rolling_mean, ema
+
+# ==========================================
+# 通达信公式编译器 (实验性)：公式文本 -> 去重后的表达式图 -> 面板向量计算
+# ==========================================
+# 实验性质：没有接入任何选股或回测脚本，只在 benchmark.py 里作为一个对照版本。
+# 自检中它与 panel_engine 的手写翻译输出逐位相同、耗时相当 (约 1.1s 对 1.1s)，并没有带来提速，
+# 所以这里只保留基准用到的两个公式 (主升浪 + 历史大底) 和它们用到的算子。
+#
+# 各策略都是手工把通达信公式翻成 pandas/numpy，MA20、DIF 这类公共项在每个策略里各算一遍。
+# 这里直接解析通达信语法 (MA / EMA / SMA / HHV / LLV / REF / CROSS / IF / ABS / MAX / ATAN 及四则、比较、AND/OR)，
+# 所有策略编译进同一张图：每个节点按 (算子, 参数) 做哈希去重，同样的子表达式无论出现在哪个策略、
+# 写在哪个中间变量里都只有一个节点，求值时只算一次。纯常数子树 (含参数) 在编译期折叠。
+# 求值对象是 panel_engine.load_bars 给出的左对齐二维数组，每个算子对全部股票调用一次；
+# 同一序列上不同窗口的 HHV/LLV 合并成一次 rolling_extrema，中间结果在最后一次被引用后立即释放。
+#
+# 与通达信的约定差异：
+#   CROSS(A,B) 按仓库一贯的翻译取 REF(A,1)<=REF(B,1) AND A>B；
+#   MA/HHV/LLV 的 min_periods 在 add_formula 时给定 (回测脚本沿用 rolling(n, min_periods=1) 的写法)。
+
+# --- 配置 ---
+SERIES_NAMES = {'C': '收盘', 'CLOSE': '收盘', 'O': '开盘', 'OPEN': '开盘', 'H': '最高', 'HIGH': '最高',
+                'L': '最低', 'LOW': '最低', 'V': '成交量', 'VOL': '成交量'}
+CONSTANTS = {'PI': math.pi}
+# 函数名 -> (参数个数, 需为常数的参数位置)
+FUNCTIONS = {
+    'MA': (2, (1,)), 'EMA': (2, (1,)), 'SMA': (3, (1, 2)), 'HHV': (2, (1,)), 'LLV': (2, (1,)),
+    'REF': (2, (1,)), 'CROSS': (2, ()), 'IF': (3, ()), 'ABS': (1, ()), 'MAX': (2, ()), 'ATAN': (1, ()),
+}
+COMMUTATIVE = {'+', '*', '=', '<>', 'AND', 'OR', 'MAX'}
+
+# benchmark.py 用到的两个策略。参数 (SLOPE) 在编译时代入
+FORMULAS = {
+    # 策略3 / 主升浪 (RIGHT_SIDE_PRO)
+    'RIGHT_SIDE_PRO': """
+        MA5:MA(C,5); MA10:MA(C,10); MA20:MA(C,20); MA60:MA(C,60); VOL_MA5:MA(V,5);
+        MA20_ANGLE:ATAN((MA20/REF(MA20,1)-1)*100)*(180/PI);
+        DIF:EMA(C,12)-EMA(C,26); DEA:EMA(DIF,9);
+        COND_TREND:=C>MA10 AND MA5>MA20 AND MA20>MA60 AND MA60>REF(MA60,1);
+        COND_POWER:=C/REF(C,1)>1.03 AND C>O;
+        COND_VOL:=V>VOL_MA5;
+        COND_MACD:=DIF>0 AND DIF>DEA;
+        BASE_BUY:COND_TREND AND COND_POWER AND COND_VOL AND COND_MACD;
+        BUY_SIGNAL:MA20_ANGLE>SLOPE AND BASE_BUY;
+        SELL_SIGNAL:CROSS(MA10,C) OR (MA20_ANGLE<0 AND C<MA20);
+    """,
+    # 策略1 / 历史大底
+    'DEEP_BOTTOM': """
+        R_HHV500:MA(HHV(H,500),21); R_HHV250:MA(HHV(H,250),21); R_HHV90:MA(HHV(H,90),21);
+        R_LLV500:MA(LLV(L,500),21); R_LLV250:MA(LLV(L,250),21); R_LLV90:MA(LLV(L,90),21);
+        R7:=(R_LLV500*0.96+R_LLV250*0.96+R_LLV90*0.96+R_HHV500*0.558+R_HHV250*0.558+R_HHV90*0.558)/6;
+        R8:=(R_LLV500*1.25+R_LLV250*1.23+R_LLV90*1.2+R_HHV500*0.55+R_HHV250*0.55+R_HHV90*0.65)/6;
+        R9:=(R_LLV500*1.3+R_LLV250*1.3+R_LLV90*1.3+R_HHV500*0.68+R_HHV250*0.68+R_HHV90*0.68)/6;
+        RA:MA((R7*3+R8*2+R9)/6*1.738,21);
+        SMA_MAX:=SMA(MAX(L-REF(L,1),0),3,1);
+        RC:IF(SMA_MAX<>0,SMA(ABS(L-REF(L,1)),3,1)/SMA_MAX*100,0);
+        RD:MA(IF(C*1.35<=RA,RC*10,RC/10),3);
+        RE:LLV(L,30); RF:HHV(RD,30);
+        RAW_SIGNAL:IF(L<=RE,(RD+RF*2)/2,0);
+    """,
+}
+
+# ==========================================
+# 1. 词法 / 语法
+# ==========================================
+_TOKEN_RE = re.compile(r"""
+    (?P<space>\s+|\{[^}]*\})
+  | (?P<number>\d+\.?\d*|\.\d+)
+  | (?P<name>[A-Za-z_一-鿿][A-Za-z0-9_一-鿿]*)
+  | (?P<op>:=|>=|<=|<>|!=|&&|\|\||[-+*/()<>=,;:])
+""", re.VERBOSE)
+_OP_ALIASES = {'&&': 'AND', '||': 'OR', '!=': '<>'}
+_COMPARE = ('>', '<', '>=', '<=', '=', '<>')
+
+def tokenize(text):
+    """返回 [(类型, 值, 位置)]，类型为 number / name / op；名字统一转大写 (通达信不区分大小写)"""
+    tokens, pos = [], 0
+    while pos < len(text):
+        m = _TOKEN_RE.match(text, pos)
+        if not m:
+            raise ValueError(f"无法识别的字符 {text[pos]!r} (位置 {pos})")
+        kind, value = m.lastgroup, m.group()
+        if kind == 'number':
+            tokens.append(('number', float(value), pos))
+        elif kind == 'name':
+            upper = value.upper()
+            tokens.append(('op', upper, pos) if upper in ('AND', 'OR') else ('name', upper, pos))
+        elif kind == 'op':
+            tokens.append(('op', _OP_ALIASES.get(value, value), pos))
+        pos = m.end()
+    tokens.append(('end', None, pos))
+    return tokens
+
+class _Parser:
+    """递归下降：OR < AND < 比较 < 加减 < 乘除 < 一元负号 < 函数/括号；边解析边在图中建节点"""
+    def __init__(self, graph, text, params, min_periods):
+        self.graph, self.tokens, self.i = graph, tokenize(text), 0
+        self.params = {k.upper(): float(v) for k, v in params.items()}
+        self.min_periods = min_periods
+        self.env = {}
+
+    def peek(self):
+        return self.tokens[self.i]
+
+    def take(self, value=None):
+        kind, tok, pos = self.tokens[self.i]
+        if value is not None and tok != value:
+            raise ValueError(f"位置 {pos}: 期望 {value!r}，实际为 {tok!r}")
+        self.i += 1
+        return tok
+
+    def statements(self):
+        """解析全部语句，返回 {输出名: 节点}；'X:=' 是中间变量，'X:' 是输出"""
+        outputs = {}
+        while self.peek()[0] != 'end':
+            if self.peek()[1] == ';':
+                self.take()
+                continue
+            kind, name, pos = self.peek()
+            nxt = self.tokens[self.i + 1][1]
+            if kind != 'name' or nxt not in (':', ':='):
+                raise ValueError(f"位置 {pos}: 语句须为 名称:表达式 或 名称:=表达式")
+            self.take()
+            assign = self.take()
+            node = self.expr()
+            self.env[name] = node
+            if assign == ':':
+                outputs[name] = node
+            if self.peek()[0] != 'end':
+                self.take(';')
+        return outputs
+
+    def expr(self):
+        node = self.and_expr()
+        while self.peek()[1] == 'OR':
+            self.take()
+            node = self.graph.op('OR', node, self.and_expr())
+        return node
+
+    def and_expr(self):
+        node = self.compare()
+        while self.peek()[1] == 'AND':
+            self.take()
+            node = self.graph.op('AND', node, self.compare())
+        return node
+
+    def compare(self):
+        node = self.additive()
+        while self.peek()[0] == 'op' and self.peek()[1] in _COMPARE:
+            node = self.graph.op(self.take(), node, self.additive())
+        return node
+
+    def additive(self):
+        node = self.term()
+        while self.peek()[1] in ('+', '-'):
+            node = self.graph.op(self.take(), node, self.term())
+        return node
+
+    def term(self):
+        node = self.unary()
+        while self.peek()[1] in ('*', '/'):
+            node = self.graph.op(self.take(), node, self.unary())
+        return node
+
+    def unary(self):
+        if self.peek()[1] == '-':
+            self.take()
+            return self.graph.op('NEG', self.unary())
+        if self.peek()[1] == '+':
+            self.take()
+            return self.unary()
+        return self.primary()
+
+    def primary(self):
+        kind, tok, pos = self.peek()
+        if kind == 'number':
+            self.take()
+            return self.graph.const(tok)
+        if tok == '(':
+            self.take()
+            node = self.expr()
+            self.take(')')
+            return node
+        if kind != 'name':
+            raise ValueError(f"位置 {pos}: 意外的 {tok!r}")
+        self.take()
+        if self.peek()[1] == '(':
+            return self.call(tok, pos)
+        if tok in self.env:
+            return self.env[tok]
+        if tok in self.params:
+            return self.graph.const(self.params[tok])
+        if tok in CONSTANTS:
+            return self.graph.const(CONSTANTS[tok])
+        if tok in SERIES_NAMES:
+            return self.graph.node('INPUT', SERIES_NAMES[tok])
+        raise ValueError(f"位置 {pos}: 未定义的变量 {tok}")
+
+    def call(self, name, pos):
+        if name not in FUNCTIONS:
+            raise ValueError(f"位置 {pos}: 不支持的函数 {name}")
+        self.take('(')
+        args = [self.expr()]
+        while self.peek()[1] == ',':
+            self.take()
+            args.append(self.expr())
+        self.take(')')
+        arity, const_positions = FUNCTIONS[name]
+        if len(args) != arity:
+            raise ValueError(f"位置 {pos}: {name} 需要 {arity} 个参数，实际 {len(args)} 个")
+        for k in const_positions:
+            if not self.graph.is_const(args[k]):
+                raise ValueError(f"位置 {pos}: {name} 的第 {k + 1} 个参数必须是常数")
+        if name in ('MA', 'HHV', 'LLV'):
+            args.append(self.graph.const(self.min_periods))
+        return self.graph.op(name, *args)
+
+# ==========================================
+# 2. 表达式图 (哈希去重 + 常数折叠)
+# ==========================================
+def _as_float(x):
+    x = np.asarray(x)
+    return x.astype(np.float64) if x.dtype == bool else x
+
+def _as_bool(x):
+    x = np.asarray(x)
+    return x if x.dtype == bool else x != 0
+
+_OPS = {
+    '+': lambda a, b: _as_float(a) + _as_float(b),
+    '-': lambda a, b: _as_float(a) - _as_float(b),
+    '*': lambda a, b: _as_float(a) * _as_float(b),
+    '/': lambda a, b: _as_float(a) / _as_float(b),
+    'NEG': lambda a: -_as_float(a),
+    '>': lambda a, b: _as_float(a) > _as_float(b),
+    '<': lambda a, b: _as_float(a) < _as_float(b),
+    '>=': lambda a, b: _as_float(a) >= _as_float(b),
+    '<=': lambda a, b: _as_float(a) <= _as_float(b),
+    '=': lambda a, b: _as_float(a) == _as_float(b),
+    '<>': lambda a, b: _as_float(a) != _as_float(b),
+    'AND': lambda a, b: _as_bool(a) & _as_bool(b),
+    'OR': lambda a, b: _as_bool(a) | _as_bool(b),
+    'IF': lambda c, a, b: np.where(_as_bool(c), a, b),
+    'ABS': lambda a: np.abs(_as_float(a)),
+    'MAX': lambda a, b: np.maximum(_as_float(a), _as_float(b)),
+    'ATAN': lambda a: np.arctan(_as_float(a)),
+}
+
+class FormulaGraph:
+    """
+    多个公式共用的表达式图。节点是 (算子, 参数元组)，参数为子节点编号或常数值；
+    相同的 (算子, 参数) 只建一次，子节点总在父节点之前建立，所以节点编号本身就是拓扑序。
+    """
+    def __init__(self):
+        self.nodes = []            # [(算子, 参数)]
+        self.index = {}            # (算子, 参数) -> 节点编号
+        self.outputs = {}          # 公式名 -> {输出名: 节点编号}
+        self.requested = 0         # 未去重时会建立的节点数 (用于报告去重效果)
+
+    def node(self, op, *args):
+        self.requested += 1
+        key = (op, args)
+        if key not in self.index:
+            self.index[key] = len(self.nodes)
+            self.nodes.append(key)
+        return self.index[key]
+
+    def const(self, value):
+        return self.node('CONST', None if value is None else float(value))
+
+    def is_const(self, node_id):
+        return self.nodes[node_id][0] == 'CONST'
+
+    def value(self, node_id):
+        return self.nodes[node_id][1][0]
+
+    def op(self, op, *args):
+        if op in _OPS and all(self.is_const(a) for a in args):
+            with np.errstate(divide='ignore', invalid='ignore'):
+                folded = _OPS[op](*[np.float64(self.value(a)) for a in args])
+            return self.const(float(folded))
+        if op in COMMUTATIVE:
+            args = tuple(sorted(args))
+        return self.node(op, *args)
+
+    def add_formula(self, name, text, params=None, min_periods=None):
+        """编译一段公式加入图中，返回 {输出名: 节点编号}"""
+        outputs = _Parser(self, text, params or {}, min_periods).statements()
+        self.outputs[name] = outputs
+        return outputs
+
+    @np.errstate(divide='ignore', invalid='ignore')
+    def evaluate(self, bars, names=None):
+        """
+        在左对齐面板上求值，返回 {公式名: {输出名: 二维数组}}。
+        names 给出时只计算这些公式 (以及它们依赖的节点)。
+        """
+        names = list(self.outputs) if names is None else list(names)
+        wanted = {node for n in names for node in self.outputs[n].values()}
+        needed = set()
+        stack = list(wanted)
+        while stack:
+            node = stack.pop()
+            if node in needed:
+                continue
+            needed.add(node)
+            op, args = self.nodes[node]
+            if op not in ('CONST', 'INPUT'):
+                stack.extend(args)
+
+        # 引用计数：节点最后一次被引用后即释放
+        refs = {node: 0 for node in needed}
+        for node in needed:
+            op, args = self.nodes[node]
+            if op not in ('CONST', 'INPUT'):
+                for a in args:
+                    refs[a] += 1
+        # 同一序列、同一 min_periods 上的多个窗口 HHV/LLV 合并计算
+        extrema_groups = {}
+        for node in needed:
+            op, args = self.nodes[node]
+            if op in ('HHV', 'LLV'):
+                extrema_groups.setdefault((op, args[0], args[2]), []).append(node)
+
+        shape = bars['收盘'].shape
+        values = {}
+        for node in sorted(needed):
+            op, args = self.nodes[node]
+            if node in values:
+                pass
+            elif op == 'CONST':
+                values[node] = args[0]
+            elif op == 'INPUT':
+                values[node] = bars[args[0]]
+            elif op in ('HHV', 'LLV'):
+                group = extrema_groups[(op, args[0], args[2])]
+                windows = {int(self.value(self.nodes[g][1][1])): g for g in group}
+                x = np.broadcast_to(_as_float(values[args[0]]), shape)
+                min_periods = self.value(args[2])
+                result = rolling_extrema(x, list(windows), 'max' if op == 'HHV' else 'min',
+                                         None if min_periods is None else int(min_periods))
+                for w, g in windows.items():
+                    values[g] = result[w]
+            else:
+                values[node] = self._apply(op, [values[a] for a in args], args, bars, shape)
+            if op not in ('CONST', 'INPUT'):
+                for a in args:
+                    refs[a] -= 1
+                    if refs[a] == 0 and a not in wanted:
+                        values.pop(a, None)
+
+        return {n: {out: values[node] for out, node in self.outputs[n].items()} for n in names}
+
+    def _apply(self, op, vals, args, bars, shape):
+        if op in _OPS:
+            return _OPS[op](*vals)
+        x = np.broadcast_to(_as_float(vals[0]), shape)
+        if op == 'MA':
+            return rolling_mean(x, int(vals[1]), None if vals[2] is None else int(vals[2]))
+        if op == 'EMA':
+            return ema(x, int(vals[1]))
+        if op == 'SMA':
+            # SMA 递推是因果的，左对齐补齐行填 0，避免补齐行上反复触发 NaN 重启
+            padding = ~bars['valid'] if 'valid' in bars else np.zeros(shape, dtype=bool)
+            return sma_panel(np.where(padding, 0.0, x), int(vals[1]), int(vals[2]))
+        if op == 'REF':
+            return shift(x, int(vals[1]))
+        if op == 'CROSS':
+            a, b = x, np.broadcast_to(_as_float(vals[1]), shape)
+            return (shift(a) <= shift(b)) & (a > b)
+        raise ValueError(f"未知的算子 {op}")
+
+    def describe(self):
+        """去重效果：(未去重节点数, 实际节点数)"""
+        return self.requested, len(self.nodes)
+
+def compile_strategies(strategies, formulas=FORMULAS):
+    """
+    strategies: {公式名: (参数字典, min_periods)}，全部编译进同一张图并返回。
+    例: compile_strategies({'RIGHT_SIDE_PRO': ({'SLOPE': 25}, 1), 'DEEP_BOTTOM': ({}, None)})
+    """
+    graph = FormulaGraph()
+    for name, (params, min_periods) in strategies.items():
+        graph.add_formula(name, formulas[name], params, min_periods)
+    return graph
+
+# ==========================================
+# 3. 自检：编译结果与 panel_engine 手写翻译逐位比较
+# ==========================================
+def self_check(codes=None):
+    import time
+    from panel_engine import load_bars, main_wave_signals, deep_bottom_signals
+
+    def same(a, b):
+        a, b = np.asarray(a), np.asarray(b)
+        if a.dtype == bool or b.dtype == bool:
+            return np.array_equal(a.astype(bool), b.astype(bool))
+        return np.array_equal(a.view(np.int64), np.asarray(b, dtype=np.float64).view(np.int64))
+
+    checks = [
+        ('RIGHT_SIDE_PRO', {'SLOPE': 25}, 1, lambda bars: main_wave_signals(bars, 1, 25)),
+        ('DEEP_BOTTOM', {}, None, lambda bars: deep_bottom_signals(bars, None)),
+    ]
+    bars = load_bars(codes)
+    graph = compile_strategies({name: (params, mp) for name, params, mp, _ in checks})
+    t0 = time.time()
+    results = graph.evaluate(bars)
+    t1 = time.time()
+    requested, built = graph.describe()
+    print(f"{'+'.join(c[0] for c in checks)}: 表达式节点 {requested} 个，去重后 {built} 个，面板求值 {t1 - t0:.2f}s")
+    for name, _, _, reference in checks:
+        t0 = time.time()
+        expected = reference(bars)
+        t1 = time.time()
+        lower = {k.upper(): v for k, v in expected.items()}
+        compared = 0
+        for out, arr in results[name].items():
+            if out in lower:
+                assert same(arr[bars['valid']], lower[out][bars['valid']]), (name, out)
+                compared += 1
+        print(f"  {name}: {compared} 个输出与手写翻译逐位一致 (手写版本 {t1 - t0:.2f}s)")
+
+if __name__ == '__main__':
+    # python3 tdx_formula.py [股票代码 ...]   编译基准用到的两个策略并与 panel_engine 逐位对照
+    self_check([str(c).zfill(6) for c in sys.argv[1:]] or None)
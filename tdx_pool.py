@@ -0,0 +1,117 @@
+import time
+import queue
+import threading
+from mootdx.quotes import Quotes
+from mootdx.consts import HQ_HOSTS
+
+# ==========================================
+# 通达信多主站连接池
+# ==========================================
+# 单个主站对过快的连续请求会直接断开连接，所以原来只能单线程 + sleep 逐只扫描。
+# 这里把请求分散到多个主站：每个主站一条连接、各自限速，连续失败的主站暂时下线并在冷却后重新做健康检查，
+# 单次请求失败时自动换一个主站重试 (failover)。
+#
+# 说明：通达信协议的日K线指令一次只能查询一只股票，没有多代码批量K线接口，
+#       所以这里的提速来自多主站并行，而不是批量请求。
+
+# --- 配置 ---
+TDX_HOSTS = [(ip, port) for _, ip, port in HQ_HOSTS[:6]]  # 默认使用前 6 个主站
+MIN_INTERVAL = 0.02        # 同一主站两次请求的最小间隔 (秒)，沿用原来单线程时的休眠时间
+CONNECT_TIMEOUT = 5        # 建立连接超时 (秒)
+MAX_FAILURES = 3           # 连续失败多少次后暂时下线该主站
+COOLDOWN_SECONDS = 30      # 下线多久后重新做健康检查
+ACQUIRE_POLL = 0.05        # 取到冷却中的主站时放回去后等待多久再取 (秒)，避免空转
+
+# mootdx 在构造客户端时会改写全局的 BESTIP 配置，多个连接必须串行建立
+_CONNECT_LOCK = threading.Lock()
+
+class TdxClientPool:
+    """多主站连接池：request() 自动选择空闲且健康的主站，失败时换主站重试"""
+
+    def __init__(self, hosts=None, min_interval=MIN_INTERVAL):
+        self.min_interval = min_interval
+        self.slots = [{'server': server, 'client': None, 'last_request': 0.0,
+                       'failures': 0, 'down_until': 0.0} for server in (hosts or TDX_HOSTS)]
+        self._free = queue.Queue()
+        for slot in self.slots:
+            self._free.put(slot)
+
+    @property
+    def size(self):
+        return len(self.slots)
+
+    def _connect(self, slot):
+        """建立连接并做一次健康检查 (拉取 1 根日K线)"""
+        with _CONNECT_LOCK:
+            # raise_exception=True：断线 / 被限流时直接抛异常，而不是静默返回 None 被当成成功
+            client = Quotes.factory(market='std', server=slot['server'], multithread=True,
+                                    heartbeat=True, timeout=CONNECT_TIMEOUT, raise_exception=True)
+        probe = client.bars(symbol='000001', frequency=9, offset=1)
+        if probe is None or probe.empty:
+            client.close()
+            raise ConnectionError(f"主站 {slot['server']} 健康检查失败")
+        slot['client'] = client
+
+    def _mark_failure(self, slot):
+        slot['failures'] += 1
+        if slot['client'] is not None:
+            try:
+                slot['client'].close()
+            except Exception:
+                pass
+            slot['client'] = None
+        if slot['failures'] >= MAX_FAILURES:
+            slot['down_until'] = time.time() + COOLDOWN_SECONDS
+
+    def _acquire(self):
+        """取出一个可用主站；空闲的都在冷却期时放回去稍等再取 (健康主站都被占用时阻塞在队列上)"""
+        while True:
+            slot = self._free.get()
+            wait = slot['down_until'] - time.time()
+            if wait <= 0:
+                return slot
+            self._free.put(slot)
+            time.sleep(min(wait, ACQUIRE_POLL))
+
+    def request(self, method, **kwargs):
+        """在某个健康主站上执行 client.<method>(**kwargs)，失败时依次换主站重试"""
+        last_error = None
+        for _ in range(self.size):
+            slot = self._acquire()
+            try:
+                if slot['client'] is None:
+                    self._connect(slot)
+
+                # 单主站限速
+                wait = slot['last_request'] + self.min_interval - time.time()
+                if wait > 0:
+                    time.sleep(wait)
+                slot['last_request'] = time.time()
+
+                result = getattr(slot['client'], method)(**kwargs)
+                if result is None:
+                    raise ConnectionError(f"主站 {slot['server']} 返回空结果")
+                slot['failures'] = 0
+                slot['down_until'] = 0.0
+                return result
+            except Exception as e:
+                last_error = e
+                self._mark_failure(slot)
+            finally:
+                self._free.put(slot)
+        raise ConnectionError(f"所有通达信主站请求失败: {last_error}")
+
+    def bars(self, **kwargs):
+        return self.request('bars', **kwargs)
+
+    def xdxr(self, **kwargs):
+        return self.request('xdxr', **kwargs)
+
+    def close(self):
+        for slot in self.slots:
+            if slot['client'] is not None:
+                try:
+                    slot['client'].close()
+                except Exception:
+                    pass
+                slot['client'] = None
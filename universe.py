@@ -0,0 +1,191 @@
+import os
+import sys
+import json
+import numpy as np
+import pandas as pd
+
+# ==========================================
+# 股票池注册表 (由 stock_list.xlsx 编译而来的二进制缓存)
+# ==========================================
+# stock_list.xlsx 带有上百万行空白行，openpyxl 每次解析要好几秒；这里只在表格变化时解析一次，
+# 编译成 numpy 结构化数组 universe.npy，之后各脚本加载只需微秒级。
+# 交易所前缀、板块、最小交易单位、涨跌停幅度等按代码推导的规则也统一集中在这里，不再各脚本各写一份。
+
+# --- 配置 ---
+UNIVERSE_SOURCE = 'stock_list.xlsx'
+UNIVERSE_FILE = './universe.npy'         # 编译后的注册表
+UNIVERSE_META = './universe.json'        # 记录来源表格的 mtime / 大小，变化时自动重新编译
+
+UNIVERSE_DTYPE = np.dtype([
+    ('id', np.int32),          # 整数 ID = 在注册表中的行号，热循环里可直接当数组下标
+    ('code', 'U6'),
+    ('name', 'U16'),
+    ('exchange', 'U2'),        # sh / sz / bj
+    ('board', 'U8'),           # main 主板 / star 科创板 / chinext 创业板 / bj 北交所
+    ('lot', np.int32),         # 最小买入单位 (股)
+    ('limit_pct', np.float64), # 涨跌停判定阈值 (%)，略低于理论涨跌幅以容忍价格舍入
+    ('industry', 'U32'),
+    ('area', 'U16'),
+    ('type', 'U16'),
+])
+
+# 每个进程只加载一次
+_UNIVERSE_CACHE = {}
+
+# ==========================================
+# 1. 按代码推导的规则 (注册表之外的代码也可直接调用)
+# ==========================================
+def normalize_code(code):
+    """Excel 读出的 600519.0 / 1 等统一为 6 位字符串"""
+    code_str = str(code).strip()
+    if code_str.endswith('.0'):
+        code_str = code_str[:-2]
+    return code_str.zfill(6)
+
+def exchange_of(code):
+    """交易所前缀：6 开头为上交所，0/3 开头为深交所，4/8/9 开头为北交所"""
+    code = normalize_code(code)
+    if code.startswith('6'):
+        return 'sh'
+    if code.startswith('0') or code.startswith('3'):
+        return 'sz'
+    if code.startswith('4') or code.startswith('8') or code.startswith('9'):
+        return 'bj'
+    return 'sh'  # 默认回退
+
+def board_of(code):
+    code = normalize_code(code)
+    if code.startswith('688'):
+        return 'star'
+    if code.startswith('30'):
+        return 'chinext'
+    if exchange_of(code) == 'bj':
+        return 'bj'
+    return 'main'
+
+def lot_size(code):
+    """最小买入单位：科创板 200 股，其余 100 股"""
+    return 200 if board_of(code) == 'star' else 100
+
+def limit_pct(code):
+    """涨跌停判定阈值 (%)：科创板/创业板 20% 按 19.8 判定，北交所 30% 按 29.8，主板 10% 按 9.8"""
+    board = board_of(code)
+    if board in ('star', 'chinext'):
+        return 19.8
+    if board == 'bj':
+        return 29.8
+    return 9.8
+
+def baostock_code(code):
+    """转换为 Baostock 需要的 sh.600000 / sz.000001 / bj.830799 格式"""
+    code = normalize_code(code)
+    return f"{exchange_of(code)}.{code}"
+
+# ==========================================
+# 2. 编译与加载
+# ==========================================
+def _source_signature(source):
+    stat = os.stat(source)
+    return {'source': os.path.abspath(source), 'mtime': stat.st_mtime, 'size': stat.st_size}
+
+def build_universe(source=UNIVERSE_SOURCE, out_file=UNIVERSE_FILE, meta_file=UNIVERSE_META):
+    """解析股票列表 (A-E 列：代码/简称/行业/地区/类型) 并编译为结构化数组"""
+    meta_df = pd.read_excel(source, usecols=[0, 1, 2, 3, 4])
+    meta_df.columns = ['code', 'name', 'industry', 'area', 'type']
+    meta_df.dropna(subset=['code'], inplace=True)
+    meta_df = meta_df[meta_df['code'].astype(str).str.strip() != '']
+    meta_df['code'] = meta_df['code'].map(normalize_code)
+
+    table = np.zeros(len(meta_df), dtype=UNIVERSE_DTYPE)
+    table['id'] = np.arange(len(meta_df))
+    table['code'] = meta_df['code'].to_numpy()
+    for col in ['name', 'industry', 'area', 'type']:
+        # 空单元格存为空字符串，读取时再还原为 NaN
+        table[col] = meta_df[col].fillna('').astype(str).to_numpy()
+    table['exchange'] = [exchange_of(c) for c in table['code']]
+    table['board'] = [board_of(c) for c in table['code']]
+    table['lot'] = [lot_size(c) for c in table['code']]
+    table['limit_pct'] = [limit_pct(c) for c in table['code']]
+
+    tmp_file = out_file + '.tmp.npy'
+    np.save(tmp_file, table)
+    os.replace(tmp_file, out_file)
+    with open(meta_file, 'w', encoding='utf-8') as f:
+        json.dump(_source_signature(source), f, ensure_ascii=False, indent=2)
+    return table
+
+def universe_is_current(source=UNIVERSE_SOURCE, out_file=UNIVERSE_FILE, meta_file=UNIVERSE_META):
+    if not os.path.exists(out_file) or not os.path.exists(meta_file):
+        return False
+    with open(meta_file, 'r', encoding='utf-8') as f:
+        meta = json.load(f)
+    return meta == _source_signature(source)
+
+def load_universe(source=UNIVERSE_SOURCE, out_file=UNIVERSE_FILE, meta_file=UNIVERSE_META):
+    """返回注册表结构化数组 (表格变化时自动重新编译)"""
+    key = os.path.abspath(out_file)
+    if key in _UNIVERSE_CACHE:
+        return _UNIVERSE_CACHE[key]
+    if os.path.exists(source) and not universe_is_current(source, out_file, meta_file):
+        table = build_universe(source, out_file, meta_file)
+    else:
+        table = np.load(out_file)
+    _UNIVERSE_CACHE[key] = table
+    return table
+
+def code_index(table=None):
+    """{代码: 整数 ID}"""
+    table = load_universe() if table is None else table
+    return {code: i for i, code in enumerate(table['code'].tolist())}
+
+def load_stock_list():
+    """
+    返回与原 meta_df.to_dict('records') 相同格式的列表：
+    [{'code', 'name', 'industry', 'area', 'type'}, ...]，空单元格为 NaN
+    """
+    table = load_universe()
+    records = []
+    for row in table.tolist():
+        _, code, name, _, _, _, _, industry, area, stock_type = row
+        records.append({
+            'code': code,
+            'name': name if name else np.nan,
+            'industry': industry if industry else np.nan,
+            'area': area if area else np.nan,
+            'type': stock_type if stock_type else np.nan,
+        })
+    return records
+
+def registry_column(codes, field, rule):
+    """
+    按注册表取 codes 对应的一列 (如 'lot' / 'limit_pct')，返回与 codes 同顺序的 numpy 数组。
+    回测里股票以整数编号 (codes 中的下标，即 book['stock'] / 共享长表的代码列) 表示，
+    热循环直接按编号取数组元素，不再按代码字符串查字典；注册表之外的代码按 rule 推导。
+    """
+    try:
+        table = load_universe()
+    except FileNotFoundError:
+        table = np.zeros(0, dtype=UNIVERSE_DTYPE)  # 没有注册表时全部按规则推导
+    index = code_index(table)
+    column = table[field]
+    values = []
+    for code in codes:
+        code = normalize_code(code)
+        values.append(column[index[code]] if code in index else rule(code))
+    return np.array(values, dtype=column.dtype)
+
+def lot_array(codes):
+    """与 codes 同顺序的最小买入单位数组，按股票整数编号取值"""
+    return registry_column(codes, 'lot', lot_size)
+
+def limit_array(codes):
+    """与 codes 同顺序的涨跌停判定阈值 (%) 数组，按股票整数编号取值"""
+    return registry_column(codes, 'limit_pct', limit_pct)
+
+if __name__ == '__main__':
+    action = sys.argv[1] if len(sys.argv) > 1 else 'build'
+    if action == 'build':
+        table = build_universe()
+        print(f"✅ 已将 {UNIVERSE_SOURCE} 编译为 {UNIVERSE_FILE}: {len(table)} 只股票。")
+    else:
+        print("用法: python3 universe.py [build]")